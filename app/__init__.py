@@ -2,10 +2,10 @@ import os
 import logging
 from flask import Flask
 from dotenv import load_dotenv
-import google.generativeai as genai
+import model_config
 
-# Configure logging
-logging.basicConfig(level=logging.DEBUG)
+# Configure logging (STUDYLM_LOG_LEVEL, INFO by default)
+logging.basicConfig(level=getattr(logging, model_config.LOG_LEVEL, logging.INFO))
 logger = logging.getLogger(__name__)
 
 def create_app():
@@ -29,11 +29,14 @@ def create_app():
     os.makedirs('static', exist_ok=True)
     
     # Configure Gemini API
+    from .services.model_backends import get_backend
     gemini_api_key = os.getenv("GEMINI_API_KEY")
-    if not gemini_api_key:
-        print("Warning: GEMINI_API_KEY environment variable not found. Please refer to the documentation to see how to set it up.")
+    if model_config.MODEL_BACKEND != 'gemini' or model_config.MODEL_CASSETTE_MODE == 'replay' and model_config.MODEL_CASSETTE:
+        logger.info(f"Using the '{model_config.MODEL_BACKEND}' model backend")
+    elif not gemini_api_key:
+        logger.warning("GEMINI_API_KEY environment variable not found. Please refer to the documentation to see how to set it up.")
     else:
-        genai.configure(api_key=gemini_api_key)
+        get_backend().configure(gemini_api_key)
     
     # Register blueprints
     from .routes.main import main_bp
@@ -44,4 +47,8 @@ def create_app():
     app.register_blueprint(chat_bp)
     app.register_blueprint(quiz_bp)
     
+    # Request rates and latencies for /metrics
+    from .helpers import metrics
+    metrics.init_app(app)
+    
     return app
\ No newline at end of file
@@ -0,0 +1,200 @@
+import os
+import json
+import random
+import threading
+from flask import current_app
+import model_config
+from app.services.file_service import FileService
+from app.core.quiz_generator import QuizGenerator
+from app.services.request_scheduler import PRIORITY_BACKGROUND
+from app.helpers.atomic_io import atomic_write_json
+from app.services.usage_service import usage_scope
+
+# Difficulty labels by where a question came from
+DIFFICULTY_BY_SOURCE = {
+    'section': 'basic',
+    'unit': 'intermediate',
+    'pool': 'exam'
+}
+
+_bank_lock = threading.Lock()
+# Held while a replenishment thread runs, so only one runs at a time
+_replenish_lock = threading.Lock()
+
+class QuestionBank:
+    """Service class for a per-upload bank of generated quiz questions"""
+
+    @staticmethod
+    def load():
+        """Load the question bank, or an empty bank if none exists"""
+        if not os.path.exists(model_config.QUESTION_BANK_FILE):
+            return {'workspace_id': None, 'questions': []}
+        with open(model_config.QUESTION_BANK_FILE, 'r') as f:
+            return json.load(f)
+
+    @staticmethod
+    def save(bank):
+        """Save the question bank"""
+        atomic_write_json(bank, model_config.QUESTION_BANK_FILE)
+
+    @staticmethod
+    def _entry(question, unit_index, section_index, source):
+        return {
+            'question': question['question'],
+            'choices': question['choices'],
+            'correct_answer': question['correct_answer'],
+            'unit': unit_index,
+            'section': section_index,
+            'source': source,
+            'difficulty': DIFFICULTY_BY_SOURCE[source],
+            'served': 0
+        }
+
+    @staticmethod
+    def index_study_guide(study_guide_data, workspace_id):
+        """
+        Index every section and unit question of a study guide into the bank.
+
+        Pool questions generated earlier for the same workspace are kept; the
+        bank is reset when the workspace changes.
+        """
+        with _bank_lock:
+            bank = QuestionBank.load()
+            if bank.get('workspace_id') != workspace_id:
+                bank = {'workspace_id': workspace_id, 'questions': []}
+
+            questions = [q for q in bank['questions'] if q['source'] == 'pool']
+            for unit_index, unit in enumerate(study_guide_data):
+                for section_index, section in enumerate(unit.get('sections', [])):
+                    for q in section.get('quizzes', []):
+                        questions.append(QuestionBank._entry(q, unit_index, section_index, 'section'))
+                for q in unit.get('unit_quiz', []):
+                    questions.append(QuestionBank._entry(q, unit_index, None, 'unit'))
+
+            bank['questions'] = questions
+            QuestionBank.save(bank)
+            current_app.logger.info(f"Indexed {len(questions)} questions into the question bank")
+            return len(questions)
+
+    @staticmethod
+    def stats(workspace_id):
+        """Count all and not-yet-served questions in the bank for a workspace"""
+        with _bank_lock:
+            bank = QuestionBank.load()
+        if bank.get('workspace_id') != workspace_id:
+            return {'total': 0, 'unserved': 0}
+        questions = bank['questions']
+        return {
+            'total': len(questions),
+            'unserved': sum(1 for q in questions if q['served'] == 0)
+        }
+
+    @staticmethod
+    def sample(workspace_id, num_questions, unit=None, difficulty=None):
+        """
+        Sample a quiz from the bank without a model call.
+
+        Least-served questions are preferred and picks are spread across units.
+
+        Returns:
+            list or None: Questions in quiz format, or None if the bank is too small
+        """
+        with _bank_lock:
+            bank = QuestionBank.load()
+            if bank.get('workspace_id') != workspace_id:
+                return None
+
+            candidates = [
+                q for q in bank['questions']
+                if (unit is None or q['unit'] == unit) and (difficulty is None or q['difficulty'] == difficulty)
+            ]
+            if len(candidates) < num_questions:
+                return None
+
+            # Group by unit, least-served first, then deal round-robin across units
+            random.shuffle(candidates)
+            candidates.sort(key=lambda q: q['served'])
+            by_unit = {}
+            for q in candidates:
+                by_unit.setdefault(q['unit'], []).append(q)
+
+            picked = []
+            while len(picked) < num_questions:
+                for unit_questions in by_unit.values():
+                    if unit_questions and len(picked) < num_questions:
+                        picked.append(unit_questions.pop(0))
+
+            for q in picked:
+                q['served'] += 1
+            QuestionBank.save(bank)
+
+        random.shuffle(picked)
+        return [
+            {'question': q['question'], 'choices': q['choices'], 'correct_answer': q['correct_answer']}
+            for q in picked
+        ]
+
+    @staticmethod
+    def replenish_in_background(file_refs, study_guide_data, workspace_id):
+        """
+        Top up the pool of unserved questions on a background thread
+
+        Args:
+            file_refs (list): Gemini file references, or None to load them in the background
+            study_guide_data (list): The study guide whose units scope the new questions
+            workspace_id (str): Workspace the bank belongs to
+        """
+        if not _replenish_lock.acquire(blocking=False):
+            return
+
+        app = current_app._get_current_object()
+
+        def worker():
+            with app.app_context(), usage_scope(workspace=workspace_id, stage='question_bank'):
+                try:
+                    refs = file_refs or FileService.load_files_from_gemini()
+                    if refs:
+                        QuestionBank.replenish(refs, study_guide_data, workspace_id)
+                except Exception as e:
+                    app.logger.error(f"Error replenishing question bank: {e}")
+                finally:
+                    _replenish_lock.release()
+
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        try:
+            thread.start()
+        except Exception:
+            _replenish_lock.release()
+            raise
+
+    @staticmethod
+    def replenish(file_refs, study_guide_data, workspace_id):
+        """Generate pool questions for each unit until the bank has enough unserved questions"""
+        target = model_config.QUESTION_BANK_TARGET_UNSERVED
+        for unit_index, unit in enumerate(study_guide_data):
+            if not unit.get('sections'):
+                continue
+            if QuestionBank.stats(workspace_id)['unserved'] >= target:
+                break
+
+            with _bank_lock:
+                existing = [q['question'] for q in QuestionBank.load()['questions']]
+
+            questions = QuizGenerator.generate_quiz_questions(
+                file_refs,
+                model_config.QUESTION_BANK_BATCH_SIZE,
+                context_prompt=QuizGenerator.build_unit_context_prompt(unit),
+                priority=PRIORITY_BACKGROUND,
+                exclude_questions=existing,
+                task='question_bank'
+            )
+
+            with _bank_lock:
+                bank = QuestionBank.load()
+                if bank.get('workspace_id') != workspace_id:
+                    # A new upload replaced this workspace while we were generating
+                    return
+                bank['questions'].extend(QuestionBank._entry(q, unit_index, None, 'pool') for q in questions)
+                QuestionBank.save(bank)
+            current_app.logger.info(f"Added {len(questions)} pool questions for unit '{unit['unit']}'")
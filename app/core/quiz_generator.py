@@ -1,14 +1,21 @@
+import re
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from flask import current_app
 import model_config
 from app.services.gemini_service import GeminiService
 from app.services.file_service import FileService
+from app.services.request_scheduler import PRIORITY_GENERATION
+from app.services.model_router import ModelRouter
 from app.helpers.json_utils import extract_json_from_response
+from app.helpers.token_estimator import estimate_input_tokens
+from app.helpers.tracing import span, propagate
 
 class QuizGenerator:
     """Class for generating quiz questions from study materials"""
     
     @staticmethod
-    def generate_quiz_questions(file_refs, num_questions, context_prompt="", model_name=None, progress_callback=None):
+    def generate_quiz_questions(file_refs, num_questions, context_prompt="", model_name=None, progress_callback=None,
+                                priority=PRIORITY_GENERATION, exclude_questions=None, task='quiz'):
         """
         Generate quiz questions using the Gemini API.
         
@@ -16,8 +23,12 @@ class QuizGenerator:
             file_refs (list): List of Gemini file references.
             num_questions (int): Number of quiz questions to generate.
             context_prompt (str, optional): Additional context to include in the prompt.
-            model_name (str, optional): Override the default quiz model.
+            model_name (str, optional): Model to use instead of the routing policy's choice.
             progress_callback (callable, optional): Function to call with progress updates
+            priority (int, optional): Scheduler priority for the model call
+            exclude_questions (list, optional): Question texts already in use elsewhere;
+                                                duplicates of these are dropped
+            task (str, optional): MODEL_ROUTES task used to pick the model for each request
             
         Returns:
             list: List of dictionaries with the following structure:
@@ -41,52 +52,59 @@ class QuizGenerator:
                 log_progress("No file references provided for quiz generation", "warning")
                 return []
             
-            # Use provided model name or fall back to default
-            if not model_name:
-                model_name = model_config.DEFAULT_QUIZ_MODEL
-            
-            # Prepare the context string if provided
-            context_str = f":\n{context_prompt}" if context_prompt else "."
-            
-            # Get the quiz generation prompt from model_config
-            prompt = model_config.QUIZ_GENERATION_PROMPT.format(
-                num_questions=num_questions,
-                context_str=context_str
-            )
-            
-            # Create a new model for the quiz generation
-            quiz_model = GeminiService.create_json_model(model_name)
-            
-            # Use the create_input_with_files function to combine files and prompt
-            input_prompt = FileService.create_input_with_files(file_refs, additional_text=prompt)
-
-            print(input_prompt)
-            
-            # Generate content with the files
-            response = GeminiService.generate_content(quiz_model, input_prompt)
-            
-            # Extract the questions from the respons
-            questions = extract_json_from_response(response)
+            valid_questions = []
+            seen_questions = set(QuizGenerator._question_key(text) for text in (exclude_questions or []))
+            max_requests = 1 + model_config.QUIZ_TOPUP_MAX_ATTEMPTS
             
-            # If we get a dict with 'questions' key, extract the questions
-            if isinstance(questions, dict) and 'questions' in questions:
-                questions = questions['questions']
+            for _ in range(max_requests):
+                missing = num_questions - len(valid_questions)
+                if missing <= 0:
+                    break
+                
+                # Top-up requests only ask for the missing questions and list
+                # the accepted ones so the model does not repeat them
+                request_context = context_prompt
+                if valid_questions:
+                    log_progress(f"Requesting {missing} more questions to reach {num_questions}")
+                    request_context += model_config.QUIZ_TOPUP_CONTEXT.format(
+                        questions=chr(10).join('- ' + q['question'] for q in valid_questions)
+                    )
+                
+                try:
+                    with span('quiz_request', requested=missing, top_up=bool(valid_questions)):
+                        questions = QuizGenerator._request_questions(
+                            file_refs, missing, request_context, model_name, priority, task
+                        )
+                except Exception as e:
+                    if not valid_questions:
+                        raise
+                    # Keep the questions already accepted rather than failing the whole quiz
+                    log_progress(f"Top-up request failed; keeping {len(valid_questions)} questions: {e}", "warning")
+                    break
+                
+                # Validate, repair and de-duplicate each question
+                with span('validate_questions', received=len(questions)) as validate_span:
+                    accepted = len(valid_questions)
+                    for q in questions:
+                        repaired = QuizGenerator.normalize_question(q)
+                        if repaired is None:
+                            log_progress(f"Skipping invalid question structure: {q}", "warning")
+                            continue
+                        key = QuizGenerator._question_key(repaired['question'])
+                        if key in seen_questions:
+                            log_progress(f"Skipping duplicate question: {repaired['question'][:80]}", "warning")
+                            continue
+                        seen_questions.add(key)
+                        valid_questions.append(repaired)
+                    validate_span.set(accepted=len(valid_questions) - accepted)
             
-            # Validate the structure of each question
-            valid_questions = []
-            for q in questions:
-                if (isinstance(q, dict) and 
-                    'question' in q and 
-                    'choices' in q and 
-                    'correct_answer' in q and 
-                    isinstance(q['choices'], list) and 
-                    len(q['choices']) == 4 and 
-                    q['correct_answer'] in q['choices']):
-                    valid_questions.append(q)
-                else:
-                    log_progress(f"Skipping invalid question structure: {q}", "warning")
+            if len(valid_questions) < num_questions:
+                log_progress(
+                    f"Only generated {len(valid_questions)}/{num_questions} valid questions after {max_requests} requests",
+                    "warning"
+                )
             
-            return valid_questions
+            return valid_questions[:num_questions]
             
         except Exception as e:
             error_msg = f"Error generating quiz questions: {e}"
@@ -95,7 +113,225 @@ class QuizGenerator:
                 progress_callback(error_msg)
             raise
 
-# Create an init file to make the core directory a package
-import os
-with open(os.path.join(os.path.dirname(__file__), '__init__.py'), 'w') as f:
-    f.write('# This file makes the core directory a Python package')
\ No newline at end of file
+    @staticmethod
+    def build_unit_context_prompt(unit, sections=None):
+        """
+        Build the unit quiz context from a study guide unit.
+        
+        Args:
+            unit (dict): Unit from the study guide
+            sections (list, optional): Subset of the unit's sections to cover; defaults to all
+        """
+        # Build sections content for the unit quiz prompt
+        sections_content = ""
+        for i, section in enumerate(sections if sections is not None else unit['sections']):
+            section_content = f"""
+            Section {i+1}: {section['section_title']}
+            Overview: {section.get('narrative', '')[:300]}...
+            Key Points:
+            {chr(10).join('- ' + point for point in section.get('key_points', []))}
+            """
+            sections_content += section_content
+        
+        # Use the unit quiz prompt template from model_config
+        return model_config.UNIT_QUIZ_PROMPT_TEMPLATE.format(
+            unit_title=unit['unit'],
+            unit_overview=unit.get('overview', ''),
+            sections_content=sections_content
+        )
+    
+    @staticmethod
+    def plan_quiz_shards(study_guide_data, num_questions):
+        """
+        Split a large quiz into shards scoped to units of the study guide.
+        
+        Questions are shared out in proportion to each unit's section count, and
+        units that receive more than QUIZ_SHARD_MAX_QUESTIONS are split across
+        groups of their sections.
+        
+        Returns:
+            list: Shard dicts with 'unit', 'sections' and 'count'
+        """
+        units = [unit for unit in study_guide_data if unit.get('sections')]
+        if not units:
+            return []
+        
+        weights = [len(unit['sections']) for unit in units]
+        total_weight = sum(weights)
+        counts = [num_questions * weight // total_weight for weight in weights]
+        # Hand out the remainder to the largest units first
+        for i in sorted(range(len(units)), key=lambda i: -weights[i])[:num_questions - sum(counts)]:
+            counts[i] += 1
+        
+        shards = []
+        max_questions = model_config.QUIZ_SHARD_MAX_QUESTIONS
+        for unit, count in zip(units, counts):
+            if count <= 0:
+                continue
+            parts = min(-(-count // max_questions), len(unit['sections']))
+            for part in range(parts):
+                shards.append({
+                    'unit': unit,
+                    'sections': unit['sections'][part::parts],
+                    'count': count // parts + (1 if part < count % parts else 0)
+                })
+        return shards
+    
+    @staticmethod
+    def is_near_duplicate(question_text, other_text):
+        """Whether two questions share most of their words"""
+        words = set(QuizGenerator._question_key(question_text).split())
+        other_words = set(QuizGenerator._question_key(other_text).split())
+        if not words or not other_words:
+            return False
+        overlap = len(words & other_words) / len(words | other_words)
+        return overlap >= model_config.QUIZ_NEAR_DUPLICATE_THRESHOLD
+    
+    @staticmethod
+    def generate_sharded_quiz(file_refs, num_questions, study_guide_data, model_name=None, shard_callback=None):
+        """
+        Generate a large quiz as parallel sub-requests scoped to study guide units.
+        
+        Args:
+            file_refs (list): List of Gemini file references
+            num_questions (int): Total number of questions
+            study_guide_data (list): The generated study guide, used to scope shards
+            model_name (str, optional): Model to use instead of the routing policy's choice
+            shard_callback (callable, optional): Called with (questions, shards_complete, shards_total)
+                                                 each time a shard is merged
+            
+        Returns:
+            list: Merged, near-duplicate-filtered questions
+        """
+        app = current_app._get_current_object()
+        shards = QuizGenerator.plan_quiz_shards(study_guide_data, num_questions)
+        current_app.logger.info(f"Generating {num_questions} questions in {len(shards)} shards")
+        
+        def run_shard(shard):
+            with app.app_context(), span('quiz_shard', unit=shard['unit']['unit'], questions=shard['count']):
+                return QuizGenerator.generate_quiz_questions(
+                    file_refs,
+                    shard['count'],
+                    context_prompt=QuizGenerator.build_unit_context_prompt(shard['unit'], shard['sections']),
+                    model_name=model_name
+                )
+        
+        merged = []
+        
+        def merge(questions):
+            for q in questions:
+                if not any(QuizGenerator.is_near_duplicate(q['question'], m['question']) for m in merged):
+                    merged.append(q)
+        
+        max_workers = max(1, min(model_config.QUIZ_SHARD_MAX_WORKERS, len(shards)))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(propagate(run_shard), shard) for shard in shards]
+            for completed, future in enumerate(as_completed(futures), start=1):
+                try:
+                    merge(future.result())
+                except Exception as e:
+                    # Other shards and the top-up below still produce a usable quiz
+                    current_app.logger.error(f"Quiz shard failed: {e}")
+                if shard_callback:
+                    shard_callback(list(merged), completed, len(shards))
+        
+        # Fill any gap left by failed shards or duplicates with one whole-material request
+        missing = num_questions - len(merged)
+        if missing > 0:
+            current_app.logger.info(f"Topping up sharded quiz with {missing} questions")
+            try:
+                merge(QuizGenerator.generate_quiz_questions(
+                    file_refs,
+                    missing,
+                    model_name=model_name,
+                    exclude_questions=[q['question'] for q in merged]
+                ))
+            except Exception as e:
+                # A short quiz is better than discarding every shard's questions
+                current_app.logger.error(f"Quiz top-up failed; returning {len(merged)} questions: {e}")
+        
+        return merged[:num_questions]
+    
+    @staticmethod
+    def _request_questions(file_refs, num_questions, context_prompt, model_name, priority, task):
+        """Make one quiz generation call and return the raw question list"""
+        # Prepare the context string if provided
+        context_str = f":\n{context_prompt}" if context_prompt else "."
+        
+        # Get the quiz generation prompt from model_config
+        prompt = model_config.QUIZ_GENERATION_PROMPT.format(
+            num_questions=num_questions,
+            context_str=context_str
+        )
+        
+        # Use the create_input_with_files function to combine files and prompt
+        input_prompt = FileService.create_input_with_files(file_refs, additional_text=prompt)
+        
+        # Get the model for the quiz generation, routed by request size unless one was given
+        if not model_name:
+            model_name = ModelRouter.route(task, input_tokens=estimate_input_tokens(input_prompt), questions=num_questions)
+        quiz_model = GeminiService.create_json_model(model_name)
+        
+        # Generate content with the files
+        response = GeminiService.generate_content(quiz_model, input_prompt, priority=priority)
+        
+        # Extract the questions from the response
+        with span('parse_response'):
+            questions = extract_json_from_response(response)
+        
+        # If we get a dict with 'questions' key, extract the questions
+        if isinstance(questions, dict) and 'questions' in questions:
+            questions = questions['questions']
+        
+        return questions if isinstance(questions, list) else []
+    
+    @staticmethod
+    def _normalize_text(text):
+        """Lowercase and collapse whitespace for near-miss comparisons"""
+        return ' '.join(str(text).lower().split())
+    
+    @staticmethod
+    def _question_key(question_text):
+        """Key used to detect duplicate questions"""
+        return re.sub(r'[^a-z0-9 ]', '', QuizGenerator._normalize_text(question_text))
+    
+    @staticmethod
+    def normalize_question(q):
+        """
+        Validate a generated question, repairing near-miss answers locally.
+        
+        The correct answer is matched against the choices exactly, then with
+        whitespace and case normalized, then as a choice letter (A-D).
+        
+        Returns:
+            dict or None: The repaired question, or None if it cannot be used
+        """
+        if not (isinstance(q, dict) and
+                'question' in q and
+                'choices' in q and
+                'correct_answer' in q and
+                isinstance(q['choices'], list) and
+                len(q['choices']) == 4):
+            return None
+        
+        choices = [str(choice).strip() for choice in q['choices']]
+        answer = str(q['correct_answer']).strip()
+        
+        if answer not in choices:
+            normalized_choices = [QuizGenerator._normalize_text(choice) for choice in choices]
+            normalized_answer = QuizGenerator._normalize_text(answer)
+            letter_match = re.match(r'^\(?([a-d])[).:]?(\s+(.*))?$', normalized_answer)
+            
+            if normalized_answer in normalized_choices:
+                answer = choices[normalized_choices.index(normalized_answer)]
+            elif letter_match and (not letter_match.group(3) or
+                                   letter_match.group(3) == normalized_choices['abcd'.index(letter_match.group(1))]):
+                answer = choices['abcd'.index(letter_match.group(1))]
+            else:
+                return None
+        
+        # Duplicate choices make the answer ambiguous
+        if len(set(QuizGenerator._normalize_text(choice) for choice in choices)) != 4:
+            return None
+        
+        return dict(q, question=str(q['question']).strip(), choices=choices, correct_answer=answer)
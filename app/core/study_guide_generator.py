@@ -1,11 +1,50 @@
 import os
+import json
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from flask import current_app
 import model_config
 from app.services.gemini_service import GeminiService
 from app.services.file_service import FileService
-from app.helpers.json_utils import extract_json_from_response, save_json_to_file
+from app.helpers.json_utils import extract_json_from_response
+from app.helpers.guide_storage import save_study_guide, load_study_guide
+from app.services.request_scheduler import PRIORITY_BACKGROUND
+from app.services.model_router import ModelRouter
+from app.helpers.token_estimator import estimate_input_tokens
+from app.helpers.tracing import span, propagate
+from app.services.usage_service import usage_scope
 from app.core.quiz_generator import QuizGenerator
 
+# Schema for a single section of the study guide
+SECTION_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "section_title": {"type": "string"},
+        "narrative": {"type": "string"},
+        "key_points": {
+            "type": "array",
+            "items": {"type": "string"}
+        }
+    },
+    "required": ["section_title", "narrative", "key_points"]
+}
+
+# Schema for the study guide structure (units of sections, without quizzes)
+STUDY_GUIDE_SCHEMA = {
+    "type": "array",
+    "items": {
+        "type": "object",
+        "properties": {
+            "unit": {"type": "string"},
+            "overview": {"type": "string"},
+            "sections": {
+                "type": "array",
+                "items": SECTION_SCHEMA
+            }
+        },
+        "required": ["unit", "overview", "sections"]
+    }
+}
+
 class StudyGuideGenerator:
     """Class for generating structured study guides from study materials"""
     
@@ -16,7 +55,7 @@ class StudyGuideGenerator:
         
         Args:
             file_refs (list): List of Gemini file references
-            model_name (str, optional): Override the default study guide model
+            model_name (str, optional): Model to use instead of the routing policy's choice
             progress_callback (callable, optional): Function to call with progress updates
             
         Returns:
@@ -33,210 +72,373 @@ class StudyGuideGenerator:
                 log_progress("No file references provided for study guide generation")
                 return None
                 
-            # Use provided model name or fall back to default
-            if not model_name:
-                model_name = model_config.DEFAULT_STUDY_GUIDE_MODEL
-            
-            # Create new model for JSON response
-            json_response_model = GeminiService.create_model(model_name)
-            
-            # Define schema for the response
-            section_schema = {
-                "type": "object",
-                "properties": {
-                    "section_title": {"type": "string"},
-                    "narrative": {"type": "string"},
-                    "key_points": {
-                        "type": "array",
-                        "items": {"type": "string"}
-                    }
-                },
-                "required": ["section_title", "narrative", "key_points"]
-            }
-            
-            response_schema = {
-                "type": "array",
-                "items": {
-                    "type": "object",
-                    "properties": {
-                        "unit": {"type": "string"},
-                        "overview": {"type": "string"},
-                        "sections": {
-                            "type": "array",
-                            "items": section_schema
-                        }
-                    },
-                    "required": ["unit", "overview", "sections"]
-                }
-            }
-            
-            # Get the structured study guide prompt from model_config
-            structured_prompt = model_config.STUDY_GUIDE_PROMPT
-            
-            # Create input with files and prompt
-            input_prompt = FileService.create_input_with_files(file_refs, additional_text=structured_prompt)
-            
-            # Log token count for the structured prompt
-            tokens = GeminiService.count_tokens(input_prompt)
-            log_progress(f"Token count: {tokens}", progress=0)
-            
-            # Generate structured response with the schema
-            log_progress("Generating initial study guide structure...", progress=0)
-            structured_response = GeminiService.generate_content(
-                json_response_model,
+            # Estimate the input size locally so generation can start right away;
+            # the exact count arrives later through the progress channel
+            input_prompt = FileService.create_input_with_files(file_refs, additional_text=model_config.STUDY_GUIDE_PROMPT)
+            estimated_tokens = estimate_input_tokens(input_prompt)
+            log_progress(f"Estimated token count: ~{estimated_tokens}", progress=0)
+            GeminiService.count_tokens_in_background(
                 input_prompt,
-                schema=response_schema
+                callback=lambda total_tokens: log_progress(f"Token count: {total_tokens}")
             )
             
-            # Extract the JSON content from the response
-            study_guide_data = extract_json_from_response(structured_response)
+            # Large uploads are outlined per file in parallel and merged afterwards
+            if estimated_tokens > model_config.MAP_REDUCE_TOKEN_THRESHOLD and len(file_refs) > 1:
+                with span('structure', strategy='map_reduce', files=len(file_refs)), usage_scope(stage='structure'):
+                    study_guide_data = StudyGuideGenerator._generate_structure_map_reduce(
+                        file_refs, model_name, log_progress
+                    )
+            else:
+                with span('structure', strategy='single_call', files=len(file_refs)), usage_scope(stage='structure'):
+                    study_guide_data = StudyGuideGenerator._generate_structure(
+                        file_refs, model_name or ModelRouter.route('structure', input_tokens=estimated_tokens),
+                        log_progress
+                    )
             
             total_units = len(study_guide_data)
             # Report that base structure is generated, but keep progress at 0%
             log_progress(f"Generated base structure with {total_units} units", progress=0)
             
-            # Initialize progress tracking variables - we're starting at 0% after base structure
-            cumulative_progress = 0
+            # Checkpoint the structure so later failures never cost the expensive call
+            output_file_path = os.path.join('static', 'output.json')
+            with span('checkpoint'):
+                save_study_guide(study_guide_data, output_file_path)
             
             # Avoid division by zero if there are no units
             if total_units == 0:
                 log_progress("No units were generated in the study guide", progress=100)
                 return study_guide_data
             
-            # Calculate points per unit (distribute 100% equally among units)
-            points_per_unit = 100 / total_units
+            failed_tasks = StudyGuideGenerator._add_quizzes(
+                study_guide_data, file_refs, output_file_path, log_progress, progress_callback
+            )
             
-            # Now add the quizzes to each section and unit
-            for unit_index, unit in enumerate(study_guide_data):
-                unit_title = unit['unit']
-                unit_number = unit_index + 1
-                log_progress(f"Processing unit {unit_number}/{total_units}: {unit_title}...")
-                
-                # Calculate total questions to be generated for this unit
-                num_sections = len(unit['sections'])
-                total_questions_in_unit = (num_sections * 3) + 10  # 3 per section + 10 for unit assessment
-                
-                # Calculate progress increment per question for this unit
-                # Handle division by zero if there are no questions to generate
-                progress_per_question_in_unit = points_per_unit / total_questions_in_unit if total_questions_in_unit > 0 else 0
+            # Ensure final progress is exactly 100%
+            if failed_tasks:
+                log_progress(
+                    f"Study guide generated with {len(study_guide_data)} units; "
+                    f"{failed_tasks} quizzes failed and can be regenerated with resume",
+                    progress=100
+                )
+            else:
+                log_progress(f"Study guide generated successfully with {len(study_guide_data)} units", progress=100)
+            return study_guide_data
+            
+        except Exception as e:
+            error_msg = f"Error generating study guide: {e}"
+            current_app.logger.error(error_msg)
+            if progress_callback:
+                progress_callback(error_msg)
+            raise
+    
+    @staticmethod
+    def resume_study_guide(file_refs, progress_callback=None):
+        """
+        Regenerate only the missing or failed quizzes of the saved study guide.
+        
+        Args:
+            file_refs (list): List of Gemini file references
+            progress_callback (callable, optional): Function to call with progress updates
+            
+        Returns:
+            dict: The completed study guide data structure
+        """
+        try:
+            def log_progress(message, progress=None):
+                current_app.logger.info(message)
+                if progress_callback:
+                    progress_callback(message, progress=progress)
+            
+            output_file_path = os.path.join('static', 'output.json')
+            study_guide_data = load_study_guide(output_file_path, cached=False)
+            
+            missing_tasks = StudyGuideGenerator.count_missing_quizzes(study_guide_data)
+            log_progress(f"Resuming study guide: {missing_tasks} quizzes to regenerate", progress=0)
+            
+            failed_tasks = StudyGuideGenerator._add_quizzes(
+                study_guide_data, file_refs, output_file_path, log_progress, progress_callback
+            )
+            
+            if failed_tasks:
+                log_progress(f"Resume finished; {failed_tasks} quizzes still failed", progress=100)
+            else:
+                log_progress("Study guide completed successfully", progress=100)
+            return study_guide_data
+            
+        except Exception as e:
+            error_msg = f"Error resuming study guide: {e}"
+            current_app.logger.error(error_msg)
+            if progress_callback:
+                progress_callback(error_msg)
+            raise
+    
+    @staticmethod
+    def count_missing_quizzes(study_guide_data):
+        """Count section and unit quizzes that are missing or marked as failed"""
+        missing = 0
+        for unit in study_guide_data:
+            for section in unit['sections']:
+                if not StudyGuideGenerator._quiz_complete(section, 'quizzes', 'quiz_status'):
+                    missing += 1
+            if not StudyGuideGenerator._quiz_complete(unit, 'unit_quiz', 'unit_quiz_status'):
+                missing += 1
+        return missing
+    
+    @staticmethod
+    def _quiz_complete(item, quiz_key, status_key):
+        """
+        Whether a section or unit already has its quiz
+        
+        Guides saved before quiz statuses were recorded count as complete
+        wherever they have questions.
+        """
+        status = item.get(status_key)
+        if status is None:
+            return bool(item.get(quiz_key))
+        return status == 'complete'
+    
+    @staticmethod
+    def _run_quiz_task(file_refs, num_questions, context_prompt, log_progress, progress_callback, task_span, task):
+        """
+        Generate one quiz, retrying it in isolation.
+        
+        Args:
+            task (str): MODEL_ROUTES task, 'section_quiz' or 'unit_quiz'
+        
+        Returns:
+            tuple: (questions, error) where error is None on success
+        """
+        max_attempts = model_config.GUIDE_TASK_MAX_ATTEMPTS
+        for attempt in range(1, max_attempts + 1):
+            task_span.set(attempts=attempt)
+            try:
+                questions = QuizGenerator.generate_quiz_questions(
+                    file_refs, 
+                    num_questions, 
+                    context_prompt=context_prompt,
+                    progress_callback=progress_callback,  # Pass the progress callback here
+                    priority=PRIORITY_BACKGROUND,
+                    task=task
+                )
+                task_span.set(questions=len(questions))
+                return questions, None
+            except Exception as e:
+                log_progress(f"Quiz generation attempt {attempt}/{max_attempts} failed: {e}")
+                task_span.set(error=str(e))
+                error = e
+        return [], error
+    
+    @staticmethod
+    def _add_quizzes(study_guide_data, file_refs, output_file_path, log_progress, progress_callback):
+        """
+        Add quizzes to every section and unit that does not have a completed one.
+        
+        Each finished task is checkpointed to output_file_path immediately, and
+        tasks that keep failing are marked so they can be resumed later.
+        
+        Returns:
+            int: Number of quiz tasks that failed
+        """
+        total_units = len(study_guide_data)
+        failed_tasks = 0
+        
+        # Avoid division by zero if there are no units
+        if total_units == 0:
+            log_progress("No units in the study guide; no quizzes to generate")
+            return failed_tasks
+        
+        # Initialize progress tracking variables - we're starting at 0% after base structure
+        cumulative_progress = 0
+        
+        # Calculate points per unit (distribute 100% equally among units)
+        points_per_unit = 100 / total_units
+        
+        # Now add the quizzes to each section and unit
+        for unit_index, unit in enumerate(study_guide_data):
+            unit_title = unit['unit']
+            unit_number = unit_index + 1
+            log_progress(f"Processing unit {unit_number}/{total_units}: {unit_title}...")
+            
+            # Calculate total questions to be generated for this unit
+            num_sections = len(unit['sections'])
+            total_questions_in_unit = (num_sections * 3) + 10  # 3 per section + 10 for unit assessment
+            
+            # Calculate progress increment per question for this unit
+            # Handle division by zero if there are no questions to generate
+            progress_per_question_in_unit = points_per_unit / total_questions_in_unit if total_questions_in_unit > 0 else 0
+            
+            total_sections = len(unit['sections'])
+            # Add quiz questions to each section
+            for section_index, section in enumerate(unit['sections']):
+                section_title = section['section_title']
+                section_number = section_index + 1
                 
-                total_sections = len(unit['sections'])
-                # Add quiz questions to each section
-                for section_index, section in enumerate(unit['sections']):
-                    section_title = section['section_title']
-                    section_number = section_index + 1
-                    log_progress(f"Processing section {section_number}/{total_sections} for unit {unit_number}: {section_title}...")
-                    
-                    # Create a structured context with section information for better quiz generation
-                    section_context = {
-                        "unit_title": unit_title,
-                        "section_title": section_title,
-                        "section_overview": section.get('narrative', ''),
-                        "key_points": section.get('key_points', [])
-                    }
-                    
-                    # Use the section quiz prompt template from model_config
-                    key_points_formatted = chr(10).join('- ' + point for point in section_context['key_points'])
-                    context_prompt = model_config.SECTION_QUIZ_PROMPT_TEMPLATE.format(
-                        section_title=section_title,
-                        unit_title=unit_title,
-                        section_overview=section_context['section_overview'],
-                        key_points=key_points_formatted
-                    )
-                    
-                    # Generate 3 questions for this section
-                    log_progress(f"Generating 3 quiz questions for section '{section_title}'...")
-                    section_quizzes = QuizGenerator.generate_quiz_questions(
-                        file_refs, 
-                        3, 
-                        context_prompt=context_prompt,
-                        progress_callback=progress_callback  # Pass the progress callback here
-                    )
-                    
-                    # Add the quizzes to the section data
-                    section['quizzes'] = section_quizzes
-                    
-                    # Update progress based on number of questions actually generated
-                    questions_generated = len(section_quizzes)
-                    increment = questions_generated * progress_per_question_in_unit
-                    cumulative_progress += increment
-                    
-                    # Report progress (rounded and capped at 100)
-                    progress_value = min(round(cumulative_progress), 100)
-                    log_progress(
-                        f"Added {questions_generated} questions to section '{section_title}'",
-                        progress=progress_value
-                    )
+                # Skip sections whose quiz was already generated (e.g. when resuming)
+                if StudyGuideGenerator._quiz_complete(section, 'quizzes', 'quiz_status'):
+                    cumulative_progress += len(section.get('quizzes', [])) * progress_per_question_in_unit
+                    continue
                 
-                # Generate 10 questions for the unit assessment
-                log_progress(f"Generating unit assessment quiz for '{unit_title}'...")
+                log_progress(f"Processing section {section_number}/{total_sections} for unit {unit_number}: {section_title}...")
                 
-                # Create a comprehensive context with the unit overview and all sections
-                unit_context = {
+                # Create a structured context with section information for better quiz generation
+                section_context = {
                     "unit_title": unit_title,
-                    "unit_overview": unit.get('overview', ''),
-                    "sections": []
+                    "section_title": section_title,
+                    "section_overview": section.get('narrative', ''),
+                    "key_points": section.get('key_points', [])
                 }
                 
-                # Add all section information to the context
-                for section in unit['sections']:
-                    unit_context['sections'].append({
-                        "title": section['section_title'],
-                        "overview": section.get('narrative', ''),
-                        "key_points": section.get('key_points', [])
-                    })
-                
-                # Build sections content for the unit quiz prompt
-                sections_content = ""
-                for i, section in enumerate(unit_context['sections']):
-                    section_content = f"""
-                    Section {i+1}: {section['title']}
-                    Overview: {section['overview'][:300]}...
-                    Key Points:
-                    {chr(10).join('- ' + point for point in section['key_points'])}
-                    """
-                    sections_content += section_content
-                
-                # Use the unit quiz prompt template from model_config
-                context_prompt = model_config.UNIT_QUIZ_PROMPT_TEMPLATE.format(
+                # Use the section quiz prompt template from model_config
+                key_points_formatted = chr(10).join('- ' + point for point in section_context['key_points'])
+                context_prompt = model_config.SECTION_QUIZ_PROMPT_TEMPLATE.format(
+                    section_title=section_title,
                     unit_title=unit_title,
-                    unit_overview=unit_context['unit_overview'],
-                    sections_content=sections_content
+                    section_overview=section_context['section_overview'],
+                    key_points=key_points_formatted
                 )
                 
-                unit_quiz_list = QuizGenerator.generate_quiz_questions(
-                    file_refs, 
-                    10, 
-                    context_prompt=context_prompt,
-                    progress_callback=progress_callback  # Pass the progress callback here
-                )
+                # Generate 3 questions for this section
+                log_progress(f"Generating 3 quiz questions for section '{section_title}'...")
+                with span('section_quiz', unit=unit_number, section=section_number) as task_span, \
+                        usage_scope(stage='section_quizzes'):
+                    section_quizzes, error = StudyGuideGenerator._run_quiz_task(
+                        file_refs, 3, context_prompt, log_progress, progress_callback, task_span, 'section_quiz'
+                    )
                 
-                # Add the unit quiz to the unit data
-                unit['unit_quiz'] = unit_quiz_list
+                # Add the quizzes to the section data and checkpoint them
+                section['quizzes'] = section_quizzes
+                if error:
+                    failed_tasks += 1
+                    section['quiz_status'] = 'failed'
+                    section['quiz_error'] = str(error)
+                else:
+                    section['quiz_status'] = 'complete'
+                    section.pop('quiz_error', None)
+                with span('checkpoint'):
+                    save_study_guide(study_guide_data, output_file_path)
                 
-                # Update progress based on number of questions actually generated for unit assessment
-                unit_questions_generated = len(unit_quiz_list)
-                unit_increment = unit_questions_generated * progress_per_question_in_unit
-                cumulative_progress += unit_increment
+                # Update progress based on number of questions actually generated
+                questions_generated = len(section_quizzes)
+                increment = questions_generated * progress_per_question_in_unit
+                cumulative_progress += increment
                 
                 # Report progress (rounded and capped at 100)
                 progress_value = min(round(cumulative_progress), 100)
                 log_progress(
-                    f"Added {unit_questions_generated} questions to unit assessment for '{unit_title}'",
+                    f"Added {questions_generated} questions to section '{section_title}'",
                     progress=progress_value
                 )
             
-            # Save clean JSON response to file
-            output_file_path = os.path.join('static', 'output.json')
-            save_json_to_file(study_guide_data, output_file_path)
+            # Skip the unit assessment if it was already generated
+            if StudyGuideGenerator._quiz_complete(unit, 'unit_quiz', 'unit_quiz_status'):
+                cumulative_progress += len(unit.get('unit_quiz', [])) * progress_per_question_in_unit
+                continue
             
-            # Ensure final progress is exactly 100%
-            log_progress(f"Study guide generated successfully with {len(study_guide_data)} units", progress=100)
-            return study_guide_data
+            # Generate 10 questions for the unit assessment
+            log_progress(f"Generating unit assessment quiz for '{unit_title}'...")
             
-        except Exception as e:
-            error_msg = f"Error generating study guide: {e}"
-            current_app.logger.error(error_msg)
-            if progress_callback:
-                progress_callback(error_msg)
-            raise
\ No newline at end of file
+            # Create a comprehensive context with the unit overview and all sections
+            context_prompt = QuizGenerator.build_unit_context_prompt(unit)
+            
+            with span('unit_quiz', unit=unit_number) as task_span, usage_scope(stage='unit_quizzes'):
+                unit_quiz_list, error = StudyGuideGenerator._run_quiz_task(
+                    file_refs, 10, context_prompt, log_progress, progress_callback, task_span, 'unit_quiz'
+                )
+            
+            # Add the unit quiz to the unit data and checkpoint it
+            unit['unit_quiz'] = unit_quiz_list
+            if error:
+                failed_tasks += 1
+                unit['unit_quiz_status'] = 'failed'
+                unit['unit_quiz_error'] = str(error)
+            else:
+                unit['unit_quiz_status'] = 'complete'
+                unit.pop('unit_quiz_error', None)
+            with span('checkpoint'):
+                save_study_guide(study_guide_data, output_file_path)
+            
+            # Update progress based on number of questions actually generated for unit assessment
+            unit_questions_generated = len(unit_quiz_list)
+            unit_increment = unit_questions_generated * progress_per_question_in_unit
+            cumulative_progress += unit_increment
+            
+            # Report progress (rounded and capped at 100)
+            progress_value = min(round(cumulative_progress), 100)
+            log_progress(
+                f"Added {unit_questions_generated} questions to unit assessment for '{unit_title}'",
+                progress=progress_value
+            )
+        
+        return failed_tasks
+    
+    @staticmethod
+    def _generate_structure(file_refs, model_name, log_progress):
+        """Generate the unit/section structure from all files in a single call"""
+        # Create new model for JSON response
+        json_response_model = GeminiService.create_model(model_name)
+        
+        # Create input with files and the structured study guide prompt
+        input_prompt = FileService.create_input_with_files(file_refs, additional_text=model_config.STUDY_GUIDE_PROMPT)
+        
+        # Generate structured response with the schema
+        log_progress("Generating initial study guide structure...", progress=0)
+        structured_response = GeminiService.generate_content(
+            json_response_model,
+            input_prompt,
+            schema=STUDY_GUIDE_SCHEMA
+        )
+        
+        # Extract the JSON content from the response
+        with span('parse_response'):
+            return extract_json_from_response(structured_response)
+    
+    @staticmethod
+    def _generate_structure_map_reduce(file_refs, model_name, log_progress):
+        """
+        Generate the unit/section structure by outlining each file in parallel
+        and merging the outlines with a cheaper text-only reduce call
+        """
+        app = current_app._get_current_object()
+        total_files = len(file_refs)
+        log_progress(f"Large upload detected: outlining {total_files} files in parallel...", progress=0)
+        
+        def outline_file(file_ref):
+            with app.app_context(), span('outline_file', file=file_ref.display_name):
+                input_prompt = FileService.create_input_with_files(
+                    [file_ref], additional_text=model_config.STUDY_GUIDE_MAP_PROMPT
+                )
+                map_model = GeminiService.create_model(
+                    model_name or ModelRouter.route('outline', input_tokens=estimate_input_tokens(input_prompt))
+                )
+                response = GeminiService.generate_content(map_model, input_prompt, schema=STUDY_GUIDE_SCHEMA)
+                with span('parse_response'):
+                    return extract_json_from_response(response)
+        
+        outlines = [None] * total_files
+        max_workers = min(model_config.MAP_REDUCE_MAX_WORKERS, total_files)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(propagate(outline_file), ref): i for i, ref in enumerate(file_refs)}
+            for completed, future in enumerate(as_completed(futures), start=1):
+                index = futures[future]
+                outlines[index] = future.result()
+                log_progress(
+                    f"Outlined file {completed}/{total_files}: {file_refs[index].display_name}",
+                    progress=0
+                )
+        
+        # Merge the per-file outlines into the final structure
+        log_progress("Merging file outlines into the study guide structure...", progress=0)
+        partial_outlines = [
+            {"file": file_ref.display_name, "units": outline}
+            for file_ref, outline in zip(file_refs, outlines)
+        ]
+        reduce_prompt = model_config.STUDY_GUIDE_REDUCE_PROMPT.format(
+            max_units=3 * total_files,
+            outlines=json.dumps(partial_outlines)
+        )
+        with span('reduce_outlines', files=total_files):
+            reduce_model = GeminiService.create_model(
+                ModelRouter.route('reduce', input_tokens=estimate_input_tokens(reduce_prompt))
+            )
+            response = GeminiService.generate_content(reduce_model, reduce_prompt, schema=STUDY_GUIDE_SCHEMA)
+            return extract_json_from_response(response)
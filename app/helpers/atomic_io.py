@@ -0,0 +1,172 @@
+"""
+Atomic file writes for StudyLM
+This module replaces files by writing a temporary file in the same directory,
+fsyncing it and renaming it over the target, so readers only ever see the
+old or the new contents and a crash never leaves a half-written file.
+
+Important artifacts can also keep a few versioned snapshots, listed in a
+small manifest, to recover from if the live file is ever unusable. Snapshots
+live under ARTIFACT_SNAPSHOT_FOLDER, keyed by the artifact's relative path,
+rather than next to the artifact, which may be in the publicly served static
+folder.
+"""
+
+import os
+import json
+import time
+import hashlib
+import logging
+import tempfile
+from threading import Lock
+import model_config
+
+logger = logging.getLogger(__name__)
+
+_manifest_lock = Lock()
+
+def _fsync_directory(directory):
+    """Persist a rename by syncing its directory (not supported on Windows)"""
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+def _write_temp(file_path, content):
+    """Write content to a synced temporary file next to file_path and return its path"""
+    directory = os.path.dirname(os.path.abspath(file_path))
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(file_path) + '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content.encode('utf-8') if isinstance(content, str) else content)
+            f.flush()
+            os.fsync(f.fileno())
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+    return temp_path
+
+def atomic_write(file_path, content):
+    """
+    Atomically replace a file with new contents
+
+    Args:
+        file_path (str): Path of the file to replace
+        content (str or bytes): New contents
+    """
+    temp_path = _write_temp(file_path, content)
+    try:
+        os.replace(temp_path, file_path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+    _fsync_directory(os.path.dirname(os.path.abspath(file_path)))
+
+def atomic_write_json(data, file_path, **dump_kwargs):
+    """Atomically replace a file with the JSON encoding of data"""
+    atomic_write(file_path, json.dumps(data, **dump_kwargs))
+
+def get_snapshot_folder(file_path):
+    """Get the folder that holds a file's snapshots and manifest"""
+    file_path = os.path.abspath(file_path)
+    key = os.path.relpath(file_path)
+    if key.startswith(os.pardir):
+        # Outside the working directory, key by the absolute path instead
+        key = os.path.splitdrive(file_path)[1].lstrip(os.sep)
+    return os.path.join(model_config.ARTIFACT_SNAPSHOT_FOLDER, key)
+
+def get_manifest_path(file_path):
+    """Get the path of the snapshot manifest for a file"""
+    return os.path.join(get_snapshot_folder(file_path), 'manifest.json')
+
+def load_manifest(file_path):
+    """Load the snapshot manifest for a file, or an empty one"""
+    try:
+        with open(get_manifest_path(file_path), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {'file': os.path.basename(file_path), 'current': 0, 'versions': []}
+
+def atomic_write_versioned(file_path, content, keep=None):
+    """
+    Atomically replace a file and keep the new contents as a numbered snapshot
+
+    The snapshot is a separate copy rather than a hard link, so a tool that
+    rewrites the live file in place cannot damage it.
+
+    Args:
+        file_path (str): Path of the file to replace
+        content (str or bytes): New contents
+        keep (int, optional): Number of snapshots to retain
+
+    Returns:
+        int: The version number of the new contents
+    """
+    keep = keep or model_config.ARTIFACT_SNAPSHOT_KEEP
+    data = content.encode('utf-8') if isinstance(content, str) else content
+    name = os.path.basename(file_path)
+    snapshot_folder = get_snapshot_folder(file_path)
+    os.makedirs(snapshot_folder, exist_ok=True)
+
+    with _manifest_lock:
+        manifest = load_manifest(file_path)
+        version = manifest['current'] + 1
+        snapshot_name = f"{name}.{version}"
+        snapshot_path = os.path.join(snapshot_folder, snapshot_name)
+
+        atomic_write(snapshot_path, data)
+        atomic_write(file_path, data)
+
+        manifest['current'] = version
+        manifest['versions'].append({
+            'version': version,
+            'file': snapshot_name,
+            'size': len(data),
+            'sha256': hashlib.sha256(data).hexdigest(),
+            'saved_at': time.time()
+        })
+
+        # Drop the oldest snapshots beyond the retention limit
+        expired, manifest['versions'] = manifest['versions'][:-keep], manifest['versions'][-keep:]
+        atomic_write_json(manifest, get_manifest_path(file_path), indent=2)
+        for entry in expired:
+            try:
+                os.unlink(os.path.join(snapshot_folder, entry['file']))
+            except OSError:
+                pass
+
+    return version
+
+def recover_latest_snapshot(file_path, parse=json.loads):
+    """
+    Restore a file from its newest intact snapshot
+
+    Args:
+        file_path (str): Path of the file to restore
+        parse (callable): Function that validates and parses snapshot bytes
+
+    Returns:
+        The parsed contents of the restored snapshot, or None if no snapshot is usable
+    """
+    snapshot_folder = get_snapshot_folder(file_path)
+    for entry in reversed(load_manifest(file_path)['versions']):
+        try:
+            with open(os.path.join(snapshot_folder, entry['file']), 'rb') as f:
+                data = f.read()
+            if hashlib.sha256(data).hexdigest() != entry['sha256']:
+                raise ValueError("checksum mismatch")
+            parsed = parse(data)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Snapshot {entry['file']} is unusable: {e}")
+            continue
+
+        atomic_write(file_path, data)
+        logger.warning(f"Restored {file_path} from snapshot version {entry['version']}")
+        return parsed
+    return None
@@ -0,0 +1,138 @@
+"""
+Token-budgeted chat history for StudyLM
+This module keeps a sliding window of recent chat turns within a token budget
+and folds older turns into a rolling summary generated in the background.
+"""
+
+import threading
+import model_config
+from app.helpers.token_estimator import estimate_text_tokens
+from app.helpers.tracing import propagate
+
+class ChatHistory:
+    """Sliding window of chat turns with a rolling summary of evicted turns"""
+
+    def __init__(self, token_budget=None, min_turns=None):
+        self.token_budget = token_budget or model_config.CHAT_HISTORY_TOKEN_BUDGET
+        self.min_turns = min_turns if min_turns is not None else model_config.CHAT_HISTORY_MIN_TURNS
+        self.turns = []
+        self.summary = ""
+        self._pending = []
+        self._summarizing = False
+        self._lock = threading.Lock()
+
+    def window_tokens(self):
+        """Total estimated tokens of the turns currently in the window"""
+        with self._lock:
+            return sum(turn['tokens'] for turn in self.turns)
+
+    def add_turn(self, user_text, model_text, model_tokens=None):
+        """
+        Record a completed user/model exchange and evict old turns over budget
+
+        Args:
+            user_text (str): The user's message
+            model_text (str): The model's full response
+            model_tokens (int, optional): Exact output token count if the API reported one
+        """
+        user_tokens = estimate_text_tokens(user_text)
+        if model_tokens is None:
+            model_tokens = estimate_text_tokens(model_text)
+
+        with self._lock:
+            self.turns.append({
+                'user': user_text,
+                'model': model_text,
+                'user_tokens': user_tokens,
+                'model_tokens': model_tokens,
+                'tokens': user_tokens + model_tokens
+            })
+
+            # Move the oldest turns out of the window until we fit the budget
+            total = sum(turn['tokens'] for turn in self.turns)
+            while total > self.token_budget and len(self.turns) > self.min_turns:
+                evicted = self.turns.pop(0)
+                total -= evicted['tokens']
+                self._pending.append(evicted)
+
+    def build_history(self, context_parts=None):
+        """
+        Build a history list for GeminiService.start_chat_session
+
+        Args:
+            context_parts (list, optional): Parts to place ahead of the conversation,
+                                            such as attached study files
+
+        Returns:
+            list: History entries of the form {'role': str, 'parts': list}
+        """
+        with self._lock:
+            summary = self.summary
+            turns = list(self.turns)
+
+        preamble = list(context_parts or [])
+        if summary:
+            preamble.append(f"\n\nSummary of the earlier conversation:\n{summary}")
+
+        history = []
+        if preamble:
+            history.append({'role': 'user', 'parts': preamble})
+            history.append({'role': 'model', 'parts': ["Understood. I'll use these materials to answer your questions."]})
+
+        for turn in turns:
+            history.append({'role': 'user', 'parts': [turn['user']]})
+            history.append({'role': 'model', 'parts': [turn['model']]})
+
+        return history
+
+    def summarize_in_background(self, app):
+        """Fold evicted turns into the rolling summary without blocking the caller"""
+        with self._lock:
+            if not self._pending or self._summarizing:
+                return
+            self._summarizing = True
+
+        # Carry the chat's usage scope so summary tokens are billed to the same chat
+        thread = threading.Thread(target=propagate(self._summarize), args=(app,))
+        thread.daemon = True
+        thread.start()
+
+    def _summarize(self, app):
+        """Generate a new rolling summary from the previous one and the evicted turns"""
+        from app.services.gemini_service import GeminiService
+        from app.services.request_scheduler import PRIORITY_BACKGROUND
+        from app.services.usage_service import usage_scope
+
+        succeeded = False
+        with app.app_context(), usage_scope(stage='chat_summary'):
+            try:
+                with self._lock:
+                    batch = list(self._pending)
+                    previous_summary = self.summary
+
+                transcript = "\n\n".join(
+                    f"User: {turn['user']}\nAssistant: {turn['model']}" for turn in batch
+                )
+                prompt = model_config.CHAT_SUMMARY_PROMPT.format(
+                    previous_summary=previous_summary or "(none)",
+                    transcript=transcript
+                )
+
+                summary_model = GeminiService.create_model(model_config.CHAT_SUMMARY_MODEL)
+                response = GeminiService.generate_content(summary_model, prompt, priority=PRIORITY_BACKGROUND)
+
+                with self._lock:
+                    self.summary = response.text.strip()
+                    del self._pending[:len(batch)]
+                succeeded = True
+                app.logger.info(f"Folded {len(batch)} chat turns into the rolling summary")
+            except Exception as e:
+                app.logger.error(f"Error summarizing chat history: {e}")
+            finally:
+                with self._lock:
+                    self._summarizing = False
+                    more_pending = bool(self._pending)
+
+        # Turns may have been evicted while we were summarizing
+        if succeeded and more_pending:
+            self.summarize_in_background(app)
@@ -0,0 +1,236 @@
+"""
+Study guide storage for StudyLM
+This module stores generated study guides as compact JSON with a sidecar
+index of byte offsets, so a single unit or section can be read without
+parsing the whole guide.
+
+Parsed guides, units and indexes are cached in-process and invalidated
+when the file on disk changes.
+"""
+
+import os
+import json
+from threading import Lock
+from flask import current_app
+from app.helpers.atomic_io import atomic_write, atomic_write_versioned, recover_latest_snapshot
+from app.helpers.metrics import STORE_SIZE, record_cache
+
+# Compact encoding; ASCII-only output keeps character and byte offsets equal
+_SEPARATORS = (',', ':')
+
+# Parsed objects keyed by (path, part), each stored with the file signature it came from
+_cache = {}
+_cache_lock = Lock()
+STORE_SIZE.set_function(lambda: len(_cache), store='study_guide_cache')
+
+def get_index_path(file_path):
+    """Get the path of the offset index that sits next to a guide file"""
+    return file_path + '.idx'
+
+def _signature(file_path):
+    """Identify the current version of a file by modification time and size"""
+    stat = os.stat(file_path)
+    return (stat.st_mtime_ns, stat.st_size)
+
+def _encode(value):
+    return json.dumps(value, separators=_SEPARATORS, ensure_ascii=True)
+
+def encode_study_guide(study_guide_data):
+    """
+    Encode a study guide as compact JSON and compute its offset index
+
+    Args:
+        study_guide_data (list): Units of the study guide
+
+    Returns:
+        tuple: (encoded text, index dict with 'units' and 'sections' offsets)
+    """
+    pieces = ['[']
+    position = 1
+    units = []
+    sections = []
+
+    for unit_number, unit in enumerate(study_guide_data):
+        if unit_number:
+            pieces.append(',')
+            position += 1
+
+        encoded_unit = _encode(unit)
+        units.append([position, position + len(encoded_unit)])
+
+        # Sections are encoded identically inside the unit, so locate them in order
+        unit_sections = []
+        section_list = unit.get('sections') if isinstance(unit, dict) else None
+        if isinstance(section_list, list) and section_list:
+            search_from = encoded_unit.find('"sections":[') + len('"sections":[')
+            for section in section_list:
+                encoded_section = _encode(section)
+                offset = encoded_unit.find(encoded_section, search_from)
+                start = position + offset
+                unit_sections.append([start, start + len(encoded_section)])
+                search_from = offset + len(encoded_section)
+        sections.append(unit_sections)
+
+        pieces.append(encoded_unit)
+        position += len(encoded_unit)
+
+    pieces.append(']')
+    return ''.join(pieces), {'units': units, 'sections': sections}
+
+def save_study_guide(study_guide_data, file_path):
+    """
+    Save a study guide as compact JSON with its offset index
+
+    Args:
+        study_guide_data (list): Units of the study guide
+        file_path (str): Path of the guide file
+
+    Returns:
+        bool: True if successful, raises exception otherwise
+    """
+    try:
+        text, index = encode_study_guide(study_guide_data)
+        version = atomic_write_versioned(file_path, text)
+
+        # Tie the index to this exact version of the guide
+        index['signature'] = list(_signature(file_path))
+        atomic_write(get_index_path(file_path), json.dumps(index, separators=_SEPARATORS))
+
+        with _cache_lock:
+            for key in [key for key in _cache if key[0] == file_path]:
+                del _cache[key]
+
+        current_app.logger.info(f"Saved study guide version {version} to {file_path} ({len(text)} bytes)")
+        return True
+    except Exception as e:
+        current_app.logger.error(f"Error saving study guide to {file_path}: {e}")
+        raise
+
+def _cached(file_path, part, signature, loader):
+    """Return a cached parsed object for this file version, loading it on a miss"""
+    key = (file_path, part)
+    with _cache_lock:
+        entry = _cache.get(key)
+    hit = bool(entry) and entry[0] == signature
+    record_cache('study_guide', hit)
+    if hit:
+        return entry[1]
+
+    value = loader()
+    with _cache_lock:
+        _cache[key] = (signature, value)
+    return value
+
+def _load_index(file_path, signature):
+    """Load the offset index if it matches the current guide file, else None"""
+    def loader():
+        try:
+            with open(get_index_path(file_path), 'r') as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if tuple(index.get('signature', ())) != signature:
+            return None
+        return index
+
+    return _cached(file_path, 'index', signature, loader)
+
+def _read_slice(file_path, start, end):
+    with open(file_path, 'rb') as f:
+        f.seek(start)
+        return json.loads(f.read(end - start))
+
+def load_study_guide(file_path, cached=True):
+    """
+    Load a whole study guide
+
+    Args:
+        file_path (str): Path of the guide file
+        cached (bool): Share the in-process parsed copy. Pass False to get a
+                       private copy that is safe to modify.
+
+    Returns:
+        list: Units of the study guide
+
+    Raises:
+        FileNotFoundError: If the guide doesn't exist
+        ValueError: If the file contains invalid JSON
+    """
+    try:
+        def loader():
+            with open(file_path, 'r') as f:
+                return json.load(f)
+
+        signature = _signature(file_path)
+        if not cached:
+            return loader()
+        return _cached(file_path, 'guide', signature, loader)
+    except FileNotFoundError:
+        current_app.logger.error(f"Study guide not found: {file_path}")
+        raise
+    except json.JSONDecodeError as e:
+        current_app.logger.error(f"Invalid JSON in study guide {file_path}: {e}")
+        recovered = recover_latest_snapshot(file_path)
+        if recovered is None:
+            raise ValueError(f"File contains invalid JSON: {e}")
+        return recovered
+
+def load_study_guide_unit(file_path, unit_index):
+    """
+    Load one unit of a study guide without parsing the rest
+
+    Args:
+        file_path (str): Path of the guide file
+        unit_index (int): Zero-based unit index
+
+    Returns:
+        dict: The unit (shared cached copy; do not modify)
+
+    Raises:
+        FileNotFoundError: If the guide doesn't exist
+        IndexError: If the unit doesn't exist
+    """
+    signature = _signature(file_path)
+    index = _load_index(file_path, signature)
+    if index is None:
+        # Guides written before the index existed fall back to a full load
+        return load_study_guide(file_path)[unit_index]
+
+    if not 0 <= unit_index < len(index['units']):
+        raise IndexError(f"Study guide has no unit {unit_index}")
+    start, end = index['units'][unit_index]
+    return _cached(file_path, ('unit', unit_index), signature,
+                   lambda: _read_slice(file_path, start, end))
+
+def load_study_guide_section(file_path, unit_index, section_index):
+    """
+    Load one section of a study guide unit without parsing the rest
+
+    Args:
+        file_path (str): Path of the guide file
+        unit_index (int): Zero-based unit index
+        section_index (int): Zero-based section index within the unit
+
+    Returns:
+        dict: The section (shared cached copy; do not modify)
+
+    Raises:
+        FileNotFoundError: If the guide doesn't exist
+        IndexError: If the unit or section doesn't exist
+    """
+    signature = _signature(file_path)
+    index = _load_index(file_path, signature)
+    if index is None:
+        try:
+            return load_study_guide(file_path)[unit_index]['sections'][section_index]
+        except (KeyError, TypeError):
+            raise IndexError(f"Unit {unit_index} has no section {section_index}")
+
+    if not 0 <= unit_index < len(index['sections']):
+        raise IndexError(f"Study guide has no unit {unit_index}")
+    unit_sections = index['sections'][unit_index]
+    if not 0 <= section_index < len(unit_sections):
+        raise IndexError(f"Unit {unit_index} has no section {section_index}")
+    start, end = unit_sections[section_index]
+    return _cached(file_path, ('section', unit_index, section_index), signature,
+                   lambda: _read_slice(file_path, start, end))
@@ -1,12 +1,328 @@
 import json
 import re
 from flask import current_app
+from app.helpers.atomic_io import atomic_write_json
+
+# Structural characters outside strings (commas end bare scalar elements of an array),
+# and characters that matter inside strings
+_ARRAY_STRUCTURAL = re.compile(r'[\[\]{}",]')
+_STRING_SPECIAL = re.compile(r'["\\]')
+_WHITESPACE = ' \t\r\n'
+_CLOSERS = {'[': ']', '{': '}'}
+_OPENERS = re.compile(r'[\[{]')
+# Bracketed values tried per response before giving up on finding an object or list of objects
+_MAX_CANDIDATES = 8
+_decoder = json.JSONDecoder()
+
+class JSONExtractionError(ValueError):
+    """Raised when no JSON value can be recovered from a piece of text"""
+
+def _strip_code_fence(text):
+    """Return the contents of the first ```json fence, tolerating a missing closing fence"""
+    fence = text.find("```json")
+    if fence == -1:
+        return text
+    start = fence + 7
+    end = text.find("```", start)
+    return text[start:end] if end != -1 else text[start:]
+
+def _remove_indexes(text, start, end, indexes):
+    """Slice text[start:end] with the characters at the given indexes removed"""
+    if not indexes:
+        return text[start:end]
+    pieces = []
+    previous = start
+    for index in indexes:
+        if index >= end:
+            break
+        pieces.append(text[previous:index])
+        previous = index + 1
+    pieces.append(text[previous:end])
+    return ''.join(pieces)
+
+def _trailing_comma_before(text, pos, floor):
+    """Index of a comma directly before pos (ignoring whitespace), or None"""
+    j = pos - 1
+    while j > floor and text[j] in _WHITESPACE:
+        j -= 1
+    return j if j > floor and text[j] == ',' else None
+
+def _is_expected_shape(data):
+    """Whether parsed data looks like a model response: an object or a list of objects"""
+    if isinstance(data, dict):
+        return True
+    return isinstance(data, list) and all(isinstance(item, dict) for item in data)
+
+def _parse_value_at(text, start, allow_partial):
+    """
+    Parse the JSON object or array that opens at text[start]
+    
+    Returns:
+        tuple: (data, complete, end) where end is the index after the value
+    """
+    # Well-formed values decode directly; only fall back to scanning on error
+    try:
+        data, end = _decoder.raw_decode(text, start)
+        return data, True, end
+    except json.JSONDecodeError:
+        pass
+    
+    stack = []
+    commas = []
+    last_element_end = None
+    last_element_commas = 0
+    pos = start
+    length = len(text)
+    
+    while pos < length:
+        found = _ARRAY_STRUCTURAL.search(text, pos)
+        if not found:
+            break
+        pos = found.start()
+        char = text[pos]
+        
+        if char == '"':
+            # Skip to the end of the string, honouring escapes
+            pos += 1
+            while True:
+                special = _STRING_SPECIAL.search(text, pos)
+                if not special:
+                    pos = length
+                    break
+                if text[special.start()] == '\\':
+                    pos = special.start() + 2
+                    continue
+                pos = special.start() + 1
+                if stack == ['[']:
+                    # A top-level string element just closed
+                    last_element_end = pos - 1
+                    last_element_commas = len(commas)
+                break
+            continue
+        
+        if char == ',':
+            if stack == ['[']:
+                # A comma ends the top-level element before it, including bare scalars
+                value_end = pos - 1
+                while value_end > start and text[value_end] in _WHITESPACE:
+                    value_end -= 1
+                if text[value_end] not in '[,':
+                    last_element_end = value_end
+                    last_element_commas = len(commas)
+        elif char in '[{':
+            stack.append(char)
+        else:
+            comma = _trailing_comma_before(text, pos, start)
+            if comma is not None:
+                commas.append(comma)
+            if not stack or _CLOSERS[stack[-1]] != char:
+                raise JSONExtractionError(f"Mismatched '{char}' at position {pos}")
+            stack.pop()
+            if not stack:
+                cleaned = _remove_indexes(text, start, pos + 1, commas)
+                try:
+                    return json.loads(cleaned), True, pos + 1
+                except json.JSONDecodeError as e:
+                    raise JSONExtractionError(f"Invalid JSON: {e}")
+            if stack == ['[']:
+                # A top-level array element just closed
+                last_element_end = pos
+                last_element_commas = len(commas)
+        pos += 1
+    
+    # The text ended before the value closed
+    if allow_partial and stack and stack[0] == '[':
+        if last_element_end is None:
+            return [], False, length
+        cleaned = _remove_indexes(text, start, last_element_end + 1, commas[:last_element_commas]) + ']'
+        try:
+            return json.loads(cleaned), False, length
+        except json.JSONDecodeError as e:
+            raise JSONExtractionError(f"Invalid JSON in truncated response: {e}")
+    
+    raise JSONExtractionError("Response ended before the JSON value was complete")
+
+def parse_json_text(text, allow_partial=True):
+    """
+    Parse the JSON object or array of objects in a model response in one pass.
+    
+    A ```json fenced block is preferred. Otherwise bracketed values are tried
+    in order and the first object or list of objects is returned, so
+    bracketed prose such as "[3] items:" before the real value is skipped.
+    Any other value is only returned when the response consists of it alone.
+    Trailing commas are dropped. If the text ends before an array closes (a
+    truncated response), the complete elements before the cut are returned
+    when allow_partial is set.
+    
+    Args:
+        text (str): Raw response text
+        allow_partial (bool): Recover the complete prefix of a truncated array
+        
+    Returns:
+        tuple: (data, complete) where complete is False if a prefix was recovered
+        
+    Raises:
+        JSONExtractionError: If no JSON value can be recovered
+    """
+    text = _strip_code_fence(text)
+    
+    leading_value = None
+    first_error = None
+    pos = 0
+    for _ in range(_MAX_CANDIDATES):
+        match = _OPENERS.search(text, pos)
+        if not match:
+            break
+        start = match.start()
+        try:
+            data, complete, end = _parse_value_at(text, start, allow_partial)
+        except JSONExtractionError as e:
+            first_error = first_error or e
+            pos = start + 1
+            continue
+        
+        if _is_expected_shape(data):
+            return data, complete
+        if not text[:start].strip():
+            # The response starts with this value; keep it in case nothing better follows
+            leading_value = (data, complete)
+        pos = end
+    
+    if leading_value is not None:
+        return leading_value
+    raise first_error or JSONExtractionError("No JSON object or array found in response")
+
+class JSONArrayStreamParser:
+    """
+    Incrementally parse a streamed JSON array, yielding each element as soon as it closes.
+    
+    Objects, arrays and strings are yielded at their closing character; numbers,
+    booleans and null at the comma or bracket that ends them.
+    
+    Usage:
+        parser = JSONArrayStreamParser()
+        for chunk in response_stream:
+            for item in parser.feed(chunk.text):
+                ...
+    """
+    
+    def __init__(self):
+        self._buffer = ''
+        self._pos = 0
+        self._started = False
+        self._in_string = False
+        self._depth = 0
+        self._element_start = None
+        self._element_commas = []
+        # Start of the text that may hold the next bare scalar element
+        self._value_from = 0
+        self.finished = False
+    
+    def feed(self, chunk):
+        """Add a chunk of text and return the list of newly completed elements"""
+        if self.finished or not chunk:
+            return []
+        self._buffer += chunk
+        buffer = self._buffer
+        length = len(buffer)
+        pos = self._pos
+        items = []
+        
+        if not self._started:
+            match = re.search(r'\[', buffer[pos:])
+            if not match:
+                self._pos = length
+                return []
+            pos += match.end()
+            self._started = True
+            self._depth = 1
+            self._value_from = pos
+        
+        while pos < length:
+            if self._in_string:
+                special = _STRING_SPECIAL.search(buffer, pos)
+                if not special:
+                    pos = length
+                    break
+                if buffer[special.start()] == '\\':
+                    if special.start() + 1 >= length:
+                        # Wait for the escaped character
+                        pos = special.start()
+                        break
+                    pos = special.start() + 2
+                    continue
+                self._in_string = False
+                pos = special.start() + 1
+                if self._depth == 1:
+                    # A string element of the array
+                    items.append(json.loads(buffer[self._element_start:pos]))
+                    self._element_start = None
+                    self._value_from = pos
+                continue
+            
+            found = _ARRAY_STRUCTURAL.search(buffer, pos)
+            if not found:
+                pos = length
+                break
+            pos = found.start()
+            char = buffer[pos]
+            
+            if char == '"':
+                if self._depth == 1:
+                    self._element_start = pos
+                self._in_string = True
+            elif char == ',':
+                if self._depth == 1:
+                    self._emit_scalar(buffer, pos, items)
+            elif char in '[{':
+                if self._depth == 1:
+                    self._element_start = pos
+                    self._element_commas = []
+                self._depth += 1
+            else:
+                if self._depth == 1:
+                    # The array itself closed
+                    self._emit_scalar(buffer, pos, items)
+                    self._depth = 0
+                    self.finished = True
+                    pos += 1
+                    break
+                if self._element_start is not None:
+                    comma = _trailing_comma_before(buffer, pos, self._element_start)
+                    if comma is not None:
+                        self._element_commas.append(comma)
+                self._depth -= 1
+                if self._depth == 1 and self._element_start is not None:
+                    element = _remove_indexes(buffer, self._element_start, pos + 1, self._element_commas)
+                    items.append(json.loads(element))
+                    self._element_start = None
+                    self._value_from = pos + 1
+            pos += 1
+        
+        # Drop text that can no longer be part of an element
+        keep_from = self._element_start if self._element_start is not None else min(pos, self._value_from)
+        self._buffer = buffer[keep_from:]
+        self._pos = pos - keep_from
+        self._value_from = max(0, self._value_from - keep_from)
+        if self._element_start is not None:
+            self._element_commas = [c - keep_from for c in self._element_commas]
+            self._element_start = 0
+        return items
+    
+    def _emit_scalar(self, buffer, pos, items):
+        """Parse a number, boolean or null element ending at a top-level comma or bracket"""
+        value = buffer[self._value_from:pos].strip(_WHITESPACE)
+        if value:
+            items.append(json.loads(value))
+        self._value_from = pos + 1
 
 def extract_json_from_response(response):
     """
     Extract JSON from the Gemini API response.
     Returns a Python dictionary parsed from the JSON in the response.
     
+    Truncated arrays are recovered up to their last complete element.
+    
     Args:
         response: The Gemini API response object
         
@@ -18,23 +334,11 @@ def extract_json_from_response(response):
     """
     try:
         text = response.text
-        
-        # Check if the response contains Markdown JSON code blocks
-        if "```json" in text:
-            # Extract the content between ```json and ```
-            start_idx = text.find("```json") + 7  # Move past "```json"
-            end_idx = text.find("```", start_idx)
-            if end_idx != -1:
-                text = text[start_idx:end_idx].strip()
-        
-        # Look for JSON content between curly braces if no code block was found
-        if not text.strip() or (not "{" in text and not "[" in text):
-            json_match = re.search(r'({[\s\S]*}|\[[\s\S]*\])', text)
-            if json_match:
-                text = json_match.group(1)
-        
-        # Parse the text as JSON
-        parsed_data = json.loads(text)
+        parsed_data, complete = parse_json_text(text)
+        if not complete:
+            current_app.logger.warning(
+                f"Response JSON was truncated; recovered {len(parsed_data)} complete items"
+            )
         return parsed_data
     except Exception as e:
         current_app.logger.error(f"Error extracting JSON from response: {e}")
@@ -43,7 +347,7 @@ def extract_json_from_response(response):
 
 def save_json_to_file(data, file_path):
     """
-    Save JSON data to a file
+    Save JSON data to a file, atomically replacing any previous version
     
     Args:
         data: The data to save (must be JSON serializable)
@@ -53,8 +357,7 @@ def save_json_to_file(data, file_path):
         bool: True if successful, raises exception otherwise
     """
     try:
-        with open(file_path, 'w') as f:
-            json.dump(data, f, indent=2)
+        atomic_write_json(data, file_path, indent=2)
         current_app.logger.info(f"Saved JSON data to {file_path}")
         return True
     except Exception as e:
@@ -85,8 +388,3 @@ def load_json_from_file(file_path):
     except json.JSONDecodeError as e:
         current_app.logger.error(f"Invalid JSON in file {file_path}: {e}")
         raise ValueError(f"File contains invalid JSON: {e}")
-
-# Create an init file to make the helpers directory a package
-import os
-with open(os.path.join(os.path.dirname(__file__), '__init__.py'), 'w') as f:
-    f.write('# This file makes the helpers directory a Python package')
\ No newline at end of file
@@ -0,0 +1,218 @@
+"""
+Prometheus-style metrics for StudyLM
+This module keeps process-wide counters, gauges and histograms and renders
+them in the Prometheus text exposition format for the /metrics endpoint.
+
+Updates take one small lock per metric, so instrumenting hot paths such as
+every HTTP request and model call costs microseconds. Gauges for in-memory
+stores are read through callbacks at scrape time rather than kept in sync.
+"""
+
+import time
+import bisect
+import logging
+import threading
+from flask import request, g
+
+logger = logging.getLogger(__name__)
+
+# Latency buckets in seconds: HTTP handlers return quickly, model calls can take minutes
+HTTP_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+MODEL_BUCKETS = (0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600)
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _format_labels(labelnames, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+class Metric:
+    """Base class for a named metric with a fixed set of label names"""
+
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self):
+        """List of (suffix, label values, extra label, value) to render"""
+        with self.lock:
+            return [('', key, None, value) for key, value in self.values.items()]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, key, extra, value in self.samples():
+            lines.append(f"{self.name}{suffix}{_format_labels(self.labelnames, key, extra)} {_format_value(value)}")
+        return '\n'.join(lines)
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self.functions = {}
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def set_function(self, function, **labels):
+        """Read the value from `function` at scrape time (e.g. the size of an in-memory store)"""
+        key = self._key(labels)
+        with self.lock:
+            self.functions[key] = function
+
+    def samples(self):
+        samples = super().samples()
+        with self.lock:
+            functions = list(self.functions.items())
+        for key, function in functions:
+            try:
+                samples.append(('', key, None, function()))
+            except Exception as e:
+                logger.warning(f"Could not read gauge {self.name}{key}: {e}")
+        return samples
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=HTTP_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is None:
+                # Per-bucket counts (the last is +Inf), then sum
+                entry = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def samples(self):
+        with self.lock:
+            values = [(key, list(counts), total) for key, (counts, total) in self.values.items()]
+        samples = []
+        for key, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                samples.append(('_bucket', key, f'le="{_format_value(float(bound))}"', cumulative))
+            samples.append(('_sum', key, None, total))
+            samples.append(('_count', key, None, cumulative))
+        return samples
+
+class MetricsRegistry:
+    """All metrics of the process, rendered together"""
+
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        with self.lock:
+            if metric.name in self.metrics:
+                raise ValueError(f"Metric {metric.name} is already registered")
+            self.metrics[metric.name] = metric
+        return metric
+
+    def render(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return '\n'.join(metric.render() for metric in metrics) + '\n'
+
+# Shared registry for this process
+registry = MetricsRegistry()
+
+def counter(name, documentation, labelnames=()):
+    return registry.register(Counter(name, documentation, labelnames))
+
+def gauge(name, documentation, labelnames=()):
+    return registry.register(Gauge(name, documentation, labelnames))
+
+def histogram(name, documentation, labelnames=(), buckets=HTTP_BUCKETS):
+    return registry.register(Histogram(name, documentation, labelnames, buckets))
+
+HTTP_REQUESTS = counter('studylm_http_requests_total', 'HTTP requests handled', ('route', 'method', 'status'))
+HTTP_LATENCY = histogram(
+    'studylm_http_request_duration_seconds',
+    'Time to produce an HTTP response (streamed bodies are timed to their first byte)',
+    ('route', 'method')
+)
+MODEL_CALLS = counter('studylm_model_calls_total', 'Model calls by outcome', ('model', 'kind', 'outcome'))
+MODEL_LATENCY = histogram(
+    'studylm_model_call_duration_seconds',
+    'Model call latency including rate limit waits and retries (streams are timed to the first chunk)',
+    ('model', 'kind'), buckets=MODEL_BUCKETS
+)
+MODEL_TOKENS = counter('studylm_model_tokens_total', 'Tokens reported by model responses', ('model', 'direction'))
+MODEL_ERRORS = counter('studylm_model_errors_total', 'Failed model calls by error type', ('model', 'error'))
+MODEL_RETRIES = counter('studylm_model_retries_total', 'Model call retries by reason', ('model', 'reason'))
+MODEL_QUEUE_WAIT = histogram(
+    'studylm_model_queue_wait_seconds', 'Time model calls waited for a rate limit slot',
+    ('model',), buckets=MODEL_BUCKETS
+)
+MODEL_ROUTES = counter(
+    'studylm_model_routes_total', 'Models chosen for generation tasks and why', ('task', 'model', 'reason')
+)
+CHAT_HEDGES = counter(
+    'studylm_chat_hedges_total', 'Chat turns by hedging outcome (not_hedged, throttled_skipped, queued_skipped, primary_won, hedge_won, failed, failed_hedged)',
+    ('model', 'outcome')
+)
+COALESCED_REQUESTS = counter(
+    'studylm_coalesced_requests_total', 'Requests that joined an identical generation already in flight', ('kind',)
+)
+CACHE_REQUESTS = counter('studylm_cache_requests_total', 'In-process cache lookups', ('cache', 'result'))
+STORE_SIZE = gauge('studylm_store_entries', 'Entries held in in-memory stores', ('store',))
+THREADS = gauge('studylm_threads', 'Live Python threads')
+THREADS.set_function(threading.active_count)
+
+def record_cache(cache, hit):
+    """Count one lookup of an in-process cache"""
+    CACHE_REQUESTS.inc(cache=cache, result='hit' if hit else 'miss')
+
+def init_app(app):
+    """Time and count every request handled by the app's blueprints"""
+
+    @app.before_request
+    def start_timer():
+        g.metrics_started = time.perf_counter()
+
+    @app.after_request
+    def record_request(response):
+        started = g.pop('metrics_started', None)
+        if started is not None:
+            route = request.url_rule.rule if request.url_rule else 'unmatched'
+            HTTP_LATENCY.observe(time.perf_counter() - started, route=route, method=request.method)
+            HTTP_REQUESTS.inc(route=route, method=request.method, status=response.status_code)
+        return response
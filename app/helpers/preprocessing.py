@@ -0,0 +1,234 @@
+"""
+Upload preprocessing for StudyLM
+This module turns uploaded study files into compact page-marked text before
+they are sent to Gemini, so the model does not re-parse raw PDF and DOCX
+files (and their page furniture) on every call.
+
+Files with too little extractable text, such as scanned or image-heavy PDFs,
+are left for the model to read from the original.
+"""
+
+import os
+import re
+import hashlib
+import logging
+import multiprocessing
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+import model_config
+from app.helpers.text_extraction import extract_pages, normalize_whitespace
+
+logger = logging.getLogger(__name__)
+
+# Header/footer lines are looked for among this many lines at each end of a page
+_EDGE_LINES = 2
+# Running headers and footers are short; longer repeated lines are content
+_MAX_FURNITURE_CHARS = 80
+_PAGE_NUMBER = re.compile(r'^(page\s*)?\d+(\s*(of|/)\s*\d+)?$', re.IGNORECASE)
+
+def extract_all_pages(file_paths, max_workers=None):
+    """
+    Extract page texts from several files in parallel worker processes
+
+    Args:
+        file_paths (list): Paths of the uploaded files
+        max_workers (int, optional): Maximum worker processes
+
+    Returns:
+        dict: Page text lists keyed by file path
+    """
+    max_workers = min(max_workers or model_config.PREPROCESS_MAX_WORKERS, len(file_paths))
+    if max_workers <= 1:
+        return {path: extract_pages(path) for path in file_paths}
+
+    try:
+        # Spawned workers avoid forking a process that is running request threads
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=max_workers, mp_context=context) as executor:
+            return dict(zip(file_paths, executor.map(extract_pages, file_paths)))
+    except Exception as e:
+        logger.warning(f"Parallel text extraction failed ({e}); extracting sequentially")
+        return {path: extract_pages(path) for path in file_paths}
+
+def _furniture_key(line):
+    """Normalize a header/footer line so running page numbers still match"""
+    return re.sub(r'\d+', '#', line.strip().lower())
+
+def strip_boilerplate(pages):
+    """
+    Remove running headers, footers and page numbers from a document's pages
+
+    A line near the top or bottom of a page is treated as furniture when the
+    same line (ignoring digits) appears at the page edges of enough pages.
+
+    Args:
+        pages (list): Page texts of one document
+
+    Returns:
+        list: Cleaned page texts
+    """
+    page_lines = [[line for line in page.splitlines() if line.strip()] for page in pages]
+
+    counts = Counter()
+    for lines in page_lines:
+        edges = lines[:_EDGE_LINES] + lines[-_EDGE_LINES:]
+        counts.update({_furniture_key(line) for line in edges if len(line.strip()) <= _MAX_FURNITURE_CHARS})
+
+    min_pages = max(model_config.BOILERPLATE_MIN_PAGES, model_config.BOILERPLATE_PAGE_FRACTION * len(pages))
+    furniture = {key for key, count in counts.items() if count >= min_pages}
+
+    cleaned = []
+    for lines in page_lines:
+        edge_indexes = set(range(min(_EDGE_LINES, len(lines)))) | set(range(max(0, len(lines) - _EDGE_LINES), len(lines)))
+        kept = [
+            line for i, line in enumerate(lines)
+            if not (i in edge_indexes and (_furniture_key(line) in furniture or _PAGE_NUMBER.match(line.strip())))
+        ]
+        cleaned.append(normalize_whitespace('\n'.join(kept)))
+    return cleaned
+
+def shingles(text, size=None):
+    """Hashed word n-grams of a text, ignoring case, punctuation and spacing"""
+    size = size or model_config.DEDUP_SHINGLE_WORDS
+    words = re.findall(r'\w+', text.lower())
+    if len(words) < size:
+        grams = [' '.join(words)] if words else []
+    else:
+        grams = [' '.join(words[i:i + size]) for i in range(len(words) - size + 1)]
+    return {int.from_bytes(hashlib.blake2b(g.encode('utf-8'), digest_size=8).digest(), 'little') for g in grams}
+
+def minhash_signature(shingle_set, size=None):
+    """
+    MinHash signature of a shingle set using one-permutation hashing
+
+    Each shingle hash is assigned to one of `size` bins and each bin keeps its
+    minimum, which costs a single pass instead of one pass per permutation.
+    Empty bins borrow the next non-empty bin's value so signatures stay
+    comparable slot by slot.
+
+    Returns:
+        tuple: The signature, or None for an empty set
+    """
+    if not shingle_set:
+        return None
+    size = size or model_config.DEDUP_SIGNATURE_SIZE
+    bins = [None] * size
+    for h in shingle_set:
+        index, value = h % size, h // size
+        current = bins[index]
+        if current is None or value < current:
+            bins[index] = value
+
+    signature = []
+    for i in range(size):
+        offset = 0
+        while bins[(i + offset) % size] is None:
+            offset += 1
+        signature.append((bins[(i + offset) % size], offset))
+    return tuple(signature)
+
+def estimate_similarity(signature, other):
+    """Estimated Jaccard similarity of the shingle sets behind two signatures"""
+    return sum(x == y for x, y in zip(signature, other)) / len(signature)
+
+def _label(path, page_number=None):
+    name = os.path.basename(path)
+    return name if page_number is None else f"{name} p.{page_number}"
+
+def dedupe_documents(pages_by_file, threshold=None):
+    """
+    Drop near-duplicate documents and pages, keeping one canonical copy of each
+
+    Whole documents are compared first; of a cluster of near-identical
+    documents (e.g. several versions of the same notes) the longest is kept.
+    Pages of the remaining documents are then matched with MinHash LSH so a
+    page repeated anywhere is kept only the first time it appears.
+
+    Args:
+        pages_by_file (dict): Page text lists keyed by file path, in upload order
+        threshold (float, optional): Estimated Jaccard similarity at which two
+                                     documents or pages count as duplicates
+
+    Returns:
+        tuple: (dict of (page_number, text) lists keyed by file path,
+                list of report entries describing what was dropped)
+    """
+    threshold = threshold or model_config.DEDUP_SIMILARITY_THRESHOLD
+    report = []
+
+    page_shingles = {path: [shingles(text) for text in pages] for path, pages in pages_by_file.items()}
+
+    # Documents, longest first so the most complete version becomes canonical
+    canonical = []
+    by_length = sorted(pages_by_file, key=lambda path: sum(len(p) for p in pages_by_file[path]), reverse=True)
+    kept_paths = set()
+    for path in by_length:
+        signature = minhash_signature(set().union(*page_shingles[path]))
+        match = None
+        if signature is not None:
+            for other_path, other_signature in canonical:
+                similarity = estimate_similarity(signature, other_signature)
+                if similarity >= threshold:
+                    match = (other_path, similarity)
+                    break
+        if match:
+            report.append({
+                'type': 'document',
+                'dropped': _label(path),
+                'duplicate_of': _label(match[0]),
+                'similarity': round(match[1], 3)
+            })
+            continue
+        if signature is not None:
+            canonical.append((path, signature))
+        kept_paths.add(path)
+
+    # Pages, bucketed by signature bands so only likely matches are compared
+    rows = model_config.DEDUP_LSH_ROWS
+    buckets = {}
+    result = {}
+    for path, pages in pages_by_file.items():
+        if path not in kept_paths:
+            result[path] = []
+            continue
+        kept = []
+        for page_number, (text, shingle_set) in enumerate(zip(pages, page_shingles[path]), start=1):
+            signature = minhash_signature(shingle_set)
+            if signature is None:
+                continue
+
+            bands = [(i, signature[i:i + rows]) for i in range(0, len(signature), rows)]
+            match = None
+            for band in bands:
+                for other_signature, other_label in buckets.get(band, ()):
+                    similarity = estimate_similarity(signature, other_signature)
+                    if similarity >= threshold and (match is None or similarity > match[1]):
+                        match = (other_label, similarity)
+            if match:
+                report.append({
+                    'type': 'page',
+                    'dropped': _label(path, page_number),
+                    'duplicate_of': match[0],
+                    'similarity': round(match[1], 3)
+                })
+                continue
+
+            entry = (signature, _label(path, page_number))
+            for band in bands:
+                buckets.setdefault(band, []).append(entry)
+            kept.append((page_number, text))
+        result[path] = kept
+    return result, report
+
+def is_text_rich(pages):
+    """Whether a document has enough extractable text to be sent as text alone"""
+    if not pages:
+        return False
+    characters = sum(len(page) for page in pages)
+    return characters / len(pages) >= model_config.PREPROCESS_MIN_CHARS_PER_PAGE
+
+def format_compact_text(source_name, numbered_pages):
+    """Render kept pages as plain text with page markers the model can cite"""
+    blocks = [f"Source: {source_name}"]
+    blocks.extend(f"[Page {page_number}]\n{text}" for page_number, text in numbered_pages)
+    return '\n\n'.join(blocks) + '\n'
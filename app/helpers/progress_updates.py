@@ -7,10 +7,15 @@ during long-running operations like study guide generation.
 import time
 from threading import Lock
 from collections import deque
+from app.helpers.metrics import STORE_SIZE
 
 # Store progress updates in a thread-safe way
 _progress_data = {}
 _progress_lock = Lock()
+STORE_SIZE.set_function(lambda: len(_progress_data), store='progress_operations')
+
+# Operation IDs that report the progress of another operation (coalesced requests)
+_aliases = {}
 
 # Maximum number of messages to keep per operation
 MAX_MESSAGES = 50
@@ -49,9 +54,16 @@ def add_progress_message(operation_id, message, status=None, progress=None):
         # Update last update time
         _progress_data[operation_id]['last_update'] = timestamp
 
+def alias_progress(operation_id, target_id):
+    """Report the progress of target_id under operation_id from now on"""
+    with _progress_lock:
+        _progress_data.pop(operation_id, None)
+        _aliases[operation_id] = target_id
+
 def get_progress(operation_id):
     """Get progress data for a specific operation"""
     with _progress_lock:
+        operation_id = _aliases.get(operation_id, operation_id)
         if operation_id not in _progress_data:
             return None
         
@@ -63,6 +75,7 @@ def get_progress(operation_id):
 def clear_progress(operation_id):
     """Clear progress data for a specific operation"""
     with _progress_lock:
+        _aliases.pop(operation_id, None)
         if operation_id in _progress_data:
             del _progress_data[operation_id]
 
@@ -76,4 +89,8 @@ def cleanup_old_progress(max_age=3600):
                 to_remove.append(op_id)
         
         for op_id in to_remove:
-            del _progress_data[op_id]
\ No newline at end of file
+            del _progress_data[op_id]
+        
+        for alias, op_id in list(_aliases.items()):
+            if op_id not in _progress_data:
+                del _aliases[alias]
\ No newline at end of file
@@ -0,0 +1,81 @@
+"""
+Single-flight coalescing of identical generations for StudyLM
+When a request arrives for a study guide or quiz that is already being
+generated for the same materials and parameters (another user, a second
+tab or a client retry), it joins the running generation instead of starting
+another thread and another round of model calls, and receives its result.
+
+Requests are matched by a fingerprint of their inputs. A flight is closed
+to new members when its generation finishes, so later identical requests
+start a fresh generation.
+"""
+
+import json
+import hashlib
+import threading
+from app.helpers.metrics import COALESCED_REQUESTS, STORE_SIZE
+
+# In-flight generations keyed by request fingerprint
+_flights = {}
+_flights_lock = threading.Lock()
+STORE_SIZE.set_function(lambda: len(_flights), store='in_flight_generations')
+
+def fingerprint(kind, **params):
+    """
+    Get the coalescing key of a request
+
+    Args:
+        kind (str): Kind of generation, e.g. 'study_guide' or 'quiz'
+        **params: Everything the result depends on (materials, counts, model)
+
+    Returns:
+        str: The kind followed by a digest of the parameters
+    """
+    payload = json.dumps(params, sort_keys=True, default=str)
+    return f"{kind}:{hashlib.sha256(payload.encode('utf-8')).hexdigest()}"
+
+class Flight:
+    """A running generation and the operation IDs of every request that shares it"""
+
+    def __init__(self, key, leader_id):
+        self.key = key
+        self.leader_id = leader_id
+        self.operation_ids = [leader_id]
+
+    def members(self):
+        """Operation IDs of the leader and every request that joined so far"""
+        with _flights_lock:
+            return list(self.operation_ids)
+
+def join(key, operation_id):
+    """
+    Join the in-flight generation for a fingerprint, or register a new one
+
+    Args:
+        key (str): Request fingerprint
+        operation_id (str): ID the caller reports progress and results under
+
+    Returns:
+        tuple: (flight, joined) where joined is False if the caller leads the
+               flight and must run the generation (and call finish afterwards)
+    """
+    with _flights_lock:
+        flight = _flights.get(key)
+        if flight is None:
+            flight = _flights[key] = Flight(key, operation_id)
+            return flight, False
+        flight.operation_ids.append(operation_id)
+    COALESCED_REQUESTS.inc(kind=key.split(':', 1)[0])
+    return flight, True
+
+def finish(flight):
+    """
+    Close a flight to new members
+
+    Returns:
+        list: Operation IDs of every request that shares the flight's result
+    """
+    with _flights_lock:
+        if _flights.get(flight.key) is flight:
+            del _flights[flight.key]
+        return list(flight.operation_ids)
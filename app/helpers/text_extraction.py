@@ -0,0 +1,89 @@
+"""
+Local text extraction for StudyLM
+This module extracts plain text, page by page, from the PDF, DOCX and TXT
+files users upload so it can be indexed before the local copies are deleted.
+"""
+
+import os
+import re
+import zipfile
+import logging
+from xml.etree import ElementTree
+
+logger = logging.getLogger(__name__)
+
+# WordprocessingML namespace used in word/document.xml
+_WORD_NS = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+
+def extract_pages(file_path):
+    """
+    Extract text from a study file, one string per page
+
+    Args:
+        file_path: Path to a PDF, DOCX or TXT file
+
+    Returns:
+        list: Page texts. DOCX and TXT files without explicit page breaks
+              are returned as a single page. Unsupported or unreadable files
+              return an empty list.
+    """
+    extension = os.path.splitext(file_path)[1].lower()
+    try:
+        if extension == '.pdf':
+            return _extract_pdf_pages(file_path)
+        if extension == '.docx':
+            return _extract_docx_pages(file_path)
+        if extension in ('.txt', '.md'):
+            return _extract_txt_pages(file_path)
+    except Exception as e:
+        logger.error(f"Error extracting text from {file_path}: {e}")
+        return []
+
+    logger.warning(f"No text extractor for file type '{extension}': {file_path}")
+    return []
+
+def _extract_pdf_pages(file_path):
+    """Extract text from each page of a PDF using pypdf, if installed"""
+    try:
+        from pypdf import PdfReader
+    except ImportError:
+        logger.warning("pypdf is not installed; skipping PDF text extraction. Install it with 'pip3 install pypdf'.")
+        return []
+
+    reader = PdfReader(file_path)
+    return [page.extract_text() or '' for page in reader.pages]
+
+def _extract_docx_pages(file_path):
+    """Extract paragraph text from a DOCX file, splitting on explicit page breaks"""
+    with zipfile.ZipFile(file_path) as docx:
+        root = ElementTree.fromstring(docx.read('word/document.xml'))
+
+    pages = []
+    paragraphs = []
+    for paragraph in root.iter(f'{_WORD_NS}p'):
+        runs = []
+        for node in paragraph.iter():
+            if node.tag == f'{_WORD_NS}t' and node.text:
+                runs.append(node.text)
+            elif node.tag == f'{_WORD_NS}tab':
+                runs.append('\t')
+            elif node.tag == f'{_WORD_NS}br' and node.get(f'{_WORD_NS}type') == 'page':
+                paragraphs.append(''.join(runs))
+                pages.append('\n'.join(paragraphs))
+                paragraphs, runs = [], []
+        paragraphs.append(''.join(runs))
+
+    pages.append('\n'.join(paragraphs))
+    return pages
+
+def _extract_txt_pages(file_path):
+    """Read a text file, treating form feeds as page breaks"""
+    with open(file_path, 'r', encoding='utf-8', errors='replace') as f:
+        text = f.read()
+    return text.split('\f')
+
+def normalize_whitespace(text):
+    """Collapse runs of spaces and blank lines left behind by extraction"""
+    text = re.sub(r'[ \t]+', ' ', text)
+    text = re.sub(r'\n\s*\n+', '\n\n', text)
+    return text.strip()
@@ -0,0 +1,112 @@
+"""
+Local token estimation for StudyLM
+This module provides cheap, offline token estimates so hot paths do not
+need a remote count_tokens round trip just to size their inputs.
+
+Exact counts reported by the API are cached per file digest and used to
+calibrate the per-file-type estimates over time.
+"""
+
+import os
+import json
+from threading import Lock
+import model_config
+from app.helpers.atomic_io import atomic_write_json
+from app.helpers.metrics import record_cache
+
+# Average number of characters per token for English prose with Gemini models
+CHARS_PER_TOKEN = 4
+
+# Starting tokens-per-byte ratios by MIME type, refined by calibrate()
+DEFAULT_TOKENS_PER_BYTE = {
+    'application/pdf': 0.01,
+    'application/vnd.openxmlformats-officedocument.wordprocessingml.document': 0.08,
+    'text/plain': 0.25,
+    'text/markdown': 0.25,
+}
+FALLBACK_TOKENS_PER_BYTE = 0.05
+
+# Weight of a new observation when updating a calibrated ratio
+CALIBRATION_WEIGHT = 0.3
+
+_cache = None
+_cache_lock = Lock()
+
+def estimate_text_tokens(text):
+    """Estimate the number of tokens in a piece of text"""
+    if not text:
+        return 0
+    return max(1, len(text) // CHARS_PER_TOKEN)
+
+def file_digest(file_ref):
+    """Get a stable content digest for a Gemini file reference"""
+    digest = getattr(file_ref, 'sha256_hash', None)
+    if isinstance(digest, bytes):
+        digest = digest.hex()
+    return digest or getattr(file_ref, 'name', None) or getattr(file_ref, 'uri', None)
+
+def _load_cache():
+    """Load the token cache from disk once per process (caller holds the lock)"""
+    global _cache
+    if _cache is None:
+        _cache = {'files': {}, 'ratios': {}}
+        if os.path.exists(model_config.TOKEN_CACHE_FILE):
+            try:
+                with open(model_config.TOKEN_CACHE_FILE, 'r') as f:
+                    _cache.update(json.load(f))
+            except (OSError, ValueError):
+                pass
+    return _cache
+
+def _save_cache():
+    """Persist the token cache (caller holds the lock)"""
+    atomic_write_json(_cache, model_config.TOKEN_CACHE_FILE)
+
+def get_cached_file_tokens(file_ref):
+    """Return the exact token count for a file if it has been counted before"""
+    with _cache_lock:
+        tokens = _load_cache()['files'].get(file_digest(file_ref))
+    record_cache('file_tokens', tokens is not None)
+    return tokens
+
+def estimate_file_tokens(file_ref):
+    """Estimate the tokens a file contributes, preferring a cached exact count"""
+    cached = get_cached_file_tokens(file_ref)
+    if cached is not None:
+        return cached
+
+    mime_type = getattr(file_ref, 'mime_type', None)
+    size_bytes = getattr(file_ref, 'size_bytes', 0) or 0
+    with _cache_lock:
+        ratio = _load_cache()['ratios'].get(mime_type)
+    if ratio is None:
+        ratio = DEFAULT_TOKENS_PER_BYTE.get(mime_type, FALLBACK_TOKENS_PER_BYTE)
+    return int(size_bytes * ratio)
+
+def estimate_input_tokens(input_list):
+    """Estimate the tokens of a list of text parts and file references"""
+    if isinstance(input_list, str):
+        return estimate_text_tokens(input_list)
+    return sum(
+        estimate_text_tokens(part) if isinstance(part, str) else estimate_file_tokens(part)
+        for part in input_list
+    )
+
+def record_file_tokens(file_ref, tokens):
+    """Cache an exact token count for a file and calibrate its file type's ratio"""
+    mime_type = getattr(file_ref, 'mime_type', None)
+    size_bytes = getattr(file_ref, 'size_bytes', 0) or 0
+
+    with _cache_lock:
+        cache = _load_cache()
+        cache['files'][file_digest(file_ref)] = tokens
+
+        if mime_type and size_bytes:
+            observed = tokens / size_bytes
+            previous = cache['ratios'].get(mime_type)
+            if previous is None:
+                cache['ratios'][mime_type] = observed
+            else:
+                cache['ratios'][mime_type] = previous + CALIBRATION_WEIGHT * (observed - previous)
+
+        _save_cache()
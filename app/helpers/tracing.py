@@ -0,0 +1,271 @@
+"""
+Per-operation tracing for StudyLM
+This module records timed spans for long-running operations such as study
+guide and quiz generation, so slow runs can be broken down into uploads,
+structure calls, quizzes, validation and retries rather than read from
+free-text progress messages.
+
+A trace is started for an operation ID and spans opened anywhere below it
+(including on worker threads started with `propagate`) are attached to it.
+Outside a trace, `span` is a cheap no-op.
+"""
+
+import os
+import time
+import itertools
+import threading
+import contextvars
+from collections import OrderedDict
+from contextlib import contextmanager
+import model_config
+from app.helpers.atomic_io import atomic_write_json
+from app.helpers.metrics import STORE_SIZE
+
+# Traces keyed by operation ID, oldest first
+_traces = OrderedDict()
+_traces_lock = threading.Lock()
+STORE_SIZE.set_function(lambda: len(_traces), store='traces')
+
+_current_span = contextvars.ContextVar('current_span', default=None)
+_span_ids = itertools.count(1)
+
+class Span:
+    """One timed step of a trace; attributes can be set while it is open"""
+
+    def __init__(self, trace, name, parent_id, attributes):
+        self.trace = trace
+        self.name = name
+        self.span_id = next(_span_ids)
+        self.parent_id = parent_id
+        self.attributes = attributes
+        self.thread = threading.current_thread().name
+        self.thread_id = threading.get_ident()
+        self.start = time.time()
+        self._started = time.perf_counter()
+        self.duration = None
+
+    def set(self, **attributes):
+        """Set attributes on the span"""
+        self.attributes.update(attributes)
+
+    def add(self, name, amount):
+        """Add to a numeric attribute, e.g. retries or seconds waited"""
+        self.attributes[name] = self.attributes.get(name, 0) + amount
+
+    def finish(self):
+        self.duration = time.perf_counter() - self._started
+
+    def to_dict(self):
+        return {
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'thread': self.thread,
+            'thread_id': self.thread_id,
+            'start': self.start,
+            'duration': self.duration,
+            'attributes': dict(self.attributes)
+        }
+
+class _NoopSpan:
+    """Stand-in used when no trace is active"""
+
+    def set(self, **attributes):
+        pass
+
+    def add(self, name, amount):
+        pass
+
+_NOOP_SPAN = _NoopSpan()
+
+def current_span():
+    """Get the innermost open span of the current trace, or a no-op span"""
+    return _current_span.get() or _NOOP_SPAN
+
+@contextmanager
+def span(name, **attributes):
+    """
+    Time a block of work as a child of the current span
+
+    Args:
+        name (str): Span name, e.g. 'model_call' or 'section_quiz'
+        **attributes: Initial attributes such as model or unit
+
+    Yields:
+        The span, whose attributes can be updated before it ends
+    """
+    parent = _current_span.get()
+    if parent is None:
+        yield _NOOP_SPAN
+        return
+
+    child = Span(parent.trace, name, parent.span_id, attributes)
+    token = _current_span.set(child)
+    try:
+        yield child
+    except Exception as e:
+        child.set(error=f"{type(e).__name__}: {e}")
+        raise
+    finally:
+        _current_span.reset(token)
+        child.finish()
+        _record(child)
+
+@contextmanager
+def start_trace(operation_id, name, **attributes):
+    """
+    Start tracing an operation; its root span covers the block
+
+    The finished trace is also written to TRACE_FOLDER as a Chrome trace file.
+
+    Args:
+        operation_id (str): ID the trace is stored under (the progress operation ID)
+        name (str): Root span name
+        **attributes: Root span attributes
+    """
+    if not model_config.TRACING_ENABLED:
+        yield _NOOP_SPAN
+        return
+
+    trace = {
+        'operation_id': operation_id,
+        'name': name,
+        'started': time.time(),
+        'spans': [],
+        'dropped_spans': 0
+    }
+    with _traces_lock:
+        _traces[operation_id] = trace
+        while len(_traces) > model_config.TRACE_MAX_OPERATIONS:
+            _traces.popitem(last=False)
+
+    root = Span(trace, name, None, attributes)
+    token = _current_span.set(root)
+    try:
+        yield root
+    except Exception as e:
+        root.set(error=f"{type(e).__name__}: {e}")
+        raise
+    finally:
+        _current_span.reset(token)
+        root.finish()
+        _record(root)
+        try:
+            save_trace(operation_id)
+        except OSError:
+            pass
+
+def _record(finished):
+    with _traces_lock:
+        spans = finished.trace['spans']
+        if len(spans) < model_config.TRACE_MAX_SPANS:
+            spans.append(finished.to_dict())
+        else:
+            finished.trace['dropped_spans'] += 1
+
+def propagate(fn):
+    """
+    Wrap a function so it runs inside the caller's trace context
+
+    Threads and executor workers start with an empty context; wrap their
+    target with this so their spans nest under the span that started them.
+    """
+    context = contextvars.copy_context()
+
+    def run(*args, **kwargs):
+        return context.copy().run(fn, *args, **kwargs)
+    return run
+
+def summarize_spans(spans):
+    """
+    Break a trace down by span name and by model
+
+    Returns:
+        dict: Per-name totals and per-model call counts, tokens, retries and queue wait
+    """
+    by_name = {}
+    by_model = {}
+    for entry in spans:
+        duration = entry['duration'] or 0
+        totals = by_name.setdefault(entry['name'], {'count': 0, 'seconds': 0.0})
+        totals['count'] += 1
+        totals['seconds'] = round(totals['seconds'] + duration, 3)
+
+        attributes = entry['attributes']
+        if 'model' not in attributes:
+            continue
+        model = by_model.setdefault(attributes['model'], {
+            'calls': 0, 'seconds': 0.0, 'input_tokens': 0, 'output_tokens': 0,
+            'retries': 0, 'queue_wait_seconds': 0.0, 'errors': 0, 'cost': 0.0
+        })
+        model['calls'] += 1
+        model['seconds'] = round(model['seconds'] + duration, 3)
+        model['input_tokens'] += attributes.get('input_tokens') or 0
+        model['output_tokens'] += attributes.get('output_tokens') or 0
+        model['retries'] += attributes.get('retries', 0)
+        model['queue_wait_seconds'] = round(model['queue_wait_seconds'] + attributes.get('queue_wait', 0), 3)
+        model['errors'] += int('error' in attributes)
+        model['cost'] = round(model['cost'] + attributes.get('cost', 0), 6)
+    return {'by_name': by_name, 'by_model': by_model}
+
+def get_trace(operation_id):
+    """
+    Get the spans recorded so far for an operation, with a latency breakdown
+
+    Returns:
+        dict: The trace, or None if it is not in memory
+    """
+    with _traces_lock:
+        trace = _traces.get(operation_id)
+        if trace is None:
+            return None
+        result = dict(trace, spans=sorted(trace['spans'], key=lambda entry: entry['start']))
+    result['summary'] = summarize_spans(result['spans'])
+    return result
+
+def to_chrome_trace(trace):
+    """
+    Convert a trace to the Chrome trace event format
+
+    The result loads in chrome://tracing or Perfetto, with one row per thread.
+    """
+    events = []
+    threads = {}
+    for entry in trace['spans']:
+        threads.setdefault(entry['thread_id'], entry['thread'])
+        events.append({
+            'name': entry['name'],
+            'cat': trace['name'],
+            'ph': 'X',
+            'ts': round((entry['start'] - trace['started']) * 1e6),
+            'dur': round((entry['duration'] or 0) * 1e6),
+            'pid': 1,
+            'tid': entry['thread_id'],
+            'args': entry['attributes']
+        })
+    for thread_id, thread_name in threads.items():
+        events.append({'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': thread_id, 'args': {'name': thread_name}})
+    return {
+        'traceEvents': events,
+        'displayTimeUnit': 'ms',
+        'otherData': {'operation_id': trace['operation_id'], 'started': trace['started']}
+    }
+
+def get_trace_path(operation_id):
+    """Get the path of an operation's exported Chrome trace file"""
+    return os.path.join(model_config.TRACE_FOLDER, f"{operation_id}.trace.json")
+
+def save_trace(operation_id):
+    """
+    Write an operation's trace to TRACE_FOLDER in Chrome trace format
+
+    Returns:
+        str: The file path, or None if the trace is not in memory
+    """
+    trace = get_trace(operation_id)
+    if trace is None:
+        return None
+    os.makedirs(model_config.TRACE_FOLDER, exist_ok=True)
+    path = get_trace_path(operation_id)
+    atomic_write_json(to_chrome_trace(trace), path)
+    return path
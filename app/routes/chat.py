@@ -1,5 +1,6 @@
 import os
 import json
+import logging
 import uuid
 import threading
 import time
@@ -9,6 +10,12 @@ from flask import Blueprint, render_template, request, jsonify, session, Respons
 import model_config
 from app.services.gemini_service import GeminiService
 from app.services.file_service import FileService
+from app.services.retrieval_service import RetrievalService
+from app.services.chat_hedging import ChatHedging
+from app.services.usage_service import usage_scope
+from app.helpers.chat_history import ChatHistory
+from app.helpers.token_estimator import estimate_input_tokens
+from app.helpers.metrics import STORE_SIZE
 
 # Create the blueprint
 chat_bp = Blueprint('chat', __name__)
@@ -19,6 +26,9 @@ active_chats = {}
 # Dictionary to store message queues for streaming (maps chat_id to a queue)
 message_queues = {}
 
+STORE_SIZE.set_function(lambda: len(active_chats), store='chat_sessions')
+STORE_SIZE.set_function(lambda: len(message_queues), store='chat_message_queues')
+
 @chat_bp.route('/chat')
 def chat():
     # Check if we have uploaded files
@@ -45,6 +55,11 @@ def new_chat():
     
     return jsonify({'success': True})
 
+@chat_bp.route('/chat-hedging', methods=['GET'])
+def chat_hedging():
+    """Get the hedge rate, hedge win rate and current hedge delay of each chat model"""
+    return jsonify(ChatHedging.get_stats())
+
 @chat_bp.route('/send-chat', methods=['POST', 'GET'])
 def send_chat():
     # Access logger from the current application
@@ -76,12 +91,15 @@ def send_chat():
             # Continue streaming from the queue until we get a done message
             queue = message_queues[chat_id]
             done = False
+            # Checked once per stream so per-message logging costs nothing when disabled
+            debug = logger.isEnabledFor(logging.DEBUG)
             
             while not done:
                 try:
                     # Try to get a message from the queue with a timeout
                     message = queue.get(timeout=180)  # 180 second timeout
-                    logger.debug(f"Got message from queue for chat_id {chat_id}: {str(message)[:100]}...")
+                    if debug:
+                        logger.debug(f"Got message from queue for chat_id {chat_id}: {str(message)[:100]}...")
                     
                     # Check if this is a done message
                     if isinstance(message, dict) and message.get('done'):
@@ -114,7 +132,8 @@ def send_chat():
         
         # Get the user's message from the request
         data = request.json
-        logger.debug(f"Request data: {data}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Request data: {data}")
         
         user_message = data.get('message', '')
         model_name = data.get('model', model_config.DEFAULT_CHAT_MODEL)
@@ -152,105 +171,110 @@ def send_chat():
         # Use the system instruction from model_config
         system_instruction = model_config.CHAT_SYSTEM_PROMPT
         
-        # Get or create a chat session
+        # Get or create the history for this chat
         if chat_id not in active_chats:
-            logger.debug(f"Creating new chat session for ID: {chat_id}")
-            
-            # Use our GeminiService to create a chat session
-            chat = GeminiService.start_chat_session(model_name, system_instruction)
-            
-            # Store the chat and the model choice in our dictionary
+            logger.debug(f"Creating new chat history for ID: {chat_id}")
             active_chats[chat_id] = {
-                "chat": chat,
-                "model": model_name,
-                "first_message": True
+                "history": ChatHistory(),
+                "model": model_name
             }
         else:
-            logger.debug(f"Using existing chat session for ID: {chat_id}")
-            # Check if model has changed
+            logger.debug(f"Using existing chat history for ID: {chat_id}")
+            # The windowed history is rebuilt every turn, so switching models
+            # only requires remembering the new choice
             current_model = active_chats[chat_id].get("model", model_config.DEFAULT_CHAT_MODEL)
-            
             if current_model != model_name:
                 logger.debug(f"Model changed from {current_model} to {model_name}")
-                
-                # Use our GeminiService to create a new chat session with the new model
-                chat = GeminiService.start_chat_session(model_name, system_instruction)
-                
-                # Get history from the old chat and apply it to the new chat
-                logger.debug("Transferring chat history to new model")
-                previous_chat_history = active_chats[chat_id]["chat"].history
-                
-                # Flag to track if we need to add file context to the first message
-                needs_context = True
-                
-                for message in previous_chat_history:
-                    if message.role == "user":
-                        if needs_context:
-                            logger.debug("Adding file context with first user message in history")
-                            combined_message = FileService.create_input_with_files(file_refs, additional_text=message.parts[0].text)
-                            chat.send_message(combined_message)
-                            needs_context = False
-                        else:
-                            chat.send_message(message.parts[0].text)
-                
-                # Update chat and model in our dictionary
-                active_chats[chat_id] = {
-                    "chat": chat,
-                    "model": model_name,
-                    "first_message": False
-                }
-            else:
-                # Use the existing chat session
-                chat = active_chats[chat_id]["chat"]
+                active_chats[chat_id]["model"] = model_name
+        
+        history = active_chats[chat_id]["history"]
+        workspace_id = FileService.get_workspace_id()
+        
+        # Get the current app for the worker and background summarization threads
+        app = current_app._get_current_object()
         
         # Always use streaming response
         logger.debug("Using streaming response pattern")
         
         # Define a worker function to process the message in a separate thread
         def process_message_worker():
-            try:
-                # Get the queue for this chat
-                queue = message_queues[chat_id]
+            # Run with an app context so services can log and read config
+            with app.app_context(), usage_scope(operation=chat_id, kind='chat', workspace=workspace_id, stage='chat'):
+                try:
+                    # Get the queue for this chat
+                    queue = message_queues[chat_id]
                 
-                # Check if this is the first message for this chat session
-                is_first_message = active_chats[chat_id].get("first_message", False)
+                    # Rebuild the session from the study files, the rolling summary
+                    # and the recent turns that fit in the token budget
+                    if logger.isEnabledFor(logging.DEBUG):
+                        logger.debug(f"Building chat session from {history.window_tokens()} tokens of recent history")
+                    context_parts = None
+                    if model_config.RETRIEVAL_ENABLED and workspace_id:
+                        passages = RetrievalService.search(workspace_id, user_message)
+                        if passages:
+                            logger.debug(f"Grounding chat turn with {len(passages)} retrieved passages")
+                            context_parts = [RetrievalService.format_passages(passages)]
+                            # Files with no text in the index (scanned or image-only) are still attached in full
+                            indexed_sources = RetrievalService.get_indexed_sources(workspace_id)
+                            unindexed_refs = [ref for ref in file_refs if ref.display_name not in indexed_sources]
+                            if unindexed_refs:
+                                logger.debug(f"Attaching {len(unindexed_refs)} files that have no indexed passages")
+                                context_parts += ['\n\n'] + FileService.create_input_with_files(unindexed_refs)
+                    if context_parts is None:
+                        context_parts = FileService.create_input_with_files(file_refs)
+                    chat_history = history.build_history(context_parts)
+                    
+                    def start_chat(chat_model_name):
+                        return GeminiService.start_chat_session(
+                            chat_model_name,
+                            system_instruction,
+                            history=list(chat_history)
+                        )
+                    
+                    # A slow first chunk is hedged with a duplicate request; stream whichever answers first
+                    reply_model, response_stream, chunks = ChatHedging.send_message(
+                        start_chat,
+                        model_name,
+                        user_message,
+                        estimated_tokens=estimate_input_tokens(context_parts + [user_message]) + history.window_tokens()
+                    )
                 
-                if is_first_message:
-                    # Attach files to the user's message for the first message
-                    logger.debug("First message: attaching files to user's message")
-                    combined_message = FileService.create_input_with_files(file_refs, additional_text=user_message)
-                    response_stream = chat.send_message(combined_message, stream=True)
-                    active_chats[chat_id]["first_message"] = False
-                else:
-                    response_stream = chat.send_message(user_message, stream=True)
+                    # Stream each chunk as it comes in
+                    full_response = ""
+                    chunk_count = 0
+                    debug = logger.isEnabledFor(logging.DEBUG)
                 
-                # Stream each chunk as it comes in
-                full_response = ""
-                chunk_count = 0
+                    for chunk in chunks:
+                        chunk_count += 1
+                        if chunk.text:
+                            full_response += chunk.text
+                            chunk_data = {'chunk': chunk.text, 'full_response': full_response}
+                            if debug:
+                                logger.debug(f"Adding chunk #{chunk_count}: '{chunk.text[:30]}...' (truncated)")
+                            queue.put(chunk_data)
+                            time.sleep(0.01)
                 
-                for chunk in response_stream:
-                    chunk_count += 1
-                    if chunk.text:
-                        full_response += chunk.text
-                        chunk_data = {'chunk': chunk.text, 'full_response': full_response}
-                        logger.debug(f"Adding chunk #{chunk_count}: '{chunk.text[:30]}...' (truncated)")
-                        queue.put(chunk_data)
-                        time.sleep(0.01)
+                    logger.debug(f"Processed {chunk_count} chunks in total")
                 
-                logger.debug(f"Processed {chunk_count} chunks in total")
+                    # Send a completion message to the queue
+                    logger.debug("Adding completion message to queue")
+                    queue.put({'done': True, 'full_response': full_response, 'reply_model': reply_model})
                 
-                # Send a completion message to the queue
-                logger.debug("Adding completion message to queue")
-                queue.put({'done': True, 'full_response': full_response})
+                    # Record the turn and fold any evicted turns into the summary
+                    GeminiService.record_usage(reply_model, response_stream)
+                    usage = getattr(response_stream, 'usage_metadata', None)
+                    model_tokens = getattr(usage, 'candidates_token_count', None) or None
+                    history.add_turn(user_message, full_response, model_tokens=model_tokens)
+                    history.summarize_in_background(app)
                 
-            except Exception as e:
-                error_msg = str(e)
-                logger.error(f"Error in worker thread: {error_msg}")
-                logger.error(traceback.format_exc())
-                queue = message_queues.get(chat_id)
-                if queue:
-                    queue.put({'error': error_msg})
-                    queue.put({'done': True})
+                except Exception as e:
+                    error_msg = str(e)
+                    logger.error(f"Error in worker thread: {error_msg}")
+                    logger.error(traceback.format_exc())
+                    queue = message_queues.get(chat_id)
+                    if queue:
+                        queue.put({'error': error_msg})
+                        queue.put({'done': True})
         
         # Start the processing in a separate thread
         logger.debug("Starting worker thread to process message")
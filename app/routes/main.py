@@ -1,19 +1,28 @@
 import os
 import json
 import uuid
-from flask import Blueprint, render_template, request, jsonify, send_from_directory, current_app
+from flask import Blueprint, render_template, request, jsonify, send_from_directory, current_app, Response
 from werkzeug.utils import secure_filename
 import threading
+import model_config
 from app.services.file_service import FileService
+from app.services.retrieval_service import RetrievalService
 from app.core.study_guide_generator import StudyGuideGenerator
-from app.helpers.json_utils import load_json_from_file
-from app.helpers.progress_updates import init_progress, add_progress_message, get_progress, clear_progress
+from app.core.question_bank import QuestionBank
+from app.services.usage_service import UsageService, usage_scope
+from app.services.model_router import ModelRouter
+from app.helpers.guide_storage import load_study_guide, load_study_guide_unit, load_study_guide_section
+from app.helpers.progress_updates import init_progress, add_progress_message, get_progress, clear_progress, alias_progress
+from app.helpers import single_flight
+from app.helpers.tracing import start_trace, span, current_span, get_trace, to_chrome_trace, get_trace_path
+from app.helpers.metrics import registry, STORE_SIZE
 
 # Create the blueprint
 main_bp = Blueprint('main', __name__)
 
 # Dictionary to track active operations
 active_operations = {}
+STORE_SIZE.set_function(lambda: len(active_operations), store='active_operations')
 
 @main_bp.route('/')
 def index():
@@ -34,7 +43,23 @@ def upload_handler():
     add_progress_message(operation_id, "Processing uploaded files...", status="uploading")
     
     # Save uploaded files using our FileService
+    flight = None
     try:
+        # An identical upload already being processed is shared instead of started again
+        key = single_flight.fingerprint('study_guide', files=sorted(
+            (secure_filename(file.filename), FileService.get_upload_digest(file)) for file in uploaded_files
+        ))
+        flight, joined = single_flight.join(key, operation_id)
+        if joined:
+            current_app.logger.info(f"Upload {operation_id} joined identical upload {flight.leader_id}")
+            alias_progress(operation_id, flight.leader_id)
+            return jsonify({
+                'success': True,
+                'message': 'Processing started',
+                'operation_id': operation_id,
+                'coalesced': True
+            })
+        
         file_paths = []
         for file in uploaded_files:
             filename = secure_filename(file.filename)
@@ -49,7 +74,7 @@ def upload_handler():
         # Start processing in background thread with app context
         thread = threading.Thread(
             target=process_files_in_background,
-            args=(file_paths, operation_id, app)
+            args=(file_paths, operation_id, app, flight)
         )
         thread.daemon = True
         thread.start()
@@ -63,12 +88,20 @@ def upload_handler():
     except Exception as e:
         current_app.logger.error(f"Error handling file upload: {e}")
         add_progress_message(operation_id, f"Error: {str(e)}", status="error")
+        if flight is not None and flight.leader_id == operation_id:
+            single_flight.finish(flight)
         return jsonify({'error': str(e)}), 500
 
-def process_files_in_background(file_paths, operation_id, app):
-    """Process uploaded files in a background thread with progress updates"""
+def process_files_in_background(file_paths, operation_id, app, flight=None):
+    """
+    Process uploaded files in a background thread with progress updates
+    
+    Args:
+        flight (Flight, optional): Single-flight entry of this upload, closed when processing ends
+    """
     # Create an application context for this thread
-    with app.app_context():
+    with app.app_context(), start_trace(operation_id, 'process_upload', files=len(file_paths)), \
+            usage_scope(operation=operation_id, kind='study_guide'):
         try:
             # Always use newly uploaded files by removing any existing file_uris.json
             if os.path.exists('file_uris.json'):
@@ -84,21 +117,69 @@ def process_files_in_background(file_paths, operation_id, app):
                     status="uploading"
                 )
             
-            # Upload the new files to Gemini using our service
-            file_refs = FileService.upload_files_to_gemini(
-                file_paths, 
-                operation_id=operation_id,
-                progress_callback=file_upload_progress
-            )
-            app.logger.info(f"Uploaded {len(file_refs)} files")
-
-            # Cleanup
+            upload_paths, display_names, pages_by_file = file_paths, None, None
             try:
-                for file_path in file_paths:
-                    os.remove(file_path)
-                    app.logger.info(f"Deleted local file: {file_path}")
-            except OSError as e:
-                app.logger.error(f"Error deleting local file {file_path}: {e}")
+                # Drop near-duplicate documents whether or not uploads are preprocessed,
+                # and never leave the previous upload's report in place
+                FileService.clear_dedup_report()
+                deduped = None
+                try:
+                    add_progress_message(operation_id, "Checking study materials for duplicates...", status="uploading")
+                    with span('find_duplicates', files=len(file_paths)):
+                        deduped, pages_by_file, dropped = FileService.dedupe_files(file_paths)
+                    upload_paths = FileService.get_unique_files(file_paths, deduped)
+                except Exception as e:
+                    app.logger.warning(f"Could not check files for duplicates; uploading all of them: {e}")
+                
+                # Extract compact text locally so the model doesn't re-parse raw files on every call
+                preprocessed = False
+                if model_config.PREPROCESS_UPLOADS and deduped is not None:
+                    try:
+                        add_progress_message(operation_id, "Extracting text from study materials...", status="uploading")
+                        with span('preprocess', files=len(file_paths)):
+                            upload_paths, display_names = FileService.preprocess_files(file_paths, deduped)
+                        preprocessed = True
+                    except Exception as e:
+                        app.logger.warning(f"Could not preprocess files; uploading originals: {e}")
+                
+                if deduped is not None:
+                    dedup_report = FileService.save_dedup_report(dropped, preprocessed)
+                    if dedup_report['documents_dropped'] or (preprocessed and dedup_report['pages_dropped']):
+                        add_progress_message(
+                            operation_id,
+                            f"Skipped {dedup_report['documents_dropped']} duplicate files" +
+                            (f" and {dedup_report['pages_dropped']} duplicate pages" if preprocessed else ""),
+                            status="uploading"
+                        )
+            
+                # Upload the new files to Gemini using our service
+                with span('upload_files', files=len(upload_paths)):
+                    file_refs = FileService.upload_files_to_gemini(
+                        upload_paths, 
+                        operation_id=operation_id,
+                        progress_callback=file_upload_progress,
+                        display_names=display_names
+                    )
+                app.logger.info(f"Uploaded {len(file_refs)} files")
+                workspace_id = FileService.get_workspace_id([ref.uri.split('/')[-1] for ref in file_refs])
+
+                # Index the local copies for chat retrieval before they are deleted
+                if model_config.RETRIEVAL_ENABLED:
+                    try:
+                        add_progress_message(operation_id, "Indexing study materials for chat...", status="uploading")
+                        with span('build_index'):
+                            RetrievalService.build_index(file_paths, workspace_id, pages_by_file)
+                    except Exception as e:
+                        # Chat falls back to attaching the full files
+                        app.logger.warning(f"Could not build retrieval index: {e}")
+            finally:
+                # Delete the originals and their compact copies, even if a step above failed
+                for file_path in set(file_paths) | set(upload_paths):
+                    try:
+                        os.remove(file_path)
+                        app.logger.info(f"Deleted local file: {file_path}")
+                    except OSError as e:
+                        app.logger.error(f"Error deleting local file {file_path}: {e}")
             
             # Starting study guide generation - set to 0% progress
             add_progress_message(operation_id, "Starting study guide generation...", status="generating", progress=0)
@@ -109,14 +190,24 @@ def process_files_in_background(file_paths, operation_id, app):
             
             # Generate the study guide with our enhanced progress tracking
             # Quiz generation will start at 0% and progress to 100%
-            result = StudyGuideGenerator.generate_study_guide(
-                file_refs, 
-                progress_callback=progress_callback
-            )
+            with usage_scope(workspace=workspace_id):
+                result = StudyGuideGenerator.generate_study_guide(
+                    file_refs, 
+                    progress_callback=progress_callback
+                )
             
             # Mark as complete
             add_progress_message(operation_id, "Study guide generation complete!", status="complete", progress=100)
             
+            # Bank the guide's questions and pre-generate a pool for instant full quizzes
+            if model_config.QUESTION_BANK_ENABLED and result:
+                try:
+                    with span('index_question_bank'):
+                        QuestionBank.index_study_guide(result, workspace_id)
+                    QuestionBank.replenish_in_background(file_refs, result, workspace_id)
+                except Exception as e:
+                    app.logger.warning(f"Could not build question bank: {e}")
+            
             # Clear any existing chat sessions from the chat blueprint module
             try:
                 from .chat import active_chats
@@ -128,6 +219,69 @@ def process_files_in_background(file_paths, operation_id, app):
         except Exception as e:
             app.logger.error(f"Error in background processing: {e}")
             add_progress_message(operation_id, f"Error: {str(e)}", status="error")
+            current_span().set(error=str(e))
+        finally:
+            if flight is not None:
+                single_flight.finish(flight)
+
+@main_bp.route('/resume-study-guide', methods=['POST'])
+def resume_study_guide():
+    """Regenerate only the missing or failed quizzes of the saved study guide"""
+    if not os.path.exists(os.path.join('static', 'output.json')):
+        return jsonify({'error': 'No study guide found. Please upload files first.'}), 404
+    
+    operation_id = str(uuid.uuid4())
+    init_progress(operation_id)
+    add_progress_message(operation_id, "Resuming study guide generation...", status="generating", progress=0)
+    
+    # Get the current app for the background thread
+    app = current_app._get_current_object()
+    
+    thread = threading.Thread(
+        target=resume_study_guide_in_background,
+        args=(operation_id, app)
+    )
+    thread.daemon = True
+    thread.start()
+    
+    return jsonify({
+        'success': True,
+        'message': 'Resume started',
+        'operation_id': operation_id
+    })
+
+def resume_study_guide_in_background(operation_id, app):
+    """Complete the saved study guide in a background thread with progress updates"""
+    with app.app_context(), start_trace(operation_id, 'resume_study_guide'), \
+            usage_scope(operation=operation_id, kind='resume_study_guide'):
+        try:
+            file_refs = FileService.load_files_from_gemini()
+            if not file_refs:
+                add_progress_message(operation_id, "Error: No study materials found. Please upload files first.", status="error")
+                return
+            
+            def progress_callback(msg, progress=None):
+                add_progress_message(operation_id, msg, status=None, progress=progress)
+            
+            workspace_id = FileService.get_workspace_id()
+            with usage_scope(workspace=workspace_id):
+                result = StudyGuideGenerator.resume_study_guide(file_refs, progress_callback=progress_callback)
+            add_progress_message(operation_id, "Study guide generation complete!", status="complete", progress=100)
+            
+            if model_config.QUESTION_BANK_ENABLED:
+                QuestionBank.index_study_guide(result, workspace_id)
+        except Exception as e:
+            app.logger.error(f"Error resuming study guide: {e}")
+            add_progress_message(operation_id, f"Error: {str(e)}", status="error")
+            current_span().set(error=str(e))
+
+@main_bp.route('/dedup-report', methods=['GET'])
+def dedup_report():
+    """Get the near-duplicate documents and pages dropped from the current upload"""
+    report = FileService.load_dedup_report()
+    if report is None:
+        return jsonify({'error': 'No dedup report found. Please upload files first.'}), 404
+    return jsonify(report)
 
 @main_bp.route('/generation-status/<operation_id>', methods=['GET'])
 def generation_status(operation_id):
@@ -138,12 +292,69 @@ def generation_status(operation_id):
     
     return jsonify(progress_data)
 
+@main_bp.route('/debug/operations/<operation_id>/trace', methods=['GET'])
+def operation_trace(operation_id):
+    """
+    Get the span trace of an upload, resume or quiz operation with a latency breakdown
+
+    With ?format=chrome the trace is downloaded in Chrome trace format for
+    chrome://tracing or Perfetto; finished traces are also served from disk.
+    """
+    trace = get_trace(operation_id)
+    if request.args.get('format') == 'chrome':
+        if trace is None:
+            trace_path = os.path.abspath(get_trace_path(operation_id))
+            if not os.path.exists(trace_path):
+                return jsonify({'error': 'Trace not found'}), 404
+            return send_from_directory(os.path.dirname(trace_path), os.path.basename(trace_path), as_attachment=True)
+        response = jsonify(to_chrome_trace(trace))
+        response.headers['Content-Disposition'] = f'attachment; filename={operation_id}.trace.json'
+        return response
+    
+    if trace is None:
+        return jsonify({'error': 'Trace not found'}), 404
+    return jsonify(trace)
+
+@main_bp.route('/usage', methods=['GET'])
+def usage_report():
+    """Get token use and estimated cost of a workspace (the current upload by default) by stage and model"""
+    workspace_id = request.args.get('workspace') or FileService.get_workspace_id()
+    report = UsageService.get_workspace_report(workspace_id) if workspace_id else None
+    if report is None:
+        return jsonify({'error': 'No usage recorded for this workspace'}), 404
+    return jsonify(report)
+
+@main_bp.route('/usage/operations/<operation_id>', methods=['GET'])
+def operation_usage(operation_id):
+    """Get token use and estimated cost of one upload, quiz or chat by stage and model"""
+    report = UsageService.get_operation_report(operation_id)
+    if report is None:
+        return jsonify({'error': 'No usage recorded for this operation'}), 404
+    return jsonify(report)
+
+@main_bp.route('/routing', methods=['GET'])
+def routing_report():
+    """Get the model routing policy, the recent health of its models and the routing decisions made"""
+    return jsonify(ModelRouter.get_report())
+
+@main_bp.route('/metrics', methods=['GET'])
+def metrics():
+    """Expose request, model call, queue, cache and store metrics in Prometheus text format"""
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4')
+
 @main_bp.route('/study-guide')
 def study_guide():
+    """
+    Render the whole study guide page
+
+    The page embeds every unit for client-side navigation and quiz scoring, so
+    it still loads the full guide (from the in-process cache after the first
+    request); the per-unit and per-section routes below use the offset index.
+    """
     try:
         # Read the generated JSON file using our helper
         output_file_path = os.path.join('static', 'output.json')
-        data = load_json_from_file(output_file_path)
+        data = load_study_guide(output_file_path)
         return render_template('study_guide.html', data=data)
     except FileNotFoundError:
         return render_template('error.html', message="Study guide not found. Please upload files first.")
@@ -151,6 +362,28 @@ def study_guide():
         current_app.logger.error(f"Error loading study guide: {e}")
         return render_template('error.html', message=f"Error loading study guide: {str(e)}")
 
+@main_bp.route('/study-guide/unit/<int:unit_index>')
+def study_guide_unit(unit_index):
+    """Get a single study guide unit as JSON without loading the whole guide"""
+    try:
+        output_file_path = os.path.join('static', 'output.json')
+        return jsonify(load_study_guide_unit(output_file_path, unit_index))
+    except FileNotFoundError:
+        return jsonify({'error': 'Study guide not found. Please upload files first.'}), 404
+    except IndexError as e:
+        return jsonify({'error': str(e)}), 404
+
+@main_bp.route('/study-guide/unit/<int:unit_index>/section/<int:section_index>')
+def study_guide_section(unit_index, section_index):
+    """Get a single study guide section as JSON without loading the whole guide"""
+    try:
+        output_file_path = os.path.join('static', 'output.json')
+        return jsonify(load_study_guide_section(output_file_path, unit_index, section_index))
+    except FileNotFoundError:
+        return jsonify({'error': 'Study guide not found. Please upload files first.'}), 404
+    except IndexError as e:
+        return jsonify({'error': str(e)}), 404
+
 @main_bp.route('/static/<path:filename>')
 def serve_static(filename):
     return send_from_directory('static', filename)
\ No newline at end of file
@@ -7,12 +7,19 @@ from flask import Blueprint, render_template, request, jsonify, current_app
 import model_config
 from app.services.file_service import FileService
 from app.core.quiz_generator import QuizGenerator
+from app.core.question_bank import QuestionBank
+from app.services.usage_service import usage_scope
+from app.helpers.guide_storage import load_study_guide
+from app.helpers.tracing import start_trace, current_span
+from app.helpers import single_flight
+from app.helpers.metrics import STORE_SIZE, record_cache
 
 # Create the blueprint
 quiz_bp = Blueprint('quiz', __name__)
 
 # Store quiz generation results
 quiz_results = {}
+STORE_SIZE.set_function(lambda: len(quiz_results), store='quiz_results')
 
 @quiz_bp.route('/quiz')
 def quiz():
@@ -22,9 +29,39 @@ def quiz():
 def generate_quiz():
     try:
         data = request.get_json()
-        model = data.get('model', model_config.DEFAULT_QUIZ_MODEL)
+        # Without an explicit model, each request is routed by the MODEL_ROUTES policy
+        model = data.get('model')
         question_count = data.get('question_count', 10)
         
+        # Generate a unique ID for this quiz generation
+        generation_id = str(uuid.uuid4())
+        
+        # Serve the quiz instantly from the question bank when it has enough questions;
+        # the bank's questions come from routed models, so an explicitly chosen model bypasses it
+        if model_config.QUESTION_BANK_ENABLED and not model:
+            workspace_id = FileService.get_workspace_id()
+            questions_list = QuestionBank.sample(workspace_id, question_count)
+            record_cache('question_bank', bool(questions_list))
+            if questions_list:
+                current_app.logger.info(f"Served {question_count} questions from the question bank")
+                quiz_results[generation_id] = {
+                    'status': 'complete',
+                    'quiz': {'questions': questions_list}
+                }
+                
+                # Top the pool back up in the background when it runs low
+                if QuestionBank.stats(workspace_id)['unserved'] < model_config.QUESTION_BANK_LOW_WATERMARK:
+                    try:
+                        study_guide_data = load_study_guide(os.path.join('static', 'output.json'))
+                        QuestionBank.replenish_in_background(None, study_guide_data, workspace_id)
+                    except (FileNotFoundError, ValueError):
+                        pass
+                
+                return jsonify({
+                    'status': 'generating',
+                    'generation_id': generation_id
+                })
+        
         # Use our file service to load files
         file_refs = FileService.load_files_from_gemini()
         if not file_refs:
@@ -33,15 +70,31 @@ def generate_quiz():
                 'error': 'No study materials found. Please upload documents first.'
             }), 400
         
-        # Generate a unique ID for this quiz generation
-        generation_id = str(uuid.uuid4())
-
-        current_app.logger.info(f"Generating quiz with {question_count} questions using {model}")
+        # Identical quizzes already being generated for the same materials are shared
+        workspace_id = FileService.get_workspace_id()
+        key = single_flight.fingerprint('quiz', workspace=workspace_id, questions=question_count, model=model)
+        flight, joined = single_flight.join(key, generation_id)
+        # Seed the result so the request can be canceled before the first shard lands
+        quiz_results[generation_id] = {'status': 'generating'}
+        if joined:
+            leader_result = quiz_results.get(flight.leader_id)
+            if leader_result and leader_result.get('status') != 'canceled':
+                quiz_results[generation_id] = leader_result
+            current_app.logger.info(f"Quiz {generation_id} joined in-flight generation {flight.leader_id}")
+            return jsonify({
+                'status': 'generating',
+                'generation_id': generation_id
+            })
+        
+        current_app.logger.info(f"Generating quiz with {question_count} questions using {model or 'routed models'}")
+        
+        # Get the current app for the background thread
+        app = current_app._get_current_object()
         
         # Start the quiz generation in a background thread
         thread = threading.Thread(
             target=generate_quiz_in_background,
-            args=(generation_id, question_count, file_refs, model)
+            args=(generation_id, question_count, file_refs, model, app, workspace_id, flight)
         )
         thread.daemon = True
         thread.start()
@@ -106,41 +159,103 @@ def quiz_status(generation_id):
     
     return jsonify(result)
 
-def generate_quiz_in_background(generation_id, question_count, file_refs, model_name=None):
-    """Helper function to generate quiz in a background thread"""
-    try:
-        if not file_refs:
-            quiz_results[generation_id] = {
-                'status': 'error',
-                'message': 'No study materials found. Please upload documents first.'
-            }
-            return
-        
-        # Use our new QuizGenerator class
-        questions_list = QuizGenerator.generate_quiz_questions(
-            file_refs, 
-            question_count,
-            model_name=model_name
-        )
-        
-        if not questions_list:
-            quiz_results[generation_id] = {
+def _publish_quiz_result(generation_id, flight, result, final=False):
+    """
+    Store a quiz result under the generation and every identical request that joined it
+
+    Requests that were canceled keep their canceled status. The final result
+    also closes the flight, so it reaches every request that joined in time.
+    """
+    if flight is None:
+        generation_ids = [generation_id]
+    else:
+        generation_ids = single_flight.finish(flight) if final else flight.members()
+    for member_id in generation_ids:
+        if quiz_results.get(member_id, {}).get('status') != 'canceled':
+            quiz_results[member_id] = result
+
+def _quiz_canceled(generation_id, flight):
+    """Whether every request waiting for this generation has been canceled"""
+    generation_ids = flight.members() if flight is not None else [generation_id]
+    return all(quiz_results.get(member_id, {}).get('status') == 'canceled' for member_id in generation_ids)
+
+def generate_quiz_in_background(generation_id, question_count, file_refs, model_name=None, app=None, workspace_id=None,
+                                flight=None):
+    """
+    Helper function to generate quiz in a background thread
+    
+    Args:
+        flight (Flight, optional): Single-flight entry of this request; results are
+                                   published to every identical request that joins it
+    """
+    with app.app_context(), start_trace(generation_id, 'generate_quiz', questions=question_count, quiz_model=model_name), \
+            usage_scope(operation=generation_id, kind='quiz', workspace=workspace_id, stage='quiz'):
+        try:
+            if not file_refs:
+                _publish_quiz_result(generation_id, flight, {
+                    'status': 'error',
+                    'message': 'No study materials found. Please upload documents first.'
+                }, final=True)
+                return
+            
+            # Large quizzes are split into parallel shards scoped to study guide units
+            study_guide_data = None
+            if question_count >= model_config.QUIZ_SHARD_THRESHOLD:
+                try:
+                    study_guide_data = load_study_guide(os.path.join('static', 'output.json'))
+                except (FileNotFoundError, ValueError):
+                    current_app.logger.info("No study guide available; generating quiz in a single request")
+            
+            if study_guide_data:
+                # Stream finished shards to the client so answering can start early
+                def shard_callback(questions, shards_complete, shards_total):
+                    _publish_quiz_result(generation_id, flight, {
+                        'status': 'generating',
+                        'quiz': {'questions': questions},
+                        'shards_complete': shards_complete,
+                        'shards_total': shards_total
+                    })
+                
+                questions_list = QuizGenerator.generate_sharded_quiz(
+                    file_refs,
+                    question_count,
+                    study_guide_data,
+                    model_name=model_name,
+                    shard_callback=shard_callback
+                )
+            else:
+                # Use our new QuizGenerator class
+                questions_list = QuizGenerator.generate_quiz_questions(
+                    file_refs, 
+                    question_count,
+                    model_name=model_name
+                )
+            
+            if _quiz_canceled(generation_id, flight):
+                return
+            
+            if not questions_list:
+                _publish_quiz_result(generation_id, flight, {
+                    'status': 'error',
+                    'message': 'Failed to generate quiz questions'
+                }, final=True)
+                return
+            
+            # Format the response in the expected structure
+            quiz_json = {'questions': questions_list}
+            
+            # Store the quiz result
+            _publish_quiz_result(generation_id, flight, {
+                'status': 'complete',
+                'quiz': quiz_json
+            }, final=True)
+        except Exception as e:
+            current_app.logger.error(f"Error in background quiz generation: {e}")
+            _publish_quiz_result(generation_id, flight, {
                 'status': 'error',
-                'message': 'Failed to generate quiz questions'
-            }
-            return
-        
-        # Format the response in the expected structure
-        quiz_json = {'questions': questions_list}
-        
-        # Store the quiz result
-        quiz_results[generation_id] = {
-            'status': 'complete',
-            'quiz': quiz_json
-        }
-    except Exception as e:
-        current_app.logger.error(f"Error in background quiz generation: {e}")
-        quiz_results[generation_id] = {
-            'status': 'error',
-            'message': str(e)
-        }
\ No newline at end of file
+                'message': str(e)
+            }, final=True)
+            current_span().set(error=str(e))
+        finally:
+            if flight is not None:
+                single_flight.finish(flight)
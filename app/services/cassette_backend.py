@@ -0,0 +1,427 @@
+"""
+Record/replay cassettes for StudyLM model calls
+CassetteBackend wraps another model backend. In record mode every request's
+fingerprint (model, generation config, system instruction, prompt text hash
+and file digests) is saved with its response, usage and timing, including
+the delay before each streamed chunk. In replay mode the same requests are
+answered from the cassette without touching the network, either in real
+time or at an accelerated speed, so runs are reproducible offline.
+
+Enable it with STUDYLM_CASSETTE=<path> and STUDYLM_CASSETTE_MODE=record,
+replay or auto (replay what is recorded, record what is missing).
+"""
+
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+import model_config
+from app.helpers.atomic_io import atomic_write_json
+from app.helpers.token_estimator import file_digest
+
+logger = logging.getLogger(__name__)
+
+CASSETTE_VERSION = 1
+
+class CassetteMissError(LookupError):
+    """Raised in replay mode when a request was never recorded"""
+
+class CassetteReplayError(Exception):
+    """Base class for recorded API errors raised again during replay"""
+
+def _replayed_error(error):
+    """Recreate a recorded error under its original class name so retry logic treats it the same"""
+    error_class = type(error['type'], (CassetteReplayError,), {'code': error.get('code')})
+    return error_class(error['message'])
+
+def _hash(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+def _normalize_parts(contents):
+    """Reduce request contents to text and file digests for fingerprinting"""
+    if not isinstance(contents, (list, tuple)):
+        contents = [contents]
+    parts = []
+    for part in contents:
+        if isinstance(part, str):
+            parts.append(part)
+        elif isinstance(part, dict):
+            parts.append({'role': part.get('role'), 'parts': _normalize_parts(part.get('parts', []))})
+        else:
+            parts.append({'file': file_digest(part)})
+    return parts
+
+def _text_lines(parts):
+    """Distinct line hashes of the text in normalized parts, for approximate matching"""
+    lines = set()
+    for part in parts:
+        if isinstance(part, str):
+            lines.update(_hash(line.strip())[:12] for line in part.splitlines() if line.strip())
+        elif 'parts' in part:
+            lines.update(_text_lines(part['parts']))
+    return lines
+
+def _files(parts):
+    files = []
+    for part in parts:
+        if isinstance(part, dict):
+            if 'file' in part:
+                files.append(part['file'])
+            else:
+                files.extend(_files(part['parts']))
+    return files
+
+def fingerprint_request(kind, model_name, config, system_instruction, contents):
+    """
+    Fingerprint a model request
+
+    Returns:
+        tuple: (exact fingerprint, loose fingerprint without the prompt text, line hashes)
+    """
+    parts = _normalize_parts(contents)
+    base = {
+        'kind': kind,
+        'model': model_name,
+        'config': json.dumps(config or {}, sort_keys=True, default=str),
+        'system_instruction': _hash(str(system_instruction or '')),
+        'files': _files(parts)
+    }
+    exact = dict(base, prompt=_hash(json.dumps(parts, sort_keys=True)))
+    return (
+        _hash(json.dumps(exact, sort_keys=True)),
+        _hash(json.dumps(base, sort_keys=True)),
+        _text_lines(parts)
+    )
+
+class CassetteFile:
+    """File reference restored from a cassette"""
+
+    def __init__(self, metadata):
+        for key, value in metadata.items():
+            setattr(self, key, value)
+
+class CassetteUsage:
+    def __init__(self, usage):
+        self.prompt_token_count = usage.get('prompt_tokens')
+        self.candidates_token_count = usage.get('output_tokens')
+        self.total_token_count = (self.prompt_token_count or 0) + (self.candidates_token_count or 0)
+
+class CassetteTokenCount:
+    def __init__(self, total_tokens):
+        self.total_tokens = total_tokens
+
+class CassetteChunk:
+    def __init__(self, text):
+        self.text = text
+
+class ReplayedResponse:
+    """A recorded response, streamed with its recorded chunk timing scaled by the replay speed"""
+
+    def __init__(self, interaction, stream, speed):
+        self.text = ''.join(text for _, text in interaction['chunks'])
+        self.usage_metadata = CassetteUsage(interaction.get('usage') or {})
+        self._chunks = interaction['chunks']
+        self._stream = stream
+        self._speed = speed
+
+    def __iter__(self):
+        for delay, text in self._chunks:
+            if self._stream and self._speed:
+                time.sleep(delay / self._speed)
+            yield CassetteChunk(text)
+
+class RecordingResponse:
+    """Wraps a live response, capturing chunk text and timing as the caller consumes it"""
+
+    def __init__(self, cassette, interaction, response, stream):
+        self._cassette = cassette
+        self._interaction = interaction
+        self._response = response
+        self._stream = stream
+        if not stream:
+            self._finish([(0, response.text)])
+
+    def __getattr__(self, name):
+        return getattr(self._response, name)
+
+    def __iter__(self):
+        if not self._stream:
+            yield from self._response
+            return
+        chunks = []
+        iterator = iter(self._response)
+        while True:
+            started = time.monotonic()
+            try:
+                chunk = next(iterator)
+            except StopIteration:
+                break
+            chunks.append((time.monotonic() - started, chunk.text))
+            yield chunk
+        self._finish(chunks)
+
+    def _finish(self, chunks):
+        usage = getattr(self._response, 'usage_metadata', None)
+        self._interaction['chunks'] = chunks
+        self._interaction['usage'] = {
+            'prompt_tokens': getattr(usage, 'prompt_token_count', None),
+            'output_tokens': getattr(usage, 'candidates_token_count', None)
+        }
+        self._cassette.add_interaction(self._interaction)
+
+class CassetteChat:
+    def __init__(self, model, history=None):
+        self.model = model
+        self.history = list(history or [])
+        self._inner = None
+
+    def send_message(self, content, stream=False):
+        def live_call():
+            if self._inner is None:
+                self._inner = self.model.inner_model().start_chat(history=self.history)
+            return self._inner.send_message(content, stream=stream)
+
+        response = self.model.backend.request(
+            'chat', self.model, self.history + [content], stream, live_call
+        )
+        self.history.append(content)
+        return response
+
+class CassetteModel:
+    def __init__(self, backend, model_name, kwargs):
+        self.backend = backend
+        self.model_name = model_name if model_name.startswith('models/') else f"models/{model_name}"
+        self.generation_config = kwargs.get('generation_config') or {}
+        self.system_instruction = kwargs.get('system_instruction')
+        self._model_name = model_name
+        self._kwargs = kwargs
+        self._inner = None
+
+    def inner_model(self):
+        """The wrapped backend's model, created only when a live call is needed"""
+        if self._inner is None:
+            self._inner = self.backend.require_inner().create_model(self._model_name, **self._kwargs)
+        return self._inner
+
+    def generate_content(self, contents, generation_config=None, stream=False):
+        config = dict(self.generation_config)
+        config.update(generation_config or {})
+        return self.backend.request(
+            'generate', self, contents, stream,
+            lambda: self.inner_model().generate_content(contents, generation_config=generation_config, stream=stream),
+            config=config
+        )
+
+    def count_tokens(self, contents):
+        return self.backend.count_tokens(self, contents)
+
+    def start_chat(self, history=None):
+        return CassetteChat(self, history)
+
+class CassetteBackend:
+    """Backend wrapper that records model traffic to a cassette or replays it"""
+
+    name = 'cassette'
+
+    def __init__(self, path, mode='replay', inner=None, speed=1.0, strict=False):
+        if mode not in ('record', 'replay', 'auto'):
+            raise ValueError(f"Unknown cassette mode: {mode}")
+        self.path = path
+        self.mode = mode
+        self.inner = inner
+        self.speed = speed
+        self.strict = strict
+        self.lock = threading.Lock()
+        self.data = {'version': CASSETTE_VERSION, 'files': {}, 'uploads': {}, 'interactions': []}
+        if mode != 'record' and os.path.exists(path):
+            with open(path, 'r') as f:
+                self.data = json.load(f)
+        self._exact = {}
+        self._loose = {}
+        self._used = {}
+        for interaction in self.data['interactions']:
+            self._index(interaction)
+
+    def _index(self, interaction):
+        self._exact.setdefault(interaction['fingerprint'], []).append(interaction)
+        self._loose.setdefault(interaction['loose'], []).append(interaction)
+
+    def require_inner(self):
+        if self.inner is None:
+            raise CassetteMissError(f"Cassette {self.path} is in replay mode and cannot make live calls")
+        return self.inner
+
+    def save(self):
+        """Persist the cassette (caller holds the lock)"""
+        atomic_write_json(self.data, self.path)
+
+    def add_interaction(self, interaction):
+        with self.lock:
+            self.data['interactions'].append(interaction)
+            self._index(interaction)
+            self.save()
+
+    def configure(self, api_key):
+        if self.inner is not None:
+            self.inner.configure(api_key)
+
+    def upload_file(self, file_path, display_name=None):
+        with open(file_path, 'rb') as f:
+            content_digest = hashlib.sha256(f.read()).hexdigest()
+
+        if self.mode != 'record':
+            with self.lock:
+                name = self.data['uploads'].get(content_digest)
+                if name:
+                    return CassetteFile(self.data['files'][name])
+            if self.mode == 'replay':
+                # Unrecorded uploads still get a stable reference so prompts can be fingerprinted
+                return CassetteFile({
+                    'name': f"files/{content_digest[:12]}",
+                    'uri': f"https://cassette.local/v1beta/files/{content_digest[:12]}",
+                    'display_name': display_name or os.path.basename(file_path),
+                    'mime_type': None,
+                    'size_bytes': os.path.getsize(file_path),
+                    'sha256_hash': content_digest
+                })
+
+        file_ref = self.require_inner().upload_file(file_path, display_name=display_name)
+        self._record_file(file_ref, content_digest)
+        return file_ref
+
+    def get_file(self, name):
+        full_name = name if name.startswith('files/') else f"files/{name}"
+        if self.mode != 'record':
+            with self.lock:
+                metadata = self.data['files'].get(full_name)
+            if metadata:
+                return CassetteFile(metadata)
+        file_ref = self.require_inner().get_file(name)
+        self._record_file(file_ref)
+        return file_ref
+
+    def _record_file(self, file_ref, content_digest=None):
+        metadata = {
+            'name': file_ref.name,
+            'uri': file_ref.uri,
+            'display_name': file_ref.display_name,
+            'mime_type': getattr(file_ref, 'mime_type', None),
+            'size_bytes': getattr(file_ref, 'size_bytes', 0),
+            'sha256_hash': file_digest(file_ref)
+        }
+        with self.lock:
+            self.data['files'][file_ref.name] = metadata
+            if content_digest:
+                self.data['uploads'][content_digest] = file_ref.name
+            self.save()
+
+    def create_model(self, model_name, **kwargs):
+        return CassetteModel(self, model_name, kwargs)
+
+    def _lookup(self, fingerprint, loose, lines):
+        """Next recorded interaction for a request, or None (caller holds the lock)"""
+        candidates = self._exact.get(fingerprint)
+        if not candidates and not self.strict:
+            # Prompts can differ slightly between runs (e.g. questions merged in completion
+            # order), so fall back to the recording of the same call whose lines overlap most
+            loose_candidates = self._loose.get(loose)
+            if loose_candidates:
+                def overlap(interaction):
+                    recorded = set(interaction['lines'])
+                    return len(recorded & lines) / (len(recorded | lines) or 1)
+                best = max(loose_candidates, key=overlap)
+                logger.warning(f"Inexact cassette match ({overlap(best):.2f} line overlap)")
+                candidates = self._exact[best['fingerprint']]
+                fingerprint = best['fingerprint']
+        if not candidates:
+            return None
+
+        # Identical requests (e.g. retries) replay their recordings in order
+        used = self._used.get(fingerprint, 0)
+        self._used[fingerprint] = used + 1
+        return candidates[min(used, len(candidates) - 1)]
+
+    def request(self, kind, model, contents, stream, live_call, config=None):
+        """Serve one generate or chat request from the cassette or record the live response"""
+        config = model.generation_config if config is None else config
+        fingerprint, loose, lines = fingerprint_request(
+            kind, model.model_name, config, model.system_instruction, contents
+        )
+
+        if self.mode != 'record':
+            with self.lock:
+                interaction = self._lookup(fingerprint, loose, lines)
+            if interaction is not None:
+                if self.speed:
+                    time.sleep(interaction['latency'] / self.speed)
+                if interaction.get('error'):
+                    raise _replayed_error(interaction['error'])
+                return ReplayedResponse(interaction, stream, self.speed)
+            if self.mode == 'replay':
+                raise CassetteMissError(
+                    f"No recorded {kind} request for {model.model_name} ({fingerprint[:12]}) in {self.path}"
+                )
+
+        interaction = {
+            'fingerprint': fingerprint,
+            'loose': loose,
+            'lines': sorted(lines),
+            'kind': kind,
+            'model': model.model_name,
+            'stream': stream
+        }
+        started = time.monotonic()
+        try:
+            response = live_call()
+        except Exception as e:
+            code = getattr(e, 'code', None)
+            interaction.update(
+                latency=time.monotonic() - started,
+                chunks=[],
+                error={'type': type(e).__name__, 'code': code if isinstance(code, int) else None, 'message': str(e)}
+            )
+            self.add_interaction(interaction)
+            raise
+        interaction['latency'] = time.monotonic() - started
+        return RecordingResponse(self, interaction, response, stream)
+
+    def count_tokens(self, model, contents):
+        fingerprint, loose, lines = fingerprint_request('count_tokens', model.model_name, None, None, contents)
+        if self.mode != 'record':
+            with self.lock:
+                interaction = self._lookup(fingerprint, loose, lines)
+            if interaction is not None:
+                return CassetteTokenCount(interaction['total_tokens'])
+            if self.mode == 'replay':
+                raise CassetteMissError(f"No recorded token count ({fingerprint[:12]}) in {self.path}")
+
+        total_tokens = model.inner_model().count_tokens(contents).total_tokens
+        self.add_interaction({
+            'fingerprint': fingerprint,
+            'loose': loose,
+            'lines': sorted(lines),
+            'kind': 'count_tokens',
+            'model': model.model_name,
+            'latency': 0,
+            'total_tokens': total_tokens
+        })
+        return CassetteTokenCount(total_tokens)
+
+def create_cassette_backend(create_inner):
+    """
+    Create the cassette backend configured in model_config
+
+    Args:
+        create_inner: Zero-argument function creating the backend to record from;
+                      not called in replay mode, so no API key is needed
+    """
+    mode = model_config.MODEL_CASSETTE_MODE
+    return CassetteBackend(
+        model_config.MODEL_CASSETTE,
+        mode=mode,
+        inner=None if mode == 'replay' else create_inner(),
+        speed=model_config.MODEL_CASSETTE_SPEED,
+        strict=model_config.MODEL_CASSETTE_STRICT
+    )
@@ -0,0 +1,264 @@
+"""
+Hedged chat requests for StudyLM
+A chat turn's time to first chunk is dominated by the slowest tail responses.
+When the first chunk of a reply has not arrived within the recent p95 time to
+first chunk of its model, a duplicate request is sent (to the same model, or to
+CHAT_HEDGE_MODEL for turns on the default model) and whichever starts
+streaming first is used; the other is cancelled.
+
+Each attempt runs on its own thread up to its first chunk, so the chat worker
+only waits for the winner and then streams it as before. No hedge is sent
+while the hedge model is rate limited or has requests queued, since a slow
+first chunk then comes from waiting for the limiter, which a duplicate only
+makes worse.
+
+A losing attempt is cancelled once it starts streaming, but its input tokens
+are still billed; they are added to the usage ledger (stage 'chat_hedge')
+from the turn's input token estimate, since a cancelled stream never reports
+its usage.
+"""
+
+import time
+import itertools
+import threading
+from queue import Queue, Empty
+from collections import deque
+from flask import current_app
+import model_config
+from app.helpers.tracing import current_span, propagate
+from app.helpers.metrics import CHAT_HEDGES
+from app.services.gemini_service import GeminiService
+from app.services.usage_service import UsageService, usage_scope
+from app.services.request_scheduler import scheduler, normalize_model_name
+
+# Recent times to first chunk in seconds, keyed by model name
+_first_chunk_seconds = {}
+# Turns, hedges and hedge wins keyed by the turn's requested model
+_stats = {}
+_stats_lock = threading.Lock()
+
+def _percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+class _Attempt:
+    """One request of a hedged chat turn"""
+
+    def __init__(self, model_name, hedge, estimated_tokens=None):
+        self.model_name = model_name
+        self.hedge = hedge
+        self.estimated_tokens = estimated_tokens
+        self.started = time.perf_counter()
+        self.response = None
+        self.chunks = None
+        self.first_chunk = None
+        self.error = None
+        # Whichever of the attempt thread (on finishing) and the chat worker (on
+        # abandoning) comes second cancels a losing stream
+        self.lock = threading.Lock()
+        self.finished = False
+        self.abandoned = False
+
+    def cancel(self):
+        """Stop a losing stream so it does not keep generating output, and account its input"""
+        if self.error is None and self.estimated_tokens:
+            with usage_scope(stage='chat_hedge'):
+                UsageService.record(self.model_name, self.estimated_tokens, 0)
+        # Generators (the offline backend) close; the Gemini SDK's streamed response
+        # wraps a gRPC call that can be cancelled
+        for target in (self.chunks, getattr(self.response, '_iterator', None)):
+            for method in ('cancel', 'close'):
+                stop = getattr(target, method, None)
+                if callable(stop):
+                    try:
+                        stop()
+                    except Exception:
+                        pass
+                    break
+
+    def finish(self):
+        with self.lock:
+            self.finished = True
+            abandoned = self.abandoned
+        if abandoned:
+            self.cancel()
+
+    def abandon(self):
+        with self.lock:
+            self.abandoned = True
+            finished = self.finished
+        if finished:
+            self.cancel()
+
+class ChatHedging:
+    """Service class for sending chat messages with a hedge request on slow first chunks"""
+
+    @staticmethod
+    def record_first_chunk(model_name, seconds):
+        """Add a reply's time to first chunk to its model's recent history"""
+        model_name = normalize_model_name(model_name)
+        with _stats_lock:
+            samples = _first_chunk_seconds.get(model_name)
+            if samples is None:
+                samples = _first_chunk_seconds[model_name] = deque(maxlen=model_config.CHAT_HEDGE_MAX_SAMPLES)
+            samples.append(seconds)
+
+    @staticmethod
+    def get_delay(model_name):
+        """Seconds to wait for a model's first chunk before sending a hedge request"""
+        with _stats_lock:
+            samples = list(_first_chunk_seconds.get(normalize_model_name(model_name), ()))
+        if len(samples) < model_config.CHAT_HEDGE_MIN_SAMPLES:
+            return model_config.CHAT_HEDGE_DEFAULT_DELAY
+        delay = _percentile(samples, model_config.CHAT_HEDGE_PERCENTILE)
+        return min(max(delay, model_config.CHAT_HEDGE_MIN_DELAY), model_config.CHAT_HEDGE_MAX_DELAY)
+
+    @staticmethod
+    def get_hedge_model(model_name):
+        """Model a hedge request is sent to; a model the user explicitly picked is never swapped"""
+        if model_config.CHAT_HEDGE_MODEL and \
+                normalize_model_name(model_name) == normalize_model_name(model_config.DEFAULT_CHAT_MODEL):
+            return model_config.CHAT_HEDGE_MODEL
+        return model_name
+
+    @staticmethod
+    def _limiter_busy(model_name):
+        """Why a hedge to a model could only wait behind its rate limiter, or None"""
+        limiter = scheduler.get_limiter(model_name)
+        if limiter.recently_throttled(model_config.ROUTING_THROTTLE_COOLDOWN_SECONDS):
+            return 'throttled'
+        if limiter.queue_depth():
+            return 'queued'
+        return None
+
+    @staticmethod
+    def _count(model_name, outcome):
+        CHAT_HEDGES.inc(model=model_name, outcome=outcome)
+        with _stats_lock:
+            stats = _stats.setdefault(model_name, {'turns': 0, 'hedged': 0, 'hedge_wins': 0, 'skipped': 0, 'failed': 0})
+            stats['turns'] += 1
+            stats['hedged'] += int(outcome in ('primary_won', 'hedge_won', 'failed_hedged'))
+            stats['skipped'] += int(outcome.endswith('_skipped'))
+            stats['hedge_wins'] += int(outcome == 'hedge_won')
+            stats['failed'] += int(outcome.startswith('failed'))
+
+    @staticmethod
+    def send_message(start_chat, model_name, content, estimated_tokens=None):
+        """
+        Send a chat message, hedging it with a duplicate request if its first chunk is slow
+
+        Args:
+            start_chat (callable): Called with a model name; returns a new chat session
+                                   with the turn's history and system instruction
+            model_name (str): Model the user chose
+            content: Message to send
+            estimated_tokens (int, optional): Estimated input tokens including history
+
+        Returns:
+            tuple: (model name, response, chunk iterator) of the request that
+                   responded first; the iterator starts with the first chunk
+        """
+        app = current_app._get_current_object()
+        results = Queue()
+
+        def run(attempt):
+            with app.app_context():
+                try:
+                    chat = start_chat(attempt.model_name)
+                    attempt.response = GeminiService.send_chat_message(
+                        chat, content, estimated_tokens=estimated_tokens
+                    )
+                    attempt.chunks = iter(attempt.response)
+                    attempt.first_chunk = next(attempt.chunks, None)
+                    ChatHedging.record_first_chunk(attempt.model_name, time.perf_counter() - attempt.started)
+                except Exception as e:
+                    attempt.error = e
+                attempt.finish()
+                results.put(attempt)
+
+        def start(attempt_model, hedge):
+            attempt = _Attempt(attempt_model, hedge, estimated_tokens)
+            thread = threading.Thread(target=propagate(run), args=(attempt,))
+            thread.daemon = True
+            thread.start()
+            return attempt
+
+        primary = start(model_name, hedge=False)
+        delay = ChatHedging.get_delay(model_name) if model_config.CHAT_HEDGING_ENABLED else None
+        pending = [primary]
+        failed = []
+        hedge = None
+        skipped = None
+        winner = None
+
+        while pending:
+            timeout = None
+            if hedge is None and delay is not None:
+                timeout = max(0, delay - (time.perf_counter() - primary.started))
+            try:
+                attempt = results.get(timeout=timeout)
+            except Empty:
+                hedge_model = ChatHedging.get_hedge_model(model_name)
+                skipped = ChatHedging._limiter_busy(hedge_model)
+                if skipped:
+                    current_app.logger.info(f"Not hedging slow turn on {model_name}: {hedge_model} is {skipped}")
+                    delay = None
+                    continue
+                current_app.logger.info(
+                    f"No first chunk from {model_name} after {delay:.1f}s; hedging with {hedge_model}"
+                )
+                hedge = start(hedge_model, hedge=True)
+                pending.append(hedge)
+                continue
+
+            pending.remove(attempt)
+            if attempt.error is None:
+                winner = attempt
+                break
+            failed.append(attempt)
+            if hedge is None:
+                # The primary failed before the deadline (after the scheduler's retries)
+                break
+
+        for attempt in pending:
+            attempt.abandon()
+
+        if winner is None:
+            ChatHedging._count(model_name, 'failed_hedged' if hedge else 'failed')
+            raise failed[0].error
+
+        if hedge is None:
+            outcome = f"{skipped}_skipped" if skipped else 'not_hedged'
+        else:
+            outcome = 'hedge_won' if winner.hedge else 'primary_won'
+        ChatHedging._count(model_name, outcome)
+        current_span().set(hedge=outcome, chat_model=winner.model_name)
+        if winner.hedge:
+            current_app.logger.info(f"Hedge request to {winner.model_name} answered first")
+
+        chunks = winner.chunks if winner.first_chunk is None else itertools.chain([winner.first_chunk], winner.chunks)
+        return winner.model_name, winner.response, chunks
+
+    @staticmethod
+    def get_stats():
+        """
+        Hedge rate and win rate per chat model, with each model's current hedge delay
+
+        Returns:
+            dict: 'enabled', 'hedge_model' and 'models' keyed by model name
+        """
+        with _stats_lock:
+            stats = {model_name: dict(totals) for model_name, totals in _stats.items()}
+            models = set(stats) | set(_first_chunk_seconds)
+        report = {}
+        for model_name in sorted(models):
+            totals = stats.get(model_name, {'turns': 0, 'hedged': 0, 'hedge_wins': 0, 'skipped': 0, 'failed': 0})
+            totals['hedge_rate'] = round(totals['hedged'] / totals['turns'], 3) if totals['turns'] else 0.0
+            totals['hedge_win_rate'] = round(totals['hedge_wins'] / totals['hedged'], 3) if totals['hedged'] else 0.0
+            totals['hedge_delay_seconds'] = round(ChatHedging.get_delay(model_name), 3)
+            report[model_name] = totals
+        return {
+            'enabled': model_config.CHAT_HEDGING_ENABLED,
+            'hedge_model': model_config.CHAT_HEDGE_MODEL,
+            'models': report
+        }
@@ -0,0 +1,259 @@
+"""
+Offline Gemini stand-in for StudyLM
+FakeBackend mimics the parts of google.generativeai that StudyLM uses, with
+configurable latency, streaming cadence, token counts and rate-limit errors,
+and canned but well-formed study guide, quiz and chat responses. It makes
+the full pipeline runnable and measurable without an API key or network.
+
+Select it with STUDYLM_MODEL_BACKEND=fake; tune it with the FAKE_MODEL_*
+settings in model_config.py.
+"""
+
+import os
+import re
+import json
+import time
+import random
+import hashlib
+import mimetypes
+import threading
+import model_config
+from app.helpers.token_estimator import estimate_input_tokens, estimate_text_tokens
+
+_WORDS = """
+absorption acid activation adaptation allele amplitude analysis anatomy antibody atom
+balance barrier binding buffer capacity carbon catalyst cell channel charge circuit
+climate coefficient compound concentration conduction conservation constant cortex current
+cycle decay density diffusion dipole displacement distribution division efficiency electron
+element emission energy entropy enzyme equilibrium evolution excitation expression feedback
+field filter flux force frequency friction function gene gradient gravity habitat
+heat hormone hypothesis impulse inertia inhibition input insulation interaction ion
+isotope kinetics lattice ligand load magnet mass matrix membrane metabolism molecule
+momentum motion mutation network neuron nucleus orbit osmosis output oxidation particle
+pathway phase photon pigment polarity population potential pressure protein pulse
+radiation ratio reaction receptor reflex regulation resistance resonance respiration response
+sample saturation sequence signal solubility solution spectrum stimulus strain stress
+structure substrate surface symmetry synapse synthesis system temperature tension threshold
+tissue torque transcription transfer transport tuning turbulence valence variable vector
+velocity vibration viscosity voltage volume wave weight yield
+""".split()
+
+class ResourceExhausted(Exception):
+    """Simulated rate-limit error; the scheduler treats it like the real 429"""
+    code = 429
+
+class FakeUsage:
+    def __init__(self, prompt_tokens, output_tokens):
+        self.prompt_token_count = prompt_tokens
+        self.candidates_token_count = output_tokens
+        self.total_token_count = prompt_tokens + output_tokens
+
+class FakeTokenCount:
+    def __init__(self, total_tokens):
+        self.total_tokens = total_tokens
+
+class FakeFile:
+    """Stand-in for an uploaded file reference"""
+
+    def __init__(self, file_id, display_name=None, mime_type=None, size_bytes=0, sha256_hash=None):
+        self.name = f"files/{file_id}"
+        self.uri = f"https://fake.local/v1beta/files/{file_id}"
+        self.display_name = display_name or file_id
+        self.mime_type = mime_type or 'application/octet-stream'
+        self.size_bytes = size_bytes
+        self.sha256_hash = sha256_hash
+
+class FakeChunk:
+    def __init__(self, text):
+        self.text = text
+
+class FakeResponse:
+    """A complete or streamed response; streamed chunks arrive at the configured cadence"""
+
+    def __init__(self, text, usage_metadata, stream=False, chunk_chars=0, chunk_delay=0):
+        self.text = text
+        self.usage_metadata = usage_metadata
+        self._stream = stream
+        self._chunk_chars = chunk_chars
+        self._chunk_delay = chunk_delay
+
+    def __iter__(self):
+        if not self._stream:
+            yield FakeChunk(self.text)
+            return
+        for start in range(0, len(self.text), self._chunk_chars):
+            if start:
+                time.sleep(self._chunk_delay)
+            yield FakeChunk(self.text[start:start + self._chunk_chars])
+
+class FakeChat:
+    def __init__(self, model, history=None):
+        self.model = model
+        self.history = list(history or [])
+
+    def send_message(self, content, stream=False):
+        response = self.model.backend.respond(
+            self.model, self.history + [content], self.model.generation_config, stream=stream, kind='chat'
+        )
+        self.history.append(content)
+        return response
+
+class FakeModel:
+    def __init__(self, backend, model_name, generation_config=None, system_instruction=None, **kwargs):
+        self.backend = backend
+        # The SDK reports model names with a 'models/' prefix
+        self.model_name = model_name if model_name.startswith('models/') else f"models/{model_name}"
+        self.generation_config = generation_config or {}
+        self.system_instruction = system_instruction
+
+    def generate_content(self, contents, generation_config=None, stream=False):
+        config = dict(self.generation_config)
+        config.update(generation_config or {})
+        return self.backend.respond(self, contents, config, stream=stream, kind='generate')
+
+    def count_tokens(self, contents):
+        self.backend.record('count_tokens')
+        return FakeTokenCount(estimate_input_tokens(_as_list(contents)))
+
+    def start_chat(self, history=None):
+        return FakeChat(self, history)
+
+def _as_list(contents):
+    return contents if isinstance(contents, list) else [contents]
+
+def _prompt_text(contents):
+    """Concatenate the text parts of request contents (including chat history entries)"""
+    parts = []
+    for part in _as_list(contents):
+        if isinstance(part, str):
+            parts.append(part)
+        elif isinstance(part, dict):
+            parts.append(_prompt_text(part.get('parts', [])))
+    return '\n'.join(parts)
+
+class FakeBackend:
+    """Offline model backend with simulated latency, streaming, token usage and throttling"""
+
+    name = 'fake'
+
+    def __init__(self, latency=None, seconds_per_1k_tokens=None, chunk_chars=None, chunk_delay=None,
+                 error_rate=None, upload_seconds_per_mb=None, guide_units=None, sections_per_unit=None, seed=None):
+        self.latency = model_config.FAKE_MODEL_LATENCY if latency is None else latency
+        self.seconds_per_1k_tokens = (model_config.FAKE_MODEL_SECONDS_PER_1K_TOKENS
+                                      if seconds_per_1k_tokens is None else seconds_per_1k_tokens)
+        self.chunk_chars = chunk_chars or model_config.FAKE_MODEL_STREAM_CHUNK_CHARS
+        self.chunk_delay = model_config.FAKE_MODEL_STREAM_CHUNK_DELAY if chunk_delay is None else chunk_delay
+        self.error_rate = model_config.FAKE_MODEL_ERROR_RATE if error_rate is None else error_rate
+        self.upload_seconds_per_mb = (model_config.FAKE_MODEL_UPLOAD_SECONDS_PER_MB
+                                      if upload_seconds_per_mb is None else upload_seconds_per_mb)
+        self.guide_units = guide_units or model_config.FAKE_MODEL_GUIDE_UNITS
+        self.sections_per_unit = sections_per_unit or model_config.FAKE_MODEL_SECTIONS_PER_UNIT
+        self.random = random.Random(model_config.FAKE_MODEL_SEED if seed is None else seed)
+        self.files = {}
+        self.lock = threading.Lock()
+        self.stats = {'requests': 0, 'errors': 0, 'prompt_tokens': 0, 'output_tokens': 0, 'by_kind': {}}
+
+    def record(self, kind, prompt_tokens=0, output_tokens=0, error=False):
+        with self.lock:
+            self.stats['by_kind'][kind] = self.stats['by_kind'].get(kind, 0) + 1
+            if kind in ('generate', 'chat'):
+                self.stats['requests'] += 1
+            self.stats['errors'] += int(error)
+            self.stats['prompt_tokens'] += prompt_tokens
+            self.stats['output_tokens'] += output_tokens
+
+    def configure(self, api_key):
+        pass
+
+    def upload_file(self, file_path, display_name=None):
+        with open(file_path, 'rb') as f:
+            data = f.read()
+        time.sleep(self.upload_seconds_per_mb * len(data) / (1024 * 1024))
+        digest = hashlib.sha256(data).digest()
+        file_ref = FakeFile(
+            digest.hex()[:12],
+            display_name=display_name or os.path.basename(file_path),
+            mime_type=mimetypes.guess_type(file_path)[0],
+            size_bytes=len(data),
+            sha256_hash=digest
+        )
+        with self.lock:
+            self.files[file_ref.name] = file_ref
+        self.record('upload')
+        return file_ref
+
+    def get_file(self, name):
+        name = name if name.startswith('files/') else f"files/{name}"
+        self.record('get_file')
+        with self.lock:
+            return self.files.get(name) or FakeFile(name.split('/', 1)[1])
+
+    def create_model(self, model_name, **kwargs):
+        return FakeModel(self, model_name, **kwargs)
+
+    def respond(self, model, contents, config, stream=False, kind='generate'):
+        """Simulate one model request and return its response"""
+        prompt_tokens = estimate_input_tokens(_as_list(contents))
+        with self.lock:
+            throttled = self.random.random() < self.error_rate
+            rng = random.Random(self.random.random())
+        if throttled:
+            time.sleep(self.latency / 4)
+            self.record(kind, error=True)
+            raise ResourceExhausted("429 Resource has been exhausted (simulated)")
+
+        text = self._compose(_prompt_text(contents), config or {}, rng)
+        output_tokens = estimate_text_tokens(text)
+        self.record(kind, prompt_tokens, output_tokens)
+        usage = FakeUsage(prompt_tokens, output_tokens)
+
+        # Time to first token, then either the whole generation or the chunk cadence
+        time.sleep(self.latency)
+        if not stream:
+            time.sleep(self.seconds_per_1k_tokens * output_tokens / 1000)
+        return FakeResponse(text, usage, stream=stream, chunk_chars=self.chunk_chars, chunk_delay=self.chunk_delay)
+
+    def _compose(self, prompt, config, rng):
+        """Produce a canned response shaped like what the prompt asks for"""
+        schema = config.get('response_schema') or {}
+        item_properties = (schema.get('items') or {}).get('properties', {}) if isinstance(schema, dict) else {}
+        if 'unit' in item_properties or 'PARTIAL OUTLINES' in prompt:
+            units = self.guide_units
+            match = re.search(r'at most (\d+) units', prompt)
+            if match:
+                units = min(units, int(match.group(1)))
+            return json.dumps(self._guide(units, rng))
+
+        match = re.search(r'(\d+) multiple-choice questions', prompt)
+        if match:
+            return json.dumps(self._quiz(int(match.group(1)), rng))
+
+        return self._sentences(rng, 6)
+
+    def _phrase(self, rng, words):
+        return ' '.join(rng.sample(_WORDS, words))
+
+    def _sentences(self, rng, count):
+        return ' '.join(self._phrase(rng, 14).capitalize() + '.' for _ in range(count))
+
+    def _guide(self, units, rng):
+        return [{
+            'unit': self._phrase(rng, 3).title(),
+            'overview': self._sentences(rng, 3),
+            'sections': [{
+                'section_title': self._phrase(rng, 4).title(),
+                'narrative': self._sentences(rng, 12),
+                'key_points': [self._phrase(rng, 10).capitalize() + '.' for _ in range(4)]
+            } for _ in range(self.sections_per_unit)]
+        } for _ in range(units)]
+
+    def _quiz(self, count, rng):
+        questions = []
+        for _ in range(count):
+            choices = [self._phrase(rng, 4).capitalize() for _ in range(4)]
+            questions.append({
+                'question': f"How does {self._phrase(rng, 3)} affect {self._phrase(rng, 5)}?",
+                'choices': choices,
+                'correct_answer': rng.choice(choices)
+            })
+        return questions
@@ -1,7 +1,14 @@
 import os
 import json
+import hashlib
 from flask import current_app
+import model_config
 from app.services.gemini_service import GeminiService
+from app.helpers.atomic_io import atomic_write_json
+from app.helpers.tracing import span
+from app.helpers.preprocessing import (
+    extract_all_pages, strip_boilerplate, dedupe_documents, is_text_rich, format_compact_text
+)
 
 class FileService:
     """Service class for file operations and storage"""
@@ -30,12 +37,20 @@ class FileService:
             current_app.logger.error(f"Error saving uploaded file: {e}")
             raise
     
+    @staticmethod
+    def get_upload_digest(file):
+        """Get the SHA-256 of an uploaded file's content without consuming its stream"""
+        digest = hashlib.sha256()
+        for block in iter(lambda: file.stream.read(1024 * 1024), b''):
+            digest.update(block)
+        file.stream.seek(0)
+        return digest.hexdigest()
+    
     @staticmethod
     def save_file_uris(file_uris):
         """Save file URIs to file_uris.json"""
         try:
-            with open('file_uris.json', 'w') as f:
-                json.dump(file_uris, f)
+            atomic_write_json(file_uris, 'file_uris.json')
             current_app.logger.info(f"Saved {len(file_uris)} file URIs to file_uris.json")
             return True
         except Exception as e:
@@ -59,7 +74,154 @@ class FileService:
             raise
     
     @staticmethod
-    def upload_files_to_gemini(file_paths, operation_id=None, progress_callback=None):
+    def get_workspace_id(file_uris=None):
+        """Get a stable ID for the set of uploaded files, derived from their URIs"""
+        if file_uris is None:
+            file_uris = FileService.load_file_uris()
+        if not file_uris:
+            return None
+        return hashlib.sha1('\n'.join(sorted(file_uris)).encode('utf-8')).hexdigest()[:16]
+    
+    @staticmethod
+    def dedupe_files(file_paths):
+        """
+        Find near-duplicate documents and pages among uploaded files
+        
+        Text is extracted per page in worker processes, running headers and
+        footers are stripped, and near-duplicate documents and pages of the
+        text-rich files are dropped in favour of one canonical copy. Files
+        without enough extractable text (e.g. scanned PDFs) are not compared.
+        
+        Args:
+            file_paths: List of uploaded file paths
+            
+        Returns:
+            tuple: (kept (page_number, text) lists keyed by path for text-rich files,
+                    page texts to index keyed by path with dropped pages blanked,
+                    list of dropped documents and pages)
+        """
+        try:
+            with span('extract_text', files=len(file_paths)):
+                pages_by_file = extract_all_pages(file_paths)
+                cleaned = {path: strip_boilerplate(pages) for path, pages in pages_by_file.items()}
+            text_rich = [path for path in file_paths if is_text_rich(cleaned[path])]
+            with span('dedupe', files=len(text_rich)) as dedupe_span:
+                deduped, dropped = dedupe_documents({path: cleaned[path] for path in text_rich})
+                dedupe_span.set(dropped=len(dropped))
+            
+            # Blank dropped pages rather than removing them so indexed page numbers stay right
+            index_pages = {}
+            for file_path in file_paths:
+                if file_path not in deduped:
+                    index_pages[file_path] = cleaned[file_path]
+                    continue
+                kept = dict(deduped[file_path])
+                index_pages[file_path] = [kept.get(number, '') for number in range(1, len(cleaned[file_path]) + 1)]
+            return deduped, index_pages, dropped
+        except Exception as e:
+            current_app.logger.error(f"Error finding duplicate files: {e}")
+            raise
+    
+    @staticmethod
+    def get_unique_files(file_paths, deduped):
+        """Get the uploaded files to send as-is, without documents that duplicate other files"""
+        unique_paths = []
+        for file_path in file_paths:
+            if file_path in deduped and not deduped[file_path]:
+                current_app.logger.info(f"Skipping {os.path.basename(file_path)}; it duplicates other uploaded files")
+                continue
+            unique_paths.append(file_path)
+        return unique_paths
+    
+    @staticmethod
+    def preprocess_files(file_paths, deduped):
+        """
+        Write compact text of deduplicated files to upload in place of the originals
+        
+        Files without enough extractable text (e.g. scanned PDFs) are kept
+        as-is so the model can still read their images.
+        
+        Args:
+            file_paths: List of uploaded file paths
+            deduped: Kept pages of the text-rich files, from dedupe_files
+            
+        Returns:
+            tuple: (paths to upload, display names keyed by upload path)
+        """
+        compact_paths = []
+        try:
+            upload_paths = []
+            display_names = {}
+            original_bytes = compact_bytes = 0
+            for file_path in FileService.get_unique_files(file_paths, deduped):
+                filename = os.path.basename(file_path)
+                original_size = os.path.getsize(file_path)
+                original_bytes += original_size
+                
+                if file_path not in deduped:
+                    current_app.logger.info(f"Uploading {filename} as-is; too little extractable text")
+                    upload_paths.append(file_path)
+                    display_names[file_path] = filename
+                    compact_bytes += original_size
+                    continue
+                
+                compact_path = file_path + '.compact.txt'
+                compact_paths.append(compact_path)
+                with open(compact_path, 'w', encoding='utf-8') as f:
+                    f.write(format_compact_text(filename, deduped[file_path]))
+                upload_paths.append(compact_path)
+                display_names[compact_path] = filename
+                compact_bytes += os.path.getsize(compact_path)
+            
+            current_app.logger.info(
+                f"Preprocessed {len(file_paths)} files: {len(deduped)} as text, "
+                f"{original_bytes} -> {compact_bytes} bytes"
+            )
+            return upload_paths, display_names
+        except Exception as e:
+            current_app.logger.error(f"Error preprocessing files: {e}")
+            # The caller uploads the originals instead, so nothing else will delete these
+            for compact_path in compact_paths:
+                if os.path.exists(compact_path):
+                    os.remove(compact_path)
+            raise
+    
+    @staticmethod
+    def save_dedup_report(dropped, preprocessed):
+        """
+        Save the list of near-duplicate documents and pages dropped at upload
+        
+        Args:
+            dropped: Report entries from dedupe_files
+            preprocessed (bool): Whether compact text was uploaded; duplicate pages are
+                                 only left out of the uploads then, and otherwise only
+                                 out of the chat retrieval index
+        """
+        report = {
+            'documents_dropped': sum(1 for entry in dropped if entry['type'] == 'document'),
+            'pages_dropped': sum(1 for entry in dropped if entry['type'] == 'page'),
+            'preprocessed': preprocessed,
+            'dropped': dropped
+        }
+        atomic_write_json(report, model_config.DEDUP_REPORT_FILE, indent=2)
+        return report
+    
+    @staticmethod
+    def clear_dedup_report():
+        """Delete the dedup report of the previous upload"""
+        if os.path.exists(model_config.DEDUP_REPORT_FILE):
+            os.remove(model_config.DEDUP_REPORT_FILE)
+    
+    @staticmethod
+    def load_dedup_report():
+        """Load the dedup report of the current upload, or None"""
+        if not os.path.exists(model_config.DEDUP_REPORT_FILE):
+            return None
+        with open(model_config.DEDUP_REPORT_FILE, 'r') as f:
+            return json.load(f)
+    
+    @staticmethod
+    def upload_files_to_gemini(file_paths, operation_id=None, progress_callback=None, display_names=None):
         """
         Upload files to Gemini and save their URIs
         
@@ -68,6 +230,7 @@ class FileService:
             operation_id: Optional ID for tracking progress
             progress_callback: Optional callback function for tracking progress
                                with signature (filename, index, total)
+            display_names: Optional dict of display names keyed by file path
         """
         try:
             # Upload files and get references
@@ -78,13 +241,13 @@ class FileService:
             
             for index, file_path in enumerate(file_paths):
                 # Extract filename for progress message
-                filename = os.path.basename(file_path)
+                filename = (display_names or {}).get(file_path) or os.path.basename(file_path)
                 
                 # Report progress if callback is provided but don't affect the progress meter
                 if progress_callback and operation_id:
                     progress_callback(filename, index + 1, total_files)
                 
-                file_ref = GeminiService.upload_file(file_path)
+                file_ref = GeminiService.upload_file(file_path, display_name=filename)
                 file_refs.append(file_ref)
                 file_uris.append(file_ref.uri.split('/')[-1])
             
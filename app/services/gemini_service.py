@@ -1,10 +1,26 @@
 import os
-import google.generativeai as genai
+import json
+import time
+import threading
 from flask import current_app
 import model_config
+from app.helpers.token_estimator import get_cached_file_tokens, record_file_tokens, estimate_input_tokens
+from app.helpers.tracing import span, propagate
+from app.helpers.metrics import MODEL_CALLS, MODEL_LATENCY, MODEL_TOKENS, MODEL_ERRORS, STORE_SIZE, record_cache
+from app.services.request_scheduler import scheduler, normalize_model_name, PRIORITY_GENERATION, PRIORITY_INTERACTIVE
+from app.services.model_backends import get_backend, set_backend
+from app.services.usage_service import UsageService
+from app.services.model_router import ModelRouter
+
+# Configured model handles keyed by model name, generation config and system instruction.
+# Handles are stateless between calls and share the SDK's process-wide API client,
+# so they can be reused across threads.
+_model_pool = {}
+_model_pool_lock = threading.Lock()
+STORE_SIZE.set_function(lambda: len(_model_pool), store='model_pool')
 
 class GeminiService:
-    """Service class for interactions with the Gemini API"""
+    """Service class for interactions with the Gemini API (or the configured model backend)"""
     
     @staticmethod
     def configure():
@@ -13,13 +29,22 @@ class GeminiService:
         if not gemini_api_key:
             current_app.logger.warning("GEMINI_API_KEY environment variable not found.")
         else:
-            genai.configure(api_key=gemini_api_key)
+            get_backend().configure(gemini_api_key)
+            GeminiService.clear_model_pool()
+    
+    @staticmethod
+    def use_backend(backend):
+        """Switch to another model backend, dropping handles created by the old one"""
+        set_backend(backend)
+        GeminiService.clear_model_pool()
     
     @staticmethod
-    def upload_file(file_path):
+    def upload_file(file_path, display_name=None):
         """Upload a file to the Gemini API"""
         try:
-            return genai.upload_file(file_path)
+            with span('upload_file', file=display_name or os.path.basename(file_path),
+                      bytes=os.path.getsize(file_path)):
+                return get_backend().upload_file(file_path, display_name=display_name)
         except Exception as e:
             current_app.logger.error(f"Error uploading file to Gemini: {e}")
             raise
@@ -28,19 +53,36 @@ class GeminiService:
     def get_file(file_uri):
         """Get a file reference from Gemini by URI"""
         try:
-            return genai.get_file(file_uri)
+            with span('get_file', file=file_uri):
+                return get_backend().get_file(file_uri)
         except Exception as e:
             current_app.logger.error(f"Error retrieving file from Gemini: {e}")
             raise
     
     @staticmethod
     def create_model(model_name, **kwargs):
-        """Create a new generative model instance"""
-        try:
-            return genai.GenerativeModel(model_name=model_name, **kwargs)
-        except Exception as e:
-            current_app.logger.error(f"Error creating Gemini model: {e}")
-            raise
+        """Get a pooled generative model instance, creating it on first use"""
+        # Workspaces over their budget are switched to a cheaper model
+        model_name = UsageService.choose_model(model_name)
+        key = (model_name, json.dumps(kwargs, sort_keys=True, default=str))
+        with _model_pool_lock:
+            model = _model_pool.get(key)
+            record_cache('model_pool', model is not None)
+            if model is not None:
+                return model
+            try:
+                model = get_backend().create_model(model_name, **kwargs)
+            except Exception as e:
+                current_app.logger.error(f"Error creating Gemini model: {e}")
+                raise
+            _model_pool[key] = model
+            return model
+
+    @staticmethod
+    def clear_model_pool():
+        """Drop all pooled model handles, e.g. after the API key changes"""
+        with _model_pool_lock:
+            _model_pool.clear()
     
     @staticmethod
     def create_json_model(model_name, schema=None):
@@ -56,14 +98,14 @@ class GeminiService:
         )
     
     @staticmethod
-    def start_chat_session(model_name, system_instruction=None):
-        """Start a new chat session with the given model and system instruction"""
+    def start_chat_session(model_name, system_instruction=None, history=None):
+        """Start a new chat session with the given model, system instruction and optional history"""
         try:
             chat_model = GeminiService.create_model(
                 model_name=model_name,
                 system_instruction=system_instruction
             )
-            return chat_model.start_chat(history=[])
+            return chat_model.start_chat(history=history or [])
         except Exception as e:
             current_app.logger.error(f"Error starting chat session: {e}")
             raise
@@ -71,12 +113,94 @@ class GeminiService:
     @staticmethod
     def count_tokens(content):
         """Count the tokens in the given content"""
-        temp_model = GeminiService.create_model(model_config.DEFAULT_STUDY_GUIDE_MODEL)
-        return temp_model.count_tokens(content)
+        count_model = GeminiService.create_model(model_config.DEFAULT_STUDY_GUIDE_MODEL)
+        return count_model.count_tokens(content)
+
+    @staticmethod
+    def count_tokens_in_background(input_list, callback=None):
+        """
+        Count the exact tokens of an input list on a background thread
+
+        Files are counted individually so their counts can be cached per digest;
+        files counted before are not sent again.
+
+        Args:
+            input_list: List of text parts and file references
+            callback: Optional function called with the total token count
+        """
+        app = current_app._get_current_object()
+        
+        def worker():
+            with app.app_context(), span('count_tokens', model=model_config.DEFAULT_STUDY_GUIDE_MODEL):
+                try:
+                    total_tokens = 0
+                    text_parts = []
+                    for part in input_list:
+                        if isinstance(part, str):
+                            text_parts.append(part)
+                            continue
+                        file_tokens = get_cached_file_tokens(part)
+                        if file_tokens is None:
+                            file_tokens = GeminiService.count_tokens([part]).total_tokens
+                            record_file_tokens(part, file_tokens)
+                        total_tokens += file_tokens
+                    
+                    if text_parts:
+                        total_tokens += GeminiService.count_tokens(''.join(text_parts)).total_tokens
+                    
+                    if callback:
+                        callback(total_tokens)
+                except Exception as e:
+                    app.logger.warning(f"Error counting tokens in background: {e}")
+        
+        thread = threading.Thread(target=propagate(worker))
+        thread.daemon = True
+        thread.start()
+
+    @staticmethod
+    def record_usage(model_name, response, call_span=None):
+        """
+        Count a response's token usage in the metrics, the usage ledger and on its model call span
+
+        Streamed responses only carry usage once fully consumed, so callers
+        that stream record it themselves after the last chunk.
+        """
+        usage = getattr(response, 'usage_metadata', None)
+        if usage is None:
+            return
+        model_name = normalize_model_name(model_name)
+        input_tokens = getattr(usage, 'prompt_token_count', None)
+        output_tokens = getattr(usage, 'candidates_token_count', None)
+        if input_tokens is not None:
+            MODEL_TOKENS.inc(input_tokens, model=model_name, direction='input')
+            if call_span:
+                call_span.set(input_tokens=input_tokens)
+        if output_tokens is not None:
+            MODEL_TOKENS.inc(output_tokens, model=model_name, direction='output')
+            if call_span:
+                call_span.set(output_tokens=output_tokens)
+        if input_tokens is not None or output_tokens is not None:
+            cost = UsageService.record(model_name, input_tokens, output_tokens)
+            if call_span:
+                call_span.set(cost=cost)
+
+    @staticmethod
+    def _observe_call(model_name, kind, started, error=None):
+        """Record a model call's latency and outcome in the metrics"""
+        model_name = normalize_model_name(model_name)
+        seconds = time.perf_counter() - started
+        MODEL_LATENCY.observe(seconds, model=model_name, kind=kind)
+        if kind == 'generate':
+            # Generation latency and failures drive fallback routing
+            ModelRouter.record(model_name, seconds, error)
+        MODEL_CALLS.inc(model=model_name, kind=kind, outcome='error' if error else 'ok')
+        if error:
+            MODEL_ERRORS.inc(model=model_name, error=type(error).__name__)
 
     @staticmethod
-    def generate_content(model, content, schema=None):
-        """Generate content using the specified model"""
+    def generate_content(model, content, schema=None, priority=PRIORITY_GENERATION):
+        """Generate content using the specified model, rate limited and retried by the scheduler"""
+        started = time.perf_counter()
         try:
             config = {}
             if schema:
@@ -85,11 +209,54 @@ class GeminiService:
                     'response_schema': schema
                 }
                 
-            return model.generate_content(content, generation_config=config)
+            estimated_tokens = estimate_input_tokens(content)
+            with span('model_call', model=normalize_model_name(model.model_name), kind='generate',
+                      input_tokens=estimated_tokens, priority=priority) as call_span:
+                response = scheduler.execute(
+                    model.model_name,
+                    lambda: model.generate_content(content, generation_config=config),
+                    estimated_tokens=estimated_tokens,
+                    priority=priority
+                )
+                GeminiService._observe_call(model.model_name, 'generate', started)
+                GeminiService.record_usage(model.model_name, response, call_span)
+                return response
         except Exception as e:
             current_app.logger.error(f"Error generating content: {e}")
+            GeminiService._observe_call(model.model_name, 'generate', started, error=e)
             raise
 
-# Create an init file to make the services directory a package
-with open(os.path.join(os.path.dirname(__file__), '__init__.py'), 'w') as f:
-    f.write('# This file makes the services directory a Python package')
\ No newline at end of file
+    @staticmethod
+    def send_chat_message(chat, content, estimated_tokens=None, stream=True, priority=PRIORITY_INTERACTIVE):
+        """
+        Send a message in a chat session, rate limited and retried by the scheduler
+
+        Args:
+            chat: Chat session from start_chat_session
+            content: Message to send
+            estimated_tokens (int, optional): Estimated input tokens including history;
+                                              defaults to an estimate of the message alone
+            stream (bool): Whether to stream the response
+            priority (int): Scheduler priority, interactive by default
+        """
+        started = time.perf_counter()
+        try:
+            if estimated_tokens is None:
+                estimated_tokens = estimate_input_tokens(content)
+            # Streamed responses report usage only once consumed, so the span keeps the estimate
+            with span('model_call', model=normalize_model_name(chat.model.model_name), kind='chat',
+                      input_tokens=estimated_tokens, priority=priority, stream=stream) as call_span:
+                response = scheduler.execute(
+                    chat.model.model_name,
+                    lambda: chat.send_message(content, stream=stream),
+                    estimated_tokens=estimated_tokens,
+                    priority=priority
+                )
+                GeminiService._observe_call(chat.model.model_name, 'chat', started)
+                if not stream:
+                    GeminiService.record_usage(chat.model.model_name, response, call_span)
+                return response
+        except Exception as e:
+            current_app.logger.error(f"Error sending chat message: {e}")
+            GeminiService._observe_call(chat.model.model_name, 'chat', started, error=e)
+            raise
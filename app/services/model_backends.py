@@ -0,0 +1,96 @@
+"""
+Model backends for StudyLM
+GeminiService talks to models through a backend so the rest of the app does
+not depend on google.generativeai directly. The live Gemini API is the
+default; an offline stand-in (see fake_backend.py) can be selected with the
+STUDYLM_MODEL_BACKEND environment variable for benchmarks and development,
+and either can be recorded to or replayed from a cassette (see
+cassette_backend.py) by setting STUDYLM_CASSETTE.
+
+A backend provides:
+    configure(api_key)                        Set up credentials
+    upload_file(path, display_name=None)      Upload a file, returning a file reference
+    get_file(name)                            Look up an uploaded file reference
+    create_model(model_name, **kwargs)        Create a model handle exposing model_name,
+                                              generate_content, count_tokens and start_chat
+"""
+
+import threading
+import model_config
+
+_backend = None
+_backend_lock = threading.Lock()
+
+class GeminiBackend:
+    """
+    Backend for the live Gemini API via google.generativeai
+
+    The SDK (and the gRPC and protobuf stack under it) takes around half a
+    second to import, so it is loaded on the first model call rather than when
+    the app starts; configure only stores the key until then.
+    """
+
+    name = 'gemini'
+
+    def __init__(self):
+        self._genai = None
+        self._api_key = None
+        self._lock = threading.Lock()
+
+    @property
+    def genai(self):
+        """The configured google.generativeai module, imported on first use"""
+        if self._genai is None:
+            with self._lock:
+                if self._genai is None:
+                    import google.generativeai as genai
+                    if self._api_key:
+                        self._configure(genai)
+                    self._genai = genai
+        return self._genai
+
+    def _configure(self, genai):
+        # One process-wide client (and its keep-alive connection) is shared by all models
+        genai.configure(api_key=self._api_key, transport=model_config.GEMINI_TRANSPORT)
+
+    def configure(self, api_key):
+        with self._lock:
+            self._api_key = api_key
+            if self._genai is not None:
+                self._configure(self._genai)
+
+    def upload_file(self, file_path, display_name=None):
+        return self.genai.upload_file(file_path, display_name=display_name)
+
+    def get_file(self, name):
+        return self.genai.get_file(name)
+
+    def create_model(self, model_name, **kwargs):
+        return self.genai.GenerativeModel(model_name=model_name, **kwargs)
+
+def create_backend(name):
+    """Create a backend by name ('gemini' or 'fake')"""
+    if name == GeminiBackend.name:
+        return GeminiBackend()
+    if name == 'fake':
+        from app.services.fake_backend import FakeBackend
+        return FakeBackend()
+    raise ValueError(f"Unknown model backend: {name}")
+
+def get_backend():
+    """Get the process-wide model backend, creating the configured one on first use"""
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            if model_config.MODEL_CASSETTE:
+                from app.services.cassette_backend import create_cassette_backend
+                _backend = create_cassette_backend(lambda: create_backend(model_config.MODEL_BACKEND))
+            else:
+                _backend = create_backend(model_config.MODEL_BACKEND)
+        return _backend
+
+def set_backend(backend):
+    """Replace the process-wide model backend (e.g. a configured FakeBackend in benchmarks)"""
+    global _backend
+    with _backend_lock:
+        _backend = backend
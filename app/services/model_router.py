@@ -0,0 +1,142 @@
+"""
+Model routing for StudyLM generation sub-tasks
+Study guide structure, per-file outlines, section quizzes, unit assessments
+and full quizzes are mapped to models by the MODEL_ROUTES policy in
+model_config instead of one hard-wired model per feature: small requests go
+to a faster model, and a task moves to its fallback model while the chosen
+one is throttled, congested, failing or slow.
+
+Health comes from a sliding window of recent generation calls per model (fed
+by GeminiService) and from the request scheduler's per-model limiters.
+"""
+
+import time
+import threading
+from collections import deque
+from flask import current_app
+import model_config
+from app.helpers.tracing import current_span
+from app.helpers.metrics import MODEL_ROUTES
+from app.services.request_scheduler import scheduler, normalize_model_name
+
+# Recent (finished at, seconds, failed) generation calls keyed by model name
+_samples = {}
+_samples_lock = threading.Lock()
+
+# Routing decision counts keyed by (task, model, reason)
+_decisions = {}
+
+def _percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+class ModelRouter:
+    """Service class that picks the model for each generation sub-task"""
+
+    @staticmethod
+    def record(model_name, seconds, error=None):
+        """Add one finished generation call to its model's recent history"""
+        model_name = normalize_model_name(model_name)
+        with _samples_lock:
+            samples = _samples.get(model_name)
+            if samples is None:
+                samples = _samples[model_name] = deque(maxlen=model_config.ROUTING_STATS_MAX_SAMPLES)
+            samples.append((time.monotonic(), seconds, error is not None))
+
+    @staticmethod
+    def get_model_stats(model_name):
+        """
+        Recent health of a model
+
+        Returns:
+            dict: Calls in the window, p50/p95 latency of successful calls in seconds,
+                  error rate, whether it was recently throttled and its queue depth
+        """
+        model_name = normalize_model_name(model_name)
+        cutoff = time.monotonic() - model_config.ROUTING_STATS_WINDOW_SECONDS
+        with _samples_lock:
+            recent = [sample for sample in _samples.get(model_name, ()) if sample[0] >= cutoff]
+        latencies = [seconds for _, seconds, failed in recent if not failed]
+        limiter = scheduler.get_limiter(model_name)
+        return {
+            'calls': len(recent),
+            'p50_seconds': round(_percentile(latencies, 0.5), 3) if latencies else None,
+            'p95_seconds': round(_percentile(latencies, 0.95), 3) if latencies else None,
+            'error_rate': round(sum(failed for _, _, failed in recent) / len(recent), 3) if recent else 0.0,
+            'throttled': limiter.recently_throttled(model_config.ROUTING_THROTTLE_COOLDOWN_SECONDS),
+            'queue_depth': limiter.queue_depth()
+        }
+
+    @staticmethod
+    def _unhealthy_reason(model_name, max_p95_seconds):
+        """Why a model should be avoided right now, or None if it is healthy"""
+        stats = ModelRouter.get_model_stats(model_name)
+        if stats['throttled']:
+            return 'throttled'
+        if stats['queue_depth'] >= model_config.ROUTING_MAX_QUEUE_DEPTH:
+            return 'congested'
+        if stats['calls'] >= model_config.ROUTING_MIN_SAMPLES:
+            if stats['error_rate'] > model_config.ROUTING_MAX_ERROR_RATE:
+                return 'errors'
+            if max_p95_seconds and stats['p95_seconds'] is not None and stats['p95_seconds'] > max_p95_seconds:
+                return 'slow'
+        return None
+
+    @staticmethod
+    def route(task, input_tokens=0, questions=None):
+        """
+        Pick the model for a generation sub-task
+
+        Args:
+            task (str): Key of MODEL_ROUTES, e.g. 'structure', 'section_quiz' or 'quiz'
+            input_tokens (int): Estimated input tokens of the request
+            questions (int, optional): Number of questions requested, for quiz tasks
+
+        Returns:
+            str: Name of the model to call
+        """
+        policy = model_config.MODEL_ROUTES[task]
+        model_name, fallback, reason = policy['model'], policy.get('fallback'), 'primary'
+
+        small = policy.get('small')
+        if small and input_tokens <= small.get('max_input_tokens', input_tokens) \
+                and (questions is None or questions <= small.get('max_questions', questions)):
+            model_name, fallback, reason = small['model'], policy['model'], 'small'
+
+        if model_config.MODEL_ROUTING_ADAPTIVE and fallback and fallback != model_name:
+            max_p95_seconds = policy.get('max_p95_seconds')
+            unhealthy = ModelRouter._unhealthy_reason(model_name, max_p95_seconds)
+            # Only switch when the fallback is not in the same trouble
+            if unhealthy and not ModelRouter._unhealthy_reason(fallback, max_p95_seconds):
+                current_app.logger.info(f"Routing {task} to {fallback}: {model_name} is {unhealthy}")
+                model_name, reason = fallback, f"fallback_{unhealthy}"
+
+        MODEL_ROUTES.inc(task=task, model=model_name, reason=reason)
+        key = (task, model_name, reason)
+        with _samples_lock:
+            _decisions[key] = _decisions.get(key, 0) + 1
+        current_span().set(routed_model=model_name, route=reason)
+        return model_name
+
+    @staticmethod
+    def get_report():
+        """
+        The routing policy with the current health of its models and the decisions made so far
+
+        Returns:
+            dict: 'routes', 'models' (stats per model) and 'decisions' (per task)
+        """
+        models = set()
+        for policy in model_config.MODEL_ROUTES.values():
+            models.update(filter(None, (policy['model'], policy.get('fallback'), policy.get('small', {}).get('model'))))
+        with _samples_lock:
+            decisions = dict(_decisions)
+        by_task = {}
+        for (task, model_name, reason), count in sorted(decisions.items()):
+            by_task.setdefault(task, []).append({'model': model_name, 'reason': reason, 'count': count})
+        return {
+            'adaptive': model_config.MODEL_ROUTING_ADAPTIVE,
+            'routes': model_config.MODEL_ROUTES,
+            'models': {model_name: ModelRouter.get_model_stats(model_name) for model_name in sorted(models)},
+            'decisions': by_task
+        }
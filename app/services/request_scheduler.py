@@ -0,0 +1,224 @@
+import time
+import heapq
+import random
+import itertools
+import threading
+from flask import current_app
+import model_config
+from app.helpers.tracing import current_span
+from app.helpers.metrics import MODEL_RETRIES, MODEL_QUEUE_WAIT, STORE_SIZE
+
+# Request priorities (lower runs first)
+PRIORITY_INTERACTIVE = 0
+PRIORITY_GENERATION = 1
+PRIORITY_BACKGROUND = 2
+
+# HTTP status codes and exception names that indicate a transient failure
+RETRYABLE_STATUS_CODES = {429, 500, 503, 504}
+RETRYABLE_ERROR_NAMES = {
+    'ResourceExhausted', 'TooManyRequests', 'ServiceUnavailable',
+    'InternalServerError', 'DeadlineExceeded', 'ConnectionError', 'TimeoutError'
+}
+THROTTLE_STATUS_CODES = {429}
+THROTTLE_ERROR_NAMES = {'ResourceExhausted', 'TooManyRequests'}
+
+def _status_code(error):
+    code = getattr(error, 'code', None)
+    if callable(code):
+        code = code()
+    return code if isinstance(code, int) else None
+
+def is_retryable(error):
+    """Whether an error from the model API is worth retrying"""
+    return _status_code(error) in RETRYABLE_STATUS_CODES or type(error).__name__ in RETRYABLE_ERROR_NAMES
+
+def is_throttled(error):
+    """Whether an error means we are sending requests too fast"""
+    return _status_code(error) in THROTTLE_STATUS_CODES or type(error).__name__ in THROTTLE_ERROR_NAMES
+
+def normalize_model_name(model_name):
+    """Strip the 'models/' prefix the SDK adds to model names"""
+    if model_name and model_name.startswith('models/'):
+        return model_name[len('models/'):]
+    return model_name
+
+class TokenBucket:
+    """Token bucket refilled continuously at a fixed rate (caller holds the lock)"""
+
+    def __init__(self, capacity, refill_per_second):
+        self.capacity = capacity
+        self.refill_per_second = refill_per_second
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, scale):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.refill_per_second * scale)
+        self.updated = now
+
+    def wait_time(self, amount, scale=1.0):
+        """Seconds until `amount` tokens are available (0 if available now)"""
+        self._refill(scale)
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0
+        return (amount - self.tokens) / (self.refill_per_second * scale)
+
+    def consume(self, amount):
+        self.tokens -= min(amount, self.capacity)
+
+class ModelLimiter:
+    """RPM/TPM limits for one model with priority-ordered waiting and adaptive rate"""
+
+    def __init__(self, rpm, tpm):
+        self.requests = TokenBucket(rpm, rpm / 60.0)
+        self.tokens = TokenBucket(tpm, tpm / 60.0)
+        # Multiplier on the refill rates, cut on throttling and slowly restored on success
+        self.rate_scale = 1.0
+        # Monotonic time of the last rate limit error, for model routing
+        self.throttled_at = None
+        self.condition = threading.Condition()
+        self.waiters = []
+        self._sequence = itertools.count()
+
+    def acquire(self, tokens, priority):
+        """Block until this request may be sent; returns the seconds spent waiting"""
+        started = time.monotonic()
+        with self.condition:
+            entry = (priority, next(self._sequence))
+            heapq.heappush(self.waiters, entry)
+            try:
+                while True:
+                    if self.waiters[0] == entry:
+                        delay = max(
+                            self.requests.wait_time(1, self.rate_scale),
+                            self.tokens.wait_time(tokens, self.rate_scale)
+                        )
+                        if delay == 0:
+                            self.requests.consume(1)
+                            self.tokens.consume(tokens)
+                            return time.monotonic() - started
+                        self.condition.wait(timeout=min(delay, 1.0))
+                    else:
+                        self.condition.wait(timeout=1.0)
+            finally:
+                self.waiters.remove(entry)
+                heapq.heapify(self.waiters)
+                self.condition.notify_all()
+
+    def queue_depth(self):
+        with self.condition:
+            return len(self.waiters)
+
+    def on_success(self):
+        with self.condition:
+            self.rate_scale = min(1.0, self.rate_scale + model_config.SCHEDULER_RATE_RECOVERY_STEP)
+
+    def on_throttled(self):
+        with self.condition:
+            self.rate_scale = max(model_config.SCHEDULER_MIN_RATE_SCALE, self.rate_scale / 2)
+            self.throttled_at = time.monotonic()
+
+    def recently_throttled(self, seconds):
+        """Whether the model returned a rate limit error in the last `seconds`"""
+        with self.condition:
+            return self.throttled_at is not None and time.monotonic() - self.throttled_at < seconds
+
+class RetryBudget:
+    """Caps retries to a fraction of successful requests so outages don't snowball"""
+
+    def __init__(self, ratio, max_tokens):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self.tokens = max_tokens
+        self.lock = threading.Lock()
+
+    def record_success(self):
+        with self.lock:
+            self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def try_spend(self):
+        with self.lock:
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+class RequestScheduler:
+    """Central scheduler that rate limits, prioritizes and retries model calls"""
+
+    def __init__(self):
+        self._limiters = {}
+        self._limiters_lock = threading.Lock()
+        self.retry_budget = RetryBudget(model_config.SCHEDULER_RETRY_BUDGET_RATIO, model_config.SCHEDULER_RETRY_BUDGET_MAX)
+
+    def get_limiter(self, model_name):
+        model_name = normalize_model_name(model_name)
+        with self._limiters_lock:
+            limiter = self._limiters.get(model_name)
+            if limiter is None:
+                limits = model_config.MODEL_RATE_LIMITS.get(model_name, model_config.DEFAULT_RATE_LIMIT)
+                limiter = ModelLimiter(limits['rpm'], limits['tpm'])
+                self._limiters[model_name] = limiter
+            return limiter
+
+    def queue_depth(self):
+        """Number of requests currently waiting for a rate limit slot"""
+        with self._limiters_lock:
+            limiters = list(self._limiters.values())
+        return sum(limiter.queue_depth() for limiter in limiters)
+
+    def execute(self, model_name, call, estimated_tokens=0, priority=PRIORITY_GENERATION):
+        """
+        Run a model call under the model's rate limits, retrying transient errors
+
+        Args:
+            model_name: Name of the model being called
+            call: Zero-argument function that performs the request
+            estimated_tokens: Estimated input tokens, charged against the TPM limit
+            priority: One of the PRIORITY_* constants
+
+        Returns:
+            The result of `call`
+        """
+        limiter = self.get_limiter(model_name)
+        metric_model = normalize_model_name(model_name)
+        call_span = current_span()
+        attempt = 0
+        while True:
+            waited = limiter.acquire(estimated_tokens, priority)
+            call_span.add('queue_wait', waited)
+            MODEL_QUEUE_WAIT.observe(waited, model=metric_model)
+            if waited > 1:
+                current_app.logger.info(f"Waited {waited:.1f}s for a rate limit slot on {model_name}")
+            try:
+                result = call()
+            except Exception as e:
+                if not is_retryable(e):
+                    raise
+                throttled = is_throttled(e)
+                if throttled:
+                    limiter.on_throttled()
+                if attempt >= model_config.SCHEDULER_MAX_RETRIES or not self.retry_budget.try_spend():
+                    current_app.logger.error(f"Giving up on {model_name} after {attempt + 1} attempts: {e}")
+                    raise
+                # Exponential backoff with full jitter
+                backoff = min(model_config.SCHEDULER_MAX_BACKOFF, model_config.SCHEDULER_BASE_BACKOFF * (2 ** attempt))
+                delay = random.uniform(0, backoff)
+                attempt += 1
+                call_span.add('retries', 1)
+                call_span.add('backoff', delay)
+                MODEL_RETRIES.inc(model=metric_model, reason='throttled' if throttled else 'transient')
+                current_app.logger.warning(
+                    f"Transient error from {model_name} ({e}); retry {attempt} in {delay:.1f}s"
+                )
+                time.sleep(delay)
+                continue
+
+            limiter.on_success()
+            self.retry_budget.record_success()
+            return result
+
+# Shared scheduler for all model calls in this process
+scheduler = RequestScheduler()
+STORE_SIZE.set_function(scheduler.queue_depth, store='scheduler_queue')
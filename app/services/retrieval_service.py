@@ -0,0 +1,289 @@
+import os
+import re
+import json
+import math
+import hashlib
+from threading import Lock
+from collections import Counter, defaultdict
+from flask import current_app
+import model_config
+from app.helpers.text_extraction import extract_pages, normalize_whitespace
+from app.helpers.atomic_io import atomic_write_json
+from app.helpers.metrics import STORE_SIZE, record_cache
+
+# Words too common to help rank passages
+_STOPWORDS = frozenset("""
+a an and are as at be but by for from has have how i if in into is it its of on or
+that the their then there these this to was were what when where which who why will with
+""".split())
+
+# Parsed indexes keyed by workspace ID, reloaded when the file changes on disk
+_index_cache = {}
+_index_cache_lock = Lock()
+STORE_SIZE.set_function(lambda: len(_index_cache), store='retrieval_index_cache')
+
+# Shared sentence-transformers embedder, created on first use
+_sentence_embedder = None
+
+def tokenize(text):
+    """Lowercase word tokens with stopwords removed"""
+    return [t for t in re.findall(r'[a-z0-9]+', text.lower()) if t not in _STOPWORDS]
+
+class HashingEmbedder:
+    """Offline CPU embedder using feature hashing of word unigrams and bigrams"""
+
+    name = 'hashing'
+
+    def __init__(self, dimensions=None):
+        self.dimensions = dimensions or model_config.RETRIEVAL_HASHING_DIMENSIONS
+
+    def embed(self, texts):
+        vectors = []
+        for text in texts:
+            tokens = tokenize(text)
+            features = tokens + [f"{a} {b}" for a, b in zip(tokens, tokens[1:])]
+            vector = [0.0] * self.dimensions
+            for feature in features:
+                digest = hashlib.md5(feature.encode('utf-8')).digest()
+                bucket = int.from_bytes(digest[:4], 'little') % self.dimensions
+                sign = 1.0 if digest[4] & 1 else -1.0
+                vector[bucket] += sign
+            vectors.append(_normalize(vector))
+        return vectors
+
+class SentenceTransformerEmbedder:
+    """Local CPU embedder backed by the optional sentence-transformers package"""
+
+    name = 'sentence-transformers'
+
+    def __init__(self, model_name=None):
+        from sentence_transformers import SentenceTransformer
+        self.model = SentenceTransformer(model_name or model_config.RETRIEVAL_EMBEDDING_MODEL, device='cpu')
+
+    def embed(self, texts):
+        return [list(map(float, v)) for v in self.model.encode(texts, normalize_embeddings=True)]
+
+def _normalize(vector):
+    norm = math.sqrt(sum(v * v for v in vector))
+    if not norm:
+        return vector
+    return [v / norm for v in vector]
+
+def get_embedder(backend=None):
+    """Return the configured embedder, falling back to hashing if it is unavailable"""
+    backend = backend or model_config.RETRIEVAL_EMBEDDING_BACKEND
+    if backend == SentenceTransformerEmbedder.name:
+        # Loading a transformer model is slow, so keep one per process
+        global _sentence_embedder
+        if _sentence_embedder is None:
+            try:
+                _sentence_embedder = SentenceTransformerEmbedder()
+            except ImportError:
+                current_app.logger.warning("sentence-transformers is not installed; using hashing embeddings")
+                return HashingEmbedder()
+        return _sentence_embedder
+    return HashingEmbedder()
+
+class RetrievalService:
+    """Service class for building and querying per-workspace passage indexes"""
+
+    @staticmethod
+    def get_index_path(workspace_id):
+        """Get the on-disk path of the index for a workspace"""
+        return os.path.join(model_config.RETRIEVAL_INDEX_FOLDER, workspace_id, 'index.json')
+
+    @staticmethod
+    def chunk_pages(source, pages, chunk_words=None, overlap_words=None):
+        """
+        Split extracted pages into overlapping word-window chunks
+
+        Args:
+            source: Display name of the file the pages came from
+            pages: List of page texts
+            chunk_words: Approximate words per chunk
+            overlap_words: Words shared between consecutive chunks
+
+        Returns:
+            list: Chunk dicts with 'source', 'page' and 'text'
+        """
+        chunk_words = chunk_words or model_config.RETRIEVAL_CHUNK_WORDS
+        overlap_words = overlap_words if overlap_words is not None else model_config.RETRIEVAL_CHUNK_OVERLAP_WORDS
+        step = max(1, chunk_words - overlap_words)
+
+        chunks = []
+        for page_number, page_text in enumerate(pages, start=1):
+            words = normalize_whitespace(page_text).split(' ')
+            words = [w for w in words if w]
+            for start in range(0, len(words), step):
+                window = words[start:start + chunk_words]
+                if not window:
+                    break
+                chunks.append({
+                    'source': source,
+                    'page': page_number,
+                    'text': ' '.join(window)
+                })
+                if start + chunk_words >= len(words):
+                    break
+        return chunks
+
+    @staticmethod
+    def build_index(file_paths, workspace_id, pages_by_file=None):
+        """
+        Extract, chunk and index local study files for a workspace
+
+        Args:
+            file_paths: Paths of the uploaded files, read before they are deleted
+            workspace_id: ID of the workspace the files belong to
+            pages_by_file: Optional already-extracted page texts keyed by file path
+
+        Files without extractable text (e.g. scanned PDFs) are left out of the
+        index and listed as unindexed, so chat keeps attaching them in full.
+
+        Returns:
+            int: Number of chunks indexed
+        """
+        try:
+            chunks = []
+            indexed_sources = []
+            for file_path in file_paths:
+                if pages_by_file and file_path in pages_by_file:
+                    pages = pages_by_file[file_path]
+                else:
+                    pages = extract_pages(file_path)
+                source = os.path.basename(file_path)
+                file_chunks = RetrievalService.chunk_pages(source, pages)
+                if file_chunks:
+                    indexed_sources.append(source)
+                else:
+                    current_app.logger.info(f"No text extracted from {source}; chat will attach the file instead")
+                chunks.extend(file_chunks)
+
+            if not chunks:
+                current_app.logger.warning("No text extracted from uploaded files; retrieval index not built")
+                return 0
+
+            # Inverted index with term frequencies for BM25
+            postings = defaultdict(list)
+            lengths = []
+            for chunk_index, chunk in enumerate(chunks):
+                terms = tokenize(chunk['text'])
+                lengths.append(len(terms))
+                for term, count in Counter(terms).items():
+                    postings[term].append([chunk_index, count])
+
+            embedder = get_embedder()
+            embeddings = embedder.embed([chunk['text'] for chunk in chunks])
+
+            index = {
+                'workspace_id': workspace_id,
+                'embedder': embedder.name,
+                'sources': indexed_sources,
+                'chunks': chunks,
+                'lengths': lengths,
+                'postings': postings,
+                'embeddings': [[round(v, 5) for v in vector] for vector in embeddings]
+            }
+
+            index_path = RetrievalService.get_index_path(workspace_id)
+            atomic_write_json(index, index_path)
+
+            current_app.logger.info(f"Indexed {len(chunks)} chunks for workspace {workspace_id}")
+            return len(chunks)
+        except Exception as e:
+            current_app.logger.error(f"Error building retrieval index: {e}")
+            raise
+
+    @staticmethod
+    def load_index(workspace_id):
+        """Load a workspace index, using the in-process cache when it is current"""
+        index_path = RetrievalService.get_index_path(workspace_id)
+        if not os.path.exists(index_path):
+            return None
+
+        mtime = os.path.getmtime(index_path)
+        with _index_cache_lock:
+            cached = _index_cache.get(workspace_id)
+        hit = bool(cached) and cached['mtime'] == mtime
+        record_cache('retrieval_index', hit)
+        if hit:
+            return cached['index']
+
+        with open(index_path, 'r') as f:
+            index = json.load(f)
+        lengths = index['lengths']
+        index['avg_length'] = (sum(lengths) / len(lengths)) if lengths else 0
+
+        with _index_cache_lock:
+            _index_cache[workspace_id] = {'mtime': mtime, 'index': index}
+        return index
+
+    @staticmethod
+    def get_indexed_sources(workspace_id):
+        """
+        Get the names of the files that have passages in a workspace index
+
+        Returns:
+            set: File names, empty if the workspace has no index
+        """
+        index = RetrievalService.load_index(workspace_id)
+        if not index:
+            return set()
+        return set(index['sources'])
+
+    @staticmethod
+    def search(workspace_id, query, top_k=None):
+        """
+        Find the passages most relevant to a query with hybrid BM25 and vector scoring
+
+        Returns:
+            list: Up to top_k chunk dicts with an added 'score', best first,
+                  or None if the workspace has no index
+        """
+        index = RetrievalService.load_index(workspace_id)
+        if not index:
+            return None
+
+        top_k = top_k or model_config.RETRIEVAL_TOP_K
+        chunks = index['chunks']
+        lengths = index['lengths']
+        avg_length = index['avg_length'] or 1
+        k1, b = 1.5, 0.75
+
+        # Sparse BM25 scores, only touching chunks that contain a query term
+        bm25 = defaultdict(float)
+        for term in set(tokenize(query)):
+            postings = index['postings'].get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (len(chunks) - len(postings) + 0.5) / (len(postings) + 0.5))
+            for chunk_index, tf in postings:
+                norm = tf + k1 * (1 - b + b * lengths[chunk_index] / avg_length)
+                bm25[chunk_index] += idf * tf * (k1 + 1) / norm
+
+        # Dense cosine scores (vectors are stored normalized)
+        if index['embedder'] == HashingEmbedder.name:
+            embedder = HashingEmbedder(len(index['embeddings'][0]))
+        else:
+            embedder = get_embedder(index['embedder'])
+        query_vector = embedder.embed([query])[0]
+        max_bm25 = max(bm25.values()) if bm25 else 1
+
+        weight = model_config.RETRIEVAL_VECTOR_WEIGHT
+        scored = []
+        for chunk_index, vector in enumerate(index['embeddings']):
+            cosine = sum(q * v for q, v in zip(query_vector, vector))
+            score = (1 - weight) * bm25.get(chunk_index, 0) / max_bm25 + weight * cosine
+            scored.append((score, chunk_index))
+
+        scored.sort(reverse=True)
+        return [dict(chunks[i], score=round(score, 4)) for score, i in scored[:top_k]]
+
+    @staticmethod
+    def format_passages(passages):
+        """Format retrieved passages as a context block for the model"""
+        blocks = [
+            f"[{i}] {p['source']} (page {p['page']}):\n{p['text']}"
+            for i, p in enumerate(passages, start=1)
+        ]
+        return "Relevant excerpts from the study materials:\n\n" + "\n\n".join(blocks)
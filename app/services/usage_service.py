@@ -0,0 +1,283 @@
+"""
+Token and cost accounting for StudyLM
+Every model response's usage metadata is attributed to the operation,
+workspace and pipeline stage that made the call and aggregated per model in
+a local ledger, so reports can show which stage of a guide, quiz or chat
+dominates token use and cost. The ledger is kept in memory and written to its
+file by a background thread at most every USAGE_FLUSH_INTERVAL seconds, so
+model calls never wait on disk I/O.
+
+Code that makes model calls declares what it is doing with `usage_scope`;
+scopes nest and are carried onto worker threads by tracing.propagate.
+"""
+
+import os
+import json
+import time
+import atexit
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+from flask import current_app
+import model_config
+from app.helpers.atomic_io import atomic_write
+from app.services.request_scheduler import normalize_model_name
+
+logger = logging.getLogger(__name__)
+
+_ledger = None
+_ledger_lock = threading.Lock()
+# Whether the ledger has changes not yet written to its file
+_dirty = False
+# Serializes ledger file writes so an older snapshot never replaces a newer one
+_flush_lock = threading.Lock()
+_flusher = None
+
+# (workspace, model) pairs already reported as switched to a cheaper model
+_downgraded = set()
+
+_scope = contextvars.ContextVar('usage_scope', default={})
+
+@contextmanager
+def usage_scope(**fields):
+    """
+    Attribute model usage inside the block to an operation, workspace or stage
+
+    Args:
+        **fields: Any of operation, kind (e.g. 'study_guide'), workspace and stage;
+                  unset fields are inherited from the enclosing scope
+    """
+    fields = {key: value for key, value in fields.items() if value is not None}
+    token = _scope.set(dict(_scope.get(), **fields))
+    try:
+        yield
+    finally:
+        _scope.reset(token)
+
+def get_price(model_name):
+    """USD per million input and output tokens for a model"""
+    return model_config.MODEL_PRICING.get(normalize_model_name(model_name), model_config.DEFAULT_MODEL_PRICING)
+
+def estimate_cost(model_name, input_tokens, output_tokens):
+    """Estimated USD cost of a call at list prices"""
+    price = get_price(model_name)
+    return (input_tokens * price['input'] + output_tokens * price['output']) / 1000000
+
+def _empty_totals():
+    return {'calls': 0, 'input_tokens': 0, 'output_tokens': 0, 'cost': 0.0}
+
+def _add(totals, input_tokens, output_tokens, cost):
+    totals['calls'] += 1
+    totals['input_tokens'] += input_tokens
+    totals['output_tokens'] += output_tokens
+    totals['cost'] = round(totals['cost'] + cost, 6)
+
+def _empty_entry(**fields):
+    return dict(fields, totals=_empty_totals(), by_stage={}, by_model={})
+
+def _add_to_entry(entry, model_name, stage, input_tokens, output_tokens, cost):
+    _add(entry['totals'], input_tokens, output_tokens, cost)
+    _add(entry['by_stage'].setdefault(stage, _empty_totals()), input_tokens, output_tokens, cost)
+    _add(entry['by_model'].setdefault(model_name, _empty_totals()), input_tokens, output_tokens, cost)
+
+class UsageService:
+    """Service class for the per-operation, per-workspace and per-model usage ledger"""
+
+    @staticmethod
+    def _load():
+        """Load the ledger from disk once per process (caller holds the lock)"""
+        global _ledger
+        if _ledger is None:
+            _ledger = {'operations': {}, 'workspaces': {}, 'totals': _empty_entry()}
+            if os.path.exists(model_config.USAGE_LEDGER_FILE):
+                try:
+                    with open(model_config.USAGE_LEDGER_FILE, 'r') as f:
+                        _ledger.update(json.load(f))
+                except (OSError, ValueError) as e:
+                    current_app.logger.warning(f"Could not read usage ledger; starting a new one: {e}")
+        return _ledger
+
+    @staticmethod
+    def record(model_name, input_tokens, output_tokens):
+        """
+        Add one model call's token usage to the ledger under the current scope
+
+        Args:
+            model_name (str): Model that served the call
+            input_tokens (int): Prompt tokens reported by the response
+            output_tokens (int): Output tokens reported by the response
+
+        Returns:
+            float: Estimated cost of the call in USD
+        """
+        global _dirty
+        scope = _scope.get()
+        model_name = normalize_model_name(model_name)
+        input_tokens = input_tokens or 0
+        output_tokens = output_tokens or 0
+        cost = estimate_cost(model_name, input_tokens, output_tokens)
+        stage = scope.get('stage', 'other')
+        operation_id = scope.get('operation')
+        workspace_id = scope.get('workspace')
+
+        try:
+            with _ledger_lock:
+                ledger = UsageService._load()
+                _add_to_entry(ledger['totals'], model_name, stage, input_tokens, output_tokens, cost)
+
+                if operation_id:
+                    operations = ledger['operations']
+                    entry = operations.get(operation_id)
+                    if entry is None:
+                        entry = operations[operation_id] = _empty_entry(
+                            kind=scope.get('kind'), workspace=workspace_id, started=time.time()
+                        )
+                        while len(operations) > model_config.USAGE_MAX_OPERATIONS:
+                            del operations[next(iter(operations))]
+                    if workspace_id and not entry['workspace']:
+                        entry['workspace'] = workspace_id
+                    _add_to_entry(entry, model_name, stage, input_tokens, output_tokens, cost)
+
+                if workspace_id:
+                    entry = ledger['workspaces'].setdefault(workspace_id, _empty_entry())
+                    _add_to_entry(entry, model_name, stage, input_tokens, output_tokens, cost)
+
+                _dirty = True
+            UsageService._start_flusher()
+        except Exception as e:
+            # Accounting must never fail a model call that has already succeeded
+            logger.warning(f"Could not record usage of {model_name}: {e}")
+        return cost
+
+    @staticmethod
+    def _start_flusher():
+        """Start the thread that writes the ledger file in the background, once per process"""
+        global _flusher
+        if _flusher is not None:
+            return
+        with _flush_lock:
+            if _flusher is not None:
+                return
+
+            def run():
+                while True:
+                    time.sleep(model_config.USAGE_FLUSH_INTERVAL)
+                    UsageService.flush()
+
+            _flusher = threading.Thread(target=run, name='usage-ledger-flush', daemon=True)
+            _flusher.start()
+            # Write the last changes when the process exits
+            atexit.register(UsageService.flush)
+
+    @staticmethod
+    def flush():
+        """
+        Write the ledger to its file if it has changed since the last write
+
+        Write errors are logged and the changes are kept for the next attempt.
+
+        Returns:
+            bool: Whether the file was written
+        """
+        global _dirty
+        with _flush_lock:
+            with _ledger_lock:
+                if not _dirty or _ledger is None:
+                    return False
+                payload = json.dumps(_ledger)
+                _dirty = False
+            try:
+                atomic_write(model_config.USAGE_LEDGER_FILE, payload)
+                return True
+            except OSError as e:
+                logger.warning(f"Could not write usage ledger: {e}")
+                with _ledger_lock:
+                    _dirty = True
+                return False
+
+    @staticmethod
+    def get_workspace_cost(workspace_id):
+        """Estimated USD spent so far by a workspace"""
+        with _ledger_lock:
+            entry = UsageService._load()['workspaces'].get(workspace_id)
+            return entry['totals']['cost'] if entry else 0.0
+
+    @staticmethod
+    def choose_model(model_name):
+        """
+        Get the model to call, switching to a cheaper one when the current
+        workspace has used up USAGE_WORKSPACE_BUDGET
+
+        Args:
+            model_name (str): Model the caller asked for
+
+        Returns:
+            str: The model to use
+        """
+        budget = model_config.USAGE_WORKSPACE_BUDGET
+        workspace_id = _scope.get().get('workspace')
+        if budget is None or not workspace_id:
+            return model_name
+
+        fallback = model_config.USAGE_BUDGET_FALLBACK_MODELS.get(normalize_model_name(model_name))
+        if not fallback or UsageService.get_workspace_cost(workspace_id) < budget:
+            return model_name
+
+        if (workspace_id, model_name) not in _downgraded:
+            _downgraded.add((workspace_id, model_name))
+            current_app.logger.warning(
+                f"Workspace {workspace_id} has exceeded its ${budget:.2f} budget; using {fallback} instead of {model_name}"
+            )
+        return fallback
+
+    @staticmethod
+    def _report(entry):
+        """Add each stage's share of cost and tokens and the dominant stage to a ledger entry"""
+        report = json.loads(json.dumps(entry))
+        totals = report['totals']
+        total_tokens = totals['input_tokens'] + totals['output_tokens']
+        stages = []
+        for stage, stage_totals in entry['by_stage'].items():
+            tokens = stage_totals['input_tokens'] + stage_totals['output_tokens']
+            stages.append(dict(
+                stage_totals,
+                stage=stage,
+                cost_share=round(stage_totals['cost'] / totals['cost'], 3) if totals['cost'] else 0,
+                token_share=round(tokens / total_tokens, 3) if total_tokens else 0
+            ))
+        stages.sort(key=lambda stage: (stage['cost'], stage['input_tokens'] + stage['output_tokens']), reverse=True)
+        report['stages'] = stages
+        report['dominant_stage'] = stages[0]['stage'] if stages else None
+        return report
+
+    @staticmethod
+    def get_operation_report(operation_id):
+        """Usage of one operation broken down by stage and model, or None if unknown"""
+        with _ledger_lock:
+            entry = UsageService._load()['operations'].get(operation_id)
+            return UsageService._report(entry) if entry else None
+
+    @staticmethod
+    def get_workspace_report(workspace_id):
+        """
+        Usage of a workspace broken down by stage and model, with its budget
+
+        Returns:
+            dict: The report, or None if the workspace has no recorded usage
+        """
+        with _ledger_lock:
+            ledger = UsageService._load()
+            entry = ledger['workspaces'].get(workspace_id)
+            if not entry:
+                return None
+            report = UsageService._report(entry)
+            report['operations'] = [
+                {'operation_id': operation_id, 'kind': operation['kind'], 'started': operation['started'],
+                 'totals': operation['totals']}
+                for operation_id, operation in ledger['operations'].items()
+                if operation['workspace'] == workspace_id
+            ]
+        report['workspace_id'] = workspace_id
+        report['budget'] = model_config.USAGE_WORKSPACE_BUDGET
+        return report
@@ -0,0 +1,73 @@
+"""
+Benchmark for study guide storage.
+
+Compares the previous pretty-printed JSON full load with compact storage,
+per-unit and per-section loads through the offset index, and cached loads.
+
+Usage (from the project root):
+    python benchmarks/bench_guide_storage.py [--size-mb 8] [--repeat 5]
+"""
+
+import os
+import sys
+import json
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask
+import model_config
+from app.helpers import guide_storage
+from bench_json_utils import make_guide, best_time
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--size-mb', type=float, default=8)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    units, _ = make_guide(int(args.size_mb * 1024 * 1024))
+    middle = len(units) // 2
+
+    with tempfile.TemporaryDirectory() as folder, Flask(__name__).app_context():
+        # Keep the guide's snapshots out of the working directory
+        model_config.ARTIFACT_SNAPSHOT_FOLDER = os.path.join(folder, 'snapshots')
+        pretty_path = os.path.join(folder, 'pretty.json')
+        compact_path = os.path.join(folder, 'output.json')
+        with open(pretty_path, 'w') as f:
+            json.dump(units, f, indent=2)
+        guide_storage.save_study_guide(units, compact_path)
+
+        def full_pretty():
+            with open(pretty_path) as f:
+                json.load(f)
+
+        def clear_cache():
+            guide_storage._cache.clear()
+
+        def uncached(fn):
+            def run():
+                clear_cache()
+                fn()
+            return run
+
+        print(f"Study guide: {len(units)} units; pretty {os.path.getsize(pretty_path) / 1024 / 1024:.1f} MB, "
+              f"compact {os.path.getsize(compact_path) / 1024 / 1024:.1f} MB; best of {args.repeat}")
+        rows = [
+            ("pretty-printed full load", full_pretty),
+            ("compact full load (cold)", uncached(lambda: guide_storage.load_study_guide(compact_path))),
+            ("compact full load (cached)", lambda: guide_storage.load_study_guide(compact_path)),
+            ("single unit (cold)", uncached(lambda: guide_storage.load_study_guide_unit(compact_path, middle))),
+            ("single section (cold)", uncached(lambda: guide_storage.load_study_guide_section(compact_path, middle, 2))),
+            ("single unit (cached)", lambda: guide_storage.load_study_guide_unit(compact_path, middle)),
+        ]
+        for label, fn in rows:
+            fn()
+            print(f"  {label:<32} {best_time(fn, args.repeat) * 1000:9.2f} ms")
+
+        assert guide_storage.load_study_guide_unit(compact_path, middle) == units[middle]
+        assert guide_storage.load_study_guide_section(compact_path, middle, 2) == units[middle]['sections'][2]
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+"""
+Micro-benchmark for JSON extraction from model responses.
+
+Compares the previous substring/regex extraction with the one-pass tolerant
+parser in app.helpers.json_utils on multi-MB study guide responses, both
+complete and truncated, and measures the streaming parser on chunked input.
+
+Usage (from the project root):
+    python benchmarks/bench_json_utils.py [--size-mb 4] [--repeat 5]
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.helpers.json_utils import parse_json_text, JSONArrayStreamParser
+
+WORDS = ("cell membrane energy transfer enzyme catalyst pathway gradient protein "
+         "structure function example analogy process regulation feedback signal").split()
+
+def legacy_extract(text):
+    """The extraction logic json_utils used before the one-pass parser"""
+    if "```json" in text:
+        start_idx = text.find("```json") + 7
+        end_idx = text.find("```", start_idx)
+        if end_idx != -1:
+            text = text[start_idx:end_idx].strip()
+    if not text.strip() or (not "{" in text and not "[" in text):
+        json_match = re.search(r'({[\s\S]*}|\[[\s\S]*\])', text)
+        if json_match:
+            text = json_match.group(1)
+    return json.loads(text)
+
+def make_guide(size_bytes):
+    """Build a study-guide-shaped JSON document of roughly size_bytes"""
+    rng = random.Random(42)
+
+    def sentence(n):
+        return ' '.join(rng.choice(WORDS) for _ in range(n)).capitalize() + '.'
+
+    units = []
+    while True:
+        units.append({
+            'unit': sentence(4),
+            'overview': ' '.join(sentence(15) for _ in range(5)),
+            'sections': [{
+                'section_title': sentence(5),
+                'narrative': '**Key idea:** ' + ' '.join(sentence(20) for _ in range(20)) + ' "quoted" \\ path',
+                'key_points': [sentence(12) for _ in range(4)]
+            } for _ in range(6)]
+        })
+        document = json.dumps(units, indent=2)
+        if len(document) >= size_bytes:
+            return units, document
+
+def best_time(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - started)
+    return min(times)
+
+def run(label, fn, repeat):
+    try:
+        elapsed = best_time(fn, repeat)
+        print(f"  {label:<40} {elapsed * 1000:9.1f} ms")
+    except Exception as e:
+        print(f"  {label:<40} failed: {type(e).__name__}: {str(e)[:60]}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--size-mb', type=float, default=4)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    units, document = make_guide(int(args.size_mb * 1024 * 1024))
+    fenced = f"Here is your study guide:\n```json\n{document}\n```\nLet me know if you need changes."
+    truncated = document[:int(len(document) * 0.9)]
+    chunks = [document[i:i + 4096] for i in range(0, len(document), 4096)]
+
+    print(f"Study guide response: {len(document) / 1024 / 1024:.1f} MB, {len(units)} units, best of {args.repeat}")
+
+    print("Complete, fenced response:")
+    run("legacy extraction", lambda: legacy_extract(fenced), args.repeat)
+    run("parse_json_text", lambda: parse_json_text(fenced), args.repeat)
+    run("json.loads (lower bound)", lambda: json.loads(document), args.repeat)
+
+    print("Truncated response (90%):")
+    run("legacy extraction", lambda: legacy_extract(truncated), args.repeat)
+    run("parse_json_text (prefix recovery)", lambda: parse_json_text(truncated), args.repeat)
+    recovered, complete = parse_json_text(truncated)
+    print(f"  recovered {len(recovered)}/{len(units)} units (complete={complete})")
+
+    print("Streamed in 4 KB chunks:")
+
+    def stream():
+        stream_parser = JSONArrayStreamParser()
+        items = []
+        for chunk in chunks:
+            items.extend(stream_parser.feed(chunk))
+        assert len(items) == len(units)
+
+    run("JSONArrayStreamParser", stream, args.repeat)
+
+if __name__ == '__main__':
+    main()
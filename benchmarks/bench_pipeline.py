@@ -0,0 +1,253 @@
+"""
+End-to-end pipeline benchmark against the offline model backend.
+
+Drives the real Flask routes (upload -> study guide -> quiz -> chat) with the
+fake Gemini stand-in, so it runs on a laptop with no API key or network, and
+reports wall time per stage, model request counts, peak threads and memory.
+
+Usage (from the project root):
+    python benchmarks/bench_pipeline.py [--files 3] [--pages 20] [--latency 0.5]
+        [--error-rate 0.05] [--quiz-questions 30] [--chat-turns 3] [--unthrottled] [--question-bank] [--json]
+        [--cassette run.json --cassette-mode record|replay|auto --cassette-speed 0]
+
+With --cassette the fake backend's traffic is recorded, or an earlier
+recording is replayed (optionally faster than real time) with no model calls.
+
+The question bank is off by default: the upload job would otherwise fill it and
+the quiz stage would be served from the bank without generating anything.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import tempfile
+import threading
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ['STUDYLM_MODEL_BACKEND'] = 'fake'
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+WORDS = ("cell membrane energy transfer enzyme catalyst pathway gradient protein structure function "
+         "example analogy process regulation feedback signal receptor channel diffusion osmosis").split()
+
+class PeakSampler:
+    """Samples the live thread count in the background and keeps the peak"""
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.peak_threads = threading.active_count()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak_threads = max(self.peak_threads, threading.active_count())
+            time.sleep(self.interval)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+def peak_memory_mb():
+    """Peak resident memory of this process, where the platform reports it"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / 1024 / 1024 if sys.platform == 'darwin' else peak / 1024
+
+def make_study_files(folder, files, pages, rng):
+    """Write synthetic multi-page lecture notes; the last file is a revised copy of the first"""
+    documents = []
+    for i in range(files):
+        if i and i == files - 1:
+            # A second version of the first lecture with a few edits, as students often upload
+            documents.append([page.replace('enzyme', 'enzymes', 2) for page in documents[0]])
+            continue
+        documents.append([
+            f"Course Notes Lecture {i + 1}\n" +
+            '\n'.join(' '.join(rng.choice(WORDS) for _ in range(14)).capitalize() + '.' for _ in range(25)) +
+            f"\nPage {p + 1}"
+            for p in range(pages)
+        ])
+
+    paths = []
+    for i, page_texts in enumerate(documents):
+        path = os.path.join(folder, f"lecture_{i + 1}.txt")
+        with open(path, 'w') as f:
+            f.write('\f'.join(page_texts))
+        paths.append(path)
+    return paths
+
+def wait_for(client, url, done, timeout):
+    """Poll a status route until done(payload) or the timeout passes"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        payload = client.get(url).get_json()
+        if done(payload):
+            return payload
+        time.sleep(0.05)
+    raise TimeoutError(f"Timed out waiting for {url}")
+
+def run_upload(client, paths, timeout):
+    files = [(open(path, 'rb'), os.path.basename(path)) for path in paths]
+    try:
+        response = client.post('/upload', data={'files[]': files}, content_type='multipart/form-data')
+    finally:
+        for f, _ in files:
+            f.close()
+    operation_id = response.get_json()['operation_id']
+    status = wait_for(client, f'/generation-status/{operation_id}',
+                      lambda p: p.get('status') in ('complete', 'error'), timeout)
+    if status['status'] == 'error':
+        raise RuntimeError(status.get('messages', [{}])[-1])
+
+def run_quiz(client, question_count, timeout):
+    response = client.post('/generate-quiz', json={'question_count': question_count})
+    generation_id = response.get_json()['generation_id']
+    result = wait_for(client, f'/quiz-status/{generation_id}',
+                      lambda p: p.get('status') in ('complete', 'error'), timeout)
+    if result['status'] == 'error':
+        raise RuntimeError(result.get('message') or result.get('error'))
+    return len(result['quiz']['questions'])
+
+def run_chat_turn(client, message):
+    """Send one chat message and read the SSE stream; returns (first chunk s, total s)"""
+    started = time.monotonic()
+    client.post('/send-chat', json={'message': message})
+    stream = client.get('/send-chat', buffered=False)
+    first_chunk = None
+    for raw in stream.response:
+        line = raw.decode('utf-8') if isinstance(raw, bytes) else raw
+        if not line.startswith('data: '):
+            continue
+        event = json.loads(line[len('data: '):])
+        if 'chunk' in event and first_chunk is None:
+            first_chunk = time.monotonic() - started
+        if event.get('error'):
+            raise RuntimeError(event['error'])
+        if event.get('done'):
+            break
+    stream.close()
+    return first_chunk, time.monotonic() - started
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--files', type=int, default=3)
+    parser.add_argument('--pages', type=int, default=20)
+    parser.add_argument('--latency', type=float, default=None, help="Seconds to first token per request")
+    parser.add_argument('--error-rate', type=float, default=None, help="Fraction of requests answered with a 429")
+    parser.add_argument('--quiz-questions', type=int, default=30)
+    parser.add_argument('--chat-turns', type=int, default=3)
+    parser.add_argument('--unthrottled', action='store_true',
+                        help="Ignore the configured per-model RPM/TPM limits to time the pipeline alone")
+    parser.add_argument('--question-bank', action='store_true',
+                        help="Keep the question bank on, so the quiz stage measures serving from the bank")
+    parser.add_argument('--timeout', type=float, default=600)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', action='store_true', help="Print the report as JSON")
+    parser.add_argument('--cassette', help="Record model calls to, or replay them from, this file")
+    parser.add_argument('--cassette-mode', choices=('record', 'replay', 'auto'), default='record')
+    parser.add_argument('--cassette-speed', type=float, default=1.0, help="Replay speed; 0 replays instantly")
+    args = parser.parse_args()
+
+    cassette_path = os.path.abspath(args.cassette) if args.cassette else None
+
+    # The app reads and writes its state relative to the working directory
+    workdir = tempfile.mkdtemp(prefix='studylm-bench-')
+    os.chdir(workdir)
+
+    import model_config
+    from app import create_app
+    from app.services.gemini_service import GeminiService
+    from app.services.fake_backend import FakeBackend
+    from app.services.cassette_backend import CassetteBackend
+
+    app = create_app()
+    logging.getLogger().setLevel(logging.WARNING)
+    app.logger.setLevel(logging.WARNING)
+
+    model_config.QUESTION_BANK_ENABLED = args.question_bank
+
+    if args.unthrottled:
+        model_config.MODEL_RATE_LIMITS = {}
+        model_config.DEFAULT_RATE_LIMIT = {'rpm': 1000000, 'tpm': 1000000000}
+
+    backend = FakeBackend(latency=args.latency, error_rate=args.error_rate, seed=args.seed)
+    if cassette_path:
+        GeminiService.use_backend(CassetteBackend(
+            cassette_path, mode=args.cassette_mode, speed=args.cassette_speed,
+            inner=None if args.cassette_mode == 'replay' else backend
+        ))
+    else:
+        GeminiService.use_backend(backend)
+
+    paths = make_study_files(app.config['UPLOAD_FOLDER'], args.files, args.pages, random.Random(args.seed))
+    client = app.test_client()
+    stages = {}
+
+    with PeakSampler() as sampler:
+        total_started = time.monotonic()
+
+        started = time.monotonic()
+        run_upload(client, paths, args.timeout)
+        stages['upload_and_guide'] = time.monotonic() - started
+
+        started = time.monotonic()
+        questions = run_quiz(client, args.quiz_questions, args.timeout)
+        stages['quiz'] = time.monotonic() - started
+
+        chat_turns = []
+        for turn in range(args.chat_turns):
+            chat_turns.append(run_chat_turn(client, f"Can you explain the {WORDS[turn]} concept from lecture 1?"))
+        stages['chat'] = sum(total for _, total in chat_turns)
+
+        stages['total'] = time.monotonic() - total_started
+
+    report = {
+        'workdir': workdir,
+        'stages_seconds': {name: round(value, 3) for name, value in stages.items()},
+        'quiz_questions': questions,
+        'chat_first_chunk_seconds': [round(first or 0, 3) for first, _ in chat_turns],
+        'model_requests': backend.stats['requests'],
+        'throttled_requests': backend.stats['errors'],
+        'calls_by_kind': backend.stats['by_kind'],
+        'prompt_tokens': backend.stats['prompt_tokens'],
+        'output_tokens': backend.stats['output_tokens'],
+        'peak_threads': sampler.peak_threads,
+        'peak_memory_mb': round(peak_memory_mb(), 1) if resource else None
+    }
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+
+    limits = 'unthrottled' if args.unthrottled else 'configured rate limits'
+    source = f"cassette {args.cassette_mode}" if cassette_path else 'fake backend'
+    bank = 'question bank on' if args.question_bank else 'question bank off'
+    print(f"StudyLM pipeline benchmark ({args.files} files x {args.pages} pages, {source}, {limits}, {bank})")
+    for name, value in report['stages_seconds'].items():
+        print(f"  {name:<22} {value:8.2f} s")
+    print(f"  quiz questions         {questions}")
+    print(f"  chat first chunk       {', '.join(f'{v:.2f}s' for v in report['chat_first_chunk_seconds'])}")
+    print(f"  model requests         {report['model_requests']} ({report['throttled_requests']} throttled)")
+    print(f"  calls by kind          {report['calls_by_kind']}")
+    print(f"  tokens in / out        {report['prompt_tokens']} / {report['output_tokens']}")
+    print(f"  peak threads           {report['peak_threads']}")
+    print(f"  peak memory            {report['peak_memory_mb']} MB")
+
+if __name__ == '__main__':
+    main()
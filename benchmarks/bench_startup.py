@@ -0,0 +1,148 @@
+"""
+Startup-time benchmark with a regression budget.
+
+Starts fresh interpreters that import the app and call create_app() (with a
+dummy GEMINI_API_KEY, so the live backend is configured), and reports the
+median wall time and the slowest imports from `python -X importtime`.
+
+It fails (exit status 1) if the median startup time exceeds the budget, if a
+module that should only load on the first model call (the Gemini SDK) is
+imported at startup, or if importing the app modifies any file in the source
+tree.
+
+Usage (from the project root):
+    python benchmarks/bench_startup.py [--runs 5] [--budget-ms 400] [--top 15] [--json]
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+STARTUP_CODE = "from app import create_app; create_app()"
+
+# Modules that must not be imported until the first model call
+DEFERRED_MODULES = ('google.generativeai', 'google.ai.generativelanguage', 'grpc')
+
+def source_snapshot():
+    """Modification time and size of every Python file in the source tree"""
+    snapshot = {}
+    for directory in ('app', '.'):
+        base = os.path.join(ROOT, directory)
+        for dirpath, dirnames, filenames in os.walk(base):
+            dirnames[:] = [name for name in dirnames if name != '__pycache__']
+            for filename in filenames:
+                if filename.endswith('.py'):
+                    path = os.path.join(dirpath, filename)
+                    stat = os.stat(path)
+                    snapshot[os.path.relpath(path, ROOT)] = (stat.st_mtime_ns, stat.st_size)
+            if directory == '.':
+                break
+    return snapshot
+
+def run_startup(workdir, importtime=False):
+    """
+    Start one interpreter that creates the app
+
+    Returns:
+        tuple: (wall seconds, stderr text)
+    """
+    env = dict(os.environ, PYTHONPATH=ROOT, GEMINI_API_KEY='startup-benchmark', PYTHONDONTWRITEBYTECODE='1')
+    env.pop('STUDYLM_MODEL_BACKEND', None)
+    env.pop('STUDYLM_CASSETTE', None)
+    command = [sys.executable] + (['-X', 'importtime'] if importtime else []) + ['-c', STARTUP_CODE]
+    started = time.perf_counter()
+    result = subprocess.run(command, cwd=workdir, env=env, capture_output=True, text=True)
+    elapsed = time.perf_counter() - started
+    if result.returncode != 0:
+        raise RuntimeError(f"App startup failed:\n{result.stderr}")
+    return elapsed, result.stderr
+
+def parse_importtime(stderr):
+    """
+    Parse `-X importtime` output
+
+    Returns:
+        dict: Cumulative microseconds keyed by module name
+    """
+    modules = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        try:
+            _, cumulative, name = line[len('import time:'):].split('|')
+            modules[name.strip()] = int(cumulative)
+        except ValueError:
+            continue
+    return modules
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5, help="Timed interpreter starts; the median is reported")
+    parser.add_argument('--budget-ms', type=float, default=400, help="Fail if median startup exceeds this")
+    parser.add_argument('--top', type=int, default=15, help="Number of slowest imports to list")
+    parser.add_argument('--json', action='store_true', help="Print the report as JSON")
+    args = parser.parse_args()
+
+    before = source_snapshot()
+    with tempfile.TemporaryDirectory(prefix='studylm-startup-') as workdir:
+        # Warm the OS file cache so the first timed run is not an outlier
+        run_startup(workdir)
+        timings = [run_startup(workdir)[0] for _ in range(args.runs)]
+        _, stderr = run_startup(workdir, importtime=True)
+    after = source_snapshot()
+
+    modules = parse_importtime(stderr)
+    top_level = {name: micros for name, micros in modules.items() if '.' not in name}
+    slowest = sorted(top_level.items(), key=lambda item: item[1], reverse=True)[:args.top]
+    deferred = [prefix for prefix in DEFERRED_MODULES
+                if any(name == prefix or name.startswith(prefix + '.') for name in modules)]
+    modified = sorted(path for path in set(before) | set(after) if before.get(path) != after.get(path))
+    median_ms = statistics.median(timings) * 1000
+
+    failures = []
+    if median_ms > args.budget_ms:
+        failures.append(f"median startup {median_ms:.0f} ms exceeds the {args.budget_ms:.0f} ms budget")
+    if deferred:
+        failures.append(f"imported at startup but should load lazily: {', '.join(deferred)}")
+    if modified:
+        failures.append(f"source files modified by importing the app: {', '.join(modified)}")
+
+    report = {
+        'runs': args.runs,
+        'median_ms': round(median_ms, 1),
+        'min_ms': round(min(timings) * 1000, 1),
+        'max_ms': round(max(timings) * 1000, 1),
+        'budget_ms': args.budget_ms,
+        'modules_imported': len(modules),
+        'slowest_imports_ms': {name: round(micros / 1000, 1) for name, micros in slowest},
+        'deferred_modules_imported': deferred,
+        'modified_files': modified,
+        'failures': failures
+    }
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print(f"StudyLM startup benchmark ({args.runs} runs, budget {args.budget_ms:.0f} ms)")
+        print(f"  median                 {report['median_ms']:8.1f} ms")
+        print(f"  min / max              {report['min_ms']:.1f} / {report['max_ms']:.1f} ms")
+        print(f"  modules imported       {report['modules_imported']}")
+        print("  slowest imports (cumulative)")
+        for name, millis in report['slowest_imports_ms'].items():
+            print(f"    {name:<28} {millis:8.1f} ms")
+        for failure in failures:
+            print(f"  FAIL: {failure}")
+        if not failures:
+            print("  OK")
+
+    sys.exit(1 if failures else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,35 @@
+"""
+Gunicorn settings for serving StudyLM in production
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+Values come from model_config, so they can be tuned with the STUDYLM_BIND,
+STUDYLM_WORKERS, STUDYLM_THREADS, STUDYLM_TIMEOUT, STUDYLM_GRACEFUL_TIMEOUT,
+STUDYLM_KEEPALIVE and STUDYLM_LOG_LEVEL environment variables.
+"""
+
+import model_config
+
+bind = model_config.SERVER_BIND
+
+# Threaded workers: chat streams (server-sent events) hold a connection open
+# while the model answers, so each one needs its own thread rather than a
+# whole worker process. Keep one worker: chat sessions, stream queues and
+# progress operations are kept in process memory.
+worker_class = 'gthread'
+workers = model_config.SERVER_WORKERS
+threads = model_config.SERVER_THREADS
+
+# With gthread the timeout applies to the worker's heartbeat, not to a single
+# request, so long streams and generation jobs are not cut off by it
+timeout = model_config.SERVER_TIMEOUT
+graceful_timeout = model_config.SERVER_GRACEFUL_TIMEOUT
+keepalive = model_config.SERVER_KEEPALIVE
+
+# Create the app in the worker after forking, so its locks, in-memory stores
+# and model client are never inherited from the master process
+preload_app = False
+
+loglevel = model_config.LOG_LEVEL.lower()
+accesslog = '-'
+errorlog = '-'
@@ -4,13 +4,111 @@ This file contains all model definitions to make it easier to manage and update
 It also contains all prompt templates used by the application.
 """
 
+import os
+
+# Gemini API transport: None for the SDK default (gRPC with a persistent channel) or "rest"
+GEMINI_TRANSPORT = None
+
+# Model backend: "gemini" for the live API, or "fake" for the offline stand-in used by benchmarks
+MODEL_BACKEND = os.getenv("STUDYLM_MODEL_BACKEND", "gemini")
+
+# Record/replay of model calls: a cassette path, "record", "replay" or "auto" (replay, recording misses),
+# replay speed (1 = recorded timing, 0 = instant, 10 = ten times faster) and whether near matches are refused
+MODEL_CASSETTE = os.getenv("STUDYLM_CASSETTE")
+MODEL_CASSETTE_MODE = os.getenv("STUDYLM_CASSETTE_MODE", "replay")
+MODEL_CASSETTE_SPEED = float(os.getenv("STUDYLM_CASSETTE_SPEED", "1"))
+MODEL_CASSETTE_STRICT = os.getenv("STUDYLM_CASSETTE_STRICT", "0") == "1"
+
+# Offline stand-in behaviour (seconds, characters and probabilities), overridable from the environment
+FAKE_MODEL_LATENCY = float(os.getenv("FAKE_MODEL_LATENCY", "0.5"))
+FAKE_MODEL_SECONDS_PER_1K_TOKENS = float(os.getenv("FAKE_MODEL_SECONDS_PER_1K_TOKENS", "0.5"))
+FAKE_MODEL_STREAM_CHUNK_CHARS = int(os.getenv("FAKE_MODEL_STREAM_CHUNK_CHARS", "60"))
+FAKE_MODEL_STREAM_CHUNK_DELAY = float(os.getenv("FAKE_MODEL_STREAM_CHUNK_DELAY", "0.03"))
+FAKE_MODEL_ERROR_RATE = float(os.getenv("FAKE_MODEL_ERROR_RATE", "0"))
+FAKE_MODEL_UPLOAD_SECONDS_PER_MB = float(os.getenv("FAKE_MODEL_UPLOAD_SECONDS_PER_MB", "0.2"))
+FAKE_MODEL_GUIDE_UNITS = int(os.getenv("FAKE_MODEL_GUIDE_UNITS", "4"))
+FAKE_MODEL_SECTIONS_PER_UNIT = int(os.getenv("FAKE_MODEL_SECTIONS_PER_UNIT", "3"))
+FAKE_MODEL_SEED = int(os.getenv("FAKE_MODEL_SEED", "0"))
+
+# Logging level name (DEBUG logs request bodies and every streamed chat chunk)
+LOG_LEVEL = os.getenv("STUDYLM_LOG_LEVEL", "INFO").upper()
+
+# Flask debugger and reloader for the development server in run.py only
+DEBUG = os.getenv("STUDYLM_DEBUG", "0") == "1"
+
+# Production serving with gunicorn (see gunicorn.conf.py), overridable from the environment.
+# Chat sessions, stream queues and progress operations live in process memory, so a single
+# worker process must serve every request; concurrency comes from threads instead. Each open
+# chat stream or progress poll holds a thread (a stream waits up to 180 seconds per message).
+SERVER_BIND = os.getenv("STUDYLM_BIND", "0.0.0.0:8000")
+SERVER_WORKERS = int(os.getenv("STUDYLM_WORKERS", "1"))
+SERVER_THREADS = int(os.getenv("STUDYLM_THREADS", "32"))
+SERVER_TIMEOUT = int(os.getenv("STUDYLM_TIMEOUT", "120"))
+SERVER_GRACEFUL_TIMEOUT = int(os.getenv("STUDYLM_GRACEFUL_TIMEOUT", "30"))
+SERVER_KEEPALIVE = int(os.getenv("STUDYLM_KEEPALIVE", "5"))
+
 # Study Guide Generation Model
 STUDY_GUIDE_MODEL = "gemini-2.5-pro-exp-03-25"
 # STUDY_GUIDE_MODEL = "gemini-2.0-flash"
 
+# Map-reduce study guide generation for very large uploads
+# Above this many input tokens, files are outlined in parallel and merged
+MAP_REDUCE_TOKEN_THRESHOLD = 300000
+MAP_REDUCE_MAX_WORKERS = 4
+# Cheaper text-only model that merges the per-file outlines
+STUDY_GUIDE_REDUCE_MODEL = "gemini-2.5-flash-preview-04-17"
+
+# Attempts per section/unit quiz before it is marked failed (failed quizzes can be resumed)
+GUIDE_TASK_MAX_ATTEMPTS = 2
+
+# Versioned snapshots kept of the study guide for recovery from a bad write, in a folder
+# per artifact (keyed by its relative path) outside the served static tree
+ARTIFACT_SNAPSHOT_KEEP = 3
+ARTIFACT_SNAPSHOT_FOLDER = "snapshots"
+
+# Exact per-file token counts (keyed by file digest) and calibrated estimator ratios
+TOKEN_CACHE_FILE = "token_cache.json"
+
+# Local preprocessing of uploads into compact page-marked text. Off by default: a text-rich
+# PDF is uploaded as its text only, so its figures, diagrams and equation images are lost
+PREPROCESS_UPLOADS = False
+PREPROCESS_MAX_WORKERS = 4
+# Files averaging fewer extracted characters per page (e.g. scanned PDFs) are uploaded as-is
+PREPROCESS_MIN_CHARS_PER_PAGE = 200
+# A header/footer line is boilerplate if it repeats on at least this many pages and this share of them
+BOILERPLATE_MIN_PAGES = 3
+BOILERPLATE_PAGE_FRACTION = 0.5
+# Near-duplicate documents and pages (MinHash over word shingles) are uploaded only once
+DEDUP_SIMILARITY_THRESHOLD = 0.85
+DEDUP_SHINGLE_WORDS = 5
+DEDUP_SIGNATURE_SIZE = 64
+DEDUP_LSH_ROWS = 4
+DEDUP_REPORT_FILE = "dedup_report.json"
+
 # Quiz Generation Model
 QUIZ_MODEL = "gemini-2.5-flash-preview-04-17"
 
+# Extra requests for missing questions when a quiz comes back short after validation
+QUIZ_TOPUP_MAX_ATTEMPTS = 2
+
+# Sharded generation for large full quizzes
+# Quizzes with at least this many questions are split into parallel unit-scoped requests
+QUIZ_SHARD_THRESHOLD = 25
+QUIZ_SHARD_MAX_QUESTIONS = 10
+QUIZ_SHARD_MAX_WORKERS = 4
+# Word overlap (Jaccard) above which two questions count as near-duplicates
+QUIZ_NEAR_DUPLICATE_THRESHOLD = 0.8
+
+# Question bank of generated questions used to serve full quizzes without a model call
+QUESTION_BANK_ENABLED = True
+QUESTION_BANK_FILE = "question_bank.json"
+# Pre-generation keeps at least this many never-served questions in the pool
+QUESTION_BANK_TARGET_UNSERVED = 60
+# Replenishment starts when fewer unserved questions than this remain
+QUESTION_BANK_LOW_WATERMARK = 25
+# Questions generated per unit in each replenishment request
+QUESTION_BANK_BATCH_SIZE = 10
+
 # Chat Models
 CHAT_BASIC_MODEL = "gemini-2.0-flash"
 CHAT_PRO_MODEL = "gemini-2.0-pro-exp-02-05"
@@ -28,6 +126,127 @@ DEFAULT_STUDY_GUIDE_MODEL = STUDY_GUIDE_MODEL
 DEFAULT_QUIZ_MODEL = QUIZ_MODEL
 DEFAULT_CHAT_MODEL = CHAT_BASIC_MODEL
 
+# Model routing for generation sub-tasks that are not given an explicit model.
+# Each task has a primary model, optionally a faster model for small requests (at most
+# max_questions questions and max_input_tokens input tokens), and a fallback. While the
+# chosen model is throttled, queued up, failing or slower than max_p95_seconds, the task
+# moves to the other model (a small request falls back to the task's primary model).
+MODEL_ROUTES = {
+    'structure': {'model': DEFAULT_STUDY_GUIDE_MODEL, 'fallback': QUIZ_MODEL, 'max_p95_seconds': 240},
+    'outline': {'model': DEFAULT_STUDY_GUIDE_MODEL, 'fallback': QUIZ_MODEL, 'max_p95_seconds': 120},
+    'reduce': {'model': STUDY_GUIDE_REDUCE_MODEL, 'fallback': CHAT_BASIC_MODEL, 'max_p95_seconds': 90},
+    'section_quiz': {
+        'model': DEFAULT_QUIZ_MODEL, 'fallback': CHAT_BASIC_MODEL, 'max_p95_seconds': 60,
+        'small': {'model': CHAT_BASIC_MODEL, 'max_questions': 5, 'max_input_tokens': 200000}
+    },
+    'unit_quiz': {'model': DEFAULT_QUIZ_MODEL, 'fallback': CHAT_BASIC_MODEL, 'max_p95_seconds': 90},
+    'quiz': {
+        'model': DEFAULT_QUIZ_MODEL, 'fallback': CHAT_BASIC_MODEL, 'max_p95_seconds': 90,
+        'small': {'model': CHAT_BASIC_MODEL, 'max_questions': 5, 'max_input_tokens': 200000}
+    },
+    'question_bank': {'model': DEFAULT_QUIZ_MODEL, 'fallback': CHAT_BASIC_MODEL, 'max_p95_seconds': 120},
+}
+# Switch to fallbacks based on recent model health; False always uses the static policy above
+MODEL_ROUTING_ADAPTIVE = True
+# Health is judged from generation calls in this window (latency and error rate need a minimum sample)
+ROUTING_STATS_WINDOW_SECONDS = 300
+ROUTING_STATS_MAX_SAMPLES = 200
+ROUTING_MIN_SAMPLES = 5
+ROUTING_MAX_ERROR_RATE = 0.3
+# A model counts as throttled for this long after a rate limit error, and as
+# congested while this many requests are waiting for its rate limit slots
+ROUTING_THROTTLE_COOLDOWN_SECONDS = 60
+ROUTING_MAX_QUEUE_DEPTH = 4
+
+# Token and cost accounting per operation, workspace and model
+USAGE_LEDGER_FILE = "usage_ledger.json"
+# Most seconds between writes of the in-memory ledger to its file
+USAGE_FLUSH_INTERVAL = 5.0
+# Operations kept in the ledger (oldest dropped first); workspace totals are kept in full
+USAGE_MAX_OPERATIONS = 200
+# List prices in USD per million tokens; unlisted models use the default
+MODEL_PRICING = {
+    STUDY_GUIDE_MODEL: {"input": 1.25, "output": 10.0},
+    QUIZ_MODEL: {"input": 0.15, "output": 0.6},
+    CHAT_BASIC_MODEL: {"input": 0.1, "output": 0.4},
+    CHAT_PRO_MODEL: {"input": 1.25, "output": 10.0},
+    CHAT_REASONING_MODEL: {"input": 0.1, "output": 0.4},
+}
+DEFAULT_MODEL_PRICING = {"input": 1.25, "output": 10.0}
+# Optional spend cap per workspace in USD (None disables it); once a workspace
+# has spent this much, its calls switch to the cheaper fallback model
+USAGE_WORKSPACE_BUDGET = None
+USAGE_BUDGET_FALLBACK_MODELS = {
+    STUDY_GUIDE_MODEL: QUIZ_MODEL,
+    CHAT_PRO_MODEL: CHAT_BASIC_MODEL,
+    CHAT_REASONING_MODEL: CHAT_BASIC_MODEL,
+}
+
+# Request scheduling for all model calls
+# Per-model rate limits (requests and input tokens per minute); unlisted models use the default
+MODEL_RATE_LIMITS = {
+    STUDY_GUIDE_MODEL: {"rpm": 5, "tpm": 250000},
+    QUIZ_MODEL: {"rpm": 10, "tpm": 250000},
+    CHAT_BASIC_MODEL: {"rpm": 15, "tpm": 1000000},
+    CHAT_PRO_MODEL: {"rpm": 2, "tpm": 1000000},
+    CHAT_REASONING_MODEL: {"rpm": 10, "tpm": 4000000},
+}
+DEFAULT_RATE_LIMIT = {"rpm": 10, "tpm": 250000}
+# Retries for 429/5xx responses use exponential backoff with full jitter
+SCHEDULER_MAX_RETRIES = 5
+SCHEDULER_BASE_BACKOFF = 2.0
+SCHEDULER_MAX_BACKOFF = 60.0
+# Each success earns this fraction of a retry, up to the maximum banked retries
+SCHEDULER_RETRY_BUDGET_RATIO = 0.2
+SCHEDULER_RETRY_BUDGET_MAX = 10
+# On throttling the send rate is halved (down to this floor) and recovers per success
+SCHEDULER_MIN_RATE_SCALE = 0.125
+SCHEDULER_RATE_RECOVERY_STEP = 0.05
+
+# Span tracing of upload, study guide and quiz operations (see /debug/operations/<id>/trace)
+TRACING_ENABLED = True
+# Finished traces are also written here in Chrome trace format
+TRACE_FOLDER = "traces"
+# Traces kept in memory (oldest dropped first) and spans kept per trace
+TRACE_MAX_OPERATIONS = 50
+TRACE_MAX_SPANS = 5000
+
+# Chat history windowing
+# Estimated tokens of recent turns kept verbatim in each chat request
+CHAT_HISTORY_TOKEN_BUDGET = 8000
+# Always keep at least this many recent turns, even if they exceed the budget
+CHAT_HISTORY_MIN_TURNS = 2
+# Model used to fold evicted turns into the rolling conversation summary
+CHAT_SUMMARY_MODEL = CHAT_BASIC_MODEL
+
+# Hedged chat requests: when a reply's first chunk has not arrived within the recent p95 time
+# to first chunk of its model (clamped to the min/max delay; the default delay is used until
+# enough turns have been timed), a duplicate request is sent to CHAT_HEDGE_MODEL (None for
+# the same model) and whichever starts streaming first is used; the other is cancelled.
+# A user who picked a model other than the default is always hedged with that same model
+CHAT_HEDGING_ENABLED = True
+CHAT_HEDGE_MODEL = None
+CHAT_HEDGE_PERCENTILE = 0.95
+CHAT_HEDGE_MIN_SAMPLES = 20
+CHAT_HEDGE_MAX_SAMPLES = 200
+CHAT_HEDGE_DEFAULT_DELAY = 8.0
+CHAT_HEDGE_MIN_DELAY = 1.0
+CHAT_HEDGE_MAX_DELAY = 20.0
+
+# Local retrieval over uploaded materials
+# When enabled and an index exists, chat sends the top-k passages instead of the full files
+RETRIEVAL_ENABLED = True
+RETRIEVAL_INDEX_FOLDER = "indexes"
+RETRIEVAL_TOP_K = 8
+RETRIEVAL_CHUNK_WORDS = 220
+RETRIEVAL_CHUNK_OVERLAP_WORDS = 40
+# Share of the hybrid score given to vector similarity (the rest is BM25)
+RETRIEVAL_VECTOR_WEIGHT = 0.4
+# "hashing" runs offline with no extra packages; "sentence-transformers" uses a local CPU model
+RETRIEVAL_EMBEDDING_BACKEND = "hashing"
+RETRIEVAL_EMBEDDING_MODEL = "all-MiniLM-L6-v2"
+RETRIEVAL_HASHING_DIMENSIONS = 256
+
 #######################
 # PROMPT TEMPLATES
 #######################
@@ -66,6 +285,27 @@ STUDY_GUIDE_PROMPT = """
 - **Ensure everything is returned in markdown format.**
 """
 
+# Study Guide Map Prompt (one file of a large upload)
+STUDY_GUIDE_MAP_PROMPT = STUDY_GUIDE_PROMPT + """
+**SCOPE:** You are only given one file out of a larger set of course materials. Build the units and sections for this file alone (max 3 units). Another step will merge your outline with the outlines of the other files, so do not add introductions or summaries of material you have not seen.
+"""
+
+# Study Guide Reduce Prompt (merge per-file outlines)
+STUDY_GUIDE_REDUCE_PROMPT = """
+**TASK:** Merge the partial study guide outlines below, each generated from one file of the same course materials, into a single coherent study guide.
+
+**PARTIAL OUTLINES (JSON):**
+{outlines}
+
+**INSTRUCTIONS:**
+- Return a JSON array of at most {max_units} units using exactly the same unit/section structure as the partial outlines ('unit', 'overview', 'sections' with 'section_title', 'narrative', 'key_points').
+- Combine units and sections that cover the same topic across files, keeping the most complete narrative and the most useful key points. Do not drop material that appears in only one file.
+- Order units and sections so that concepts build on each other logically.
+- Rewrite unit overviews so they describe the merged content.
+- Do not invent content that is not present in the partial outlines.
+- **Ensure everything is returned in markdown format.**
+"""
+
 # Quiz Generation Prompt (Quality Focus)
 QUIZ_GENERATION_PROMPT = """
 **TASK:** Generate a high-quality quiz that effectively tests comprehension and ability to apply concepts. The quiz should have {num_questions} multiple-choice questions based *strictly* on the provided study materials{context_str}
@@ -94,6 +334,13 @@ QUIZ_GENERATION_PROMPT = """
 - Ensure 'correct_answer' text matches one of the 'choices' exactly.
 """
 
+# Quiz Top-Up Context (appended when asking for the missing questions only)
+QUIZ_TOPUP_CONTEXT = """
+
+**ALREADY ASKED:** The following questions have already been written. Do not repeat or paraphrase them; cover different concepts:
+{questions}
+"""
+
 # Section Quiz Context Prompt Template (Guidance Focus)
 SECTION_QUIZ_PROMPT_TEMPLATE = """
 **CONTEXT FOR QUIZ GENERATION:** Focus questions on the specific content of section '{section_title}' in unit '{unit_title}'.
@@ -130,4 +377,21 @@ You are StudyLM, an AI learning assistant. Your primary function is to help the
 5.  **Verify Understanding (Subtly):** After a complex explanation, use gentle checks like "Does that explanation clarify things for you?" or "Would walking through an example based on the text be helpful?".
 6.  **Ask for Clarification:** If a user's query is ambiguous, ask for more detail to ensure you provide the most relevant answer based on their materials (e.g., "Which part of the process are you most interested in?", "Could you specify which section you're referring to?").
 7.  **Maintain Helpful Tone:** Be patient, accurate, and supportive.
-"""
\ No newline at end of file
+"""
+
+# Chat History Summary Prompt
+CHAT_SUMMARY_PROMPT = """
+**TASK:** Maintain a running summary of a tutoring conversation between a student and StudyLM about their study materials.
+
+**Previous Summary:**
+{previous_summary}
+
+**New Conversation Turns:**
+{transcript}
+
+**INSTRUCTIONS:**
+- Merge the new turns into the previous summary and return only the updated summary.
+- Keep the topics discussed, the student's questions, misunderstandings that were corrected, and any preferences the student expressed.
+- Drop pleasantries and repeated explanations.
+- Keep the summary under 250 words.
+"""
@@ -1,3 +1,4 @@
+import model_config
 from app import create_app
 
 # Create the application instance
@@ -7,6 +8,7 @@ if __name__ == '__main__':
     # Create static directory if it doesn't exist
     import os
     os.makedirs('static', exist_ok=True)
-    
-    # Run the Flask application
-    app.run(debug=True)
\ No newline at end of file
+
+    # Run the Flask development server (set STUDYLM_DEBUG=1 for the debugger and reloader).
+    # For production, serve wsgi.py with gunicorn: gunicorn -c gunicorn.conf.py wsgi:app
+    app.run(debug=model_config.DEBUG, threaded=True)
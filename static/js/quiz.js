@@ -23,6 +23,7 @@ document.addEventListener('DOMContentLoaded', function() {
     let quizGenerationStatus = 'idle'; // 'idle', 'generating', 'complete'
     let totalQuestions = 0; // Track total questions for validation
     let quizSubmitted = false; // Track if quiz has been submitted
+    let quizStreaming = false; // True while more shards of a large quiz are still arriving
     
     // Add the shared QuizUI styles
     QuizUI.addStyles();
@@ -363,6 +364,7 @@ document.addEventListener('DOMContentLoaded', function() {
                     // Quiz generation completed
                     quizData = data.quiz;
                     quizGenerationStatus = 'complete';
+                    quizStreaming = false;
                     
                     // Save quiz to localStorage
                     localStorage.setItem('studyLmQuiz', JSON.stringify(quizData));
@@ -372,6 +374,7 @@ document.addEventListener('DOMContentLoaded', function() {
                     // Render the quiz
                     showQuizContent();
                     renderQuiz(quizData);
+                    restoreSelections();
                 } else if (data.status === 'error') {
                     // Quiz generation failed
                     showError(data.message || 'Failed to generate quiz');
@@ -383,6 +386,16 @@ document.addEventListener('DOMContentLoaded', function() {
                     console.log('Quiz generation was canceled');
                     resetQuizState();
                 } else if (data.status === 'generating') {
+                    // Large quizzes arrive in shards - show finished questions early
+                    const renderedCount = quizData && quizData.questions ? quizData.questions.length : 0;
+                    if (data.quiz && data.quiz.questions && data.quiz.questions.length > renderedCount) {
+                        quizData = data.quiz;
+                        quizStreaming = true;
+                        showQuizContent();
+                        renderQuiz(quizData);
+                        restoreSelections();
+                    }
+                    
                     // Quiz is still being generated, check again in a few seconds
                     setTimeout(checkQuizGenerationStatus, 3000);
                 }
@@ -465,6 +478,19 @@ document.addEventListener('DOMContentLoaded', function() {
         // because we're using event delegation in the main event listener
     }
 
+    // Re-apply answers the user already picked after the quiz is re-rendered
+    function restoreSelections() {
+        for (const questionIndex in quizSelections) {
+            const answer = quizSelections[questionIndex];
+            const selectedInput = document.querySelector(`input[name="quiz-question-${questionIndex}"][value="${answer.selectedIndex}"]`);
+            if (!selectedInput) continue;
+            
+            selectedInput.checked = true;
+            selectedInput.closest('.form-check').classList.add('selected-answer');
+        }
+        updateAnswerCount();
+    }
+    
     // Function to update answer count and button state
     function updateAnswerCount() {
         // Ensure totalQuestions is valid before proceeding
@@ -485,8 +511,8 @@ document.addEventListener('DOMContentLoaded', function() {
             // Update button text to show progress
             submitQuizBtn.innerHTML = `<i class="bi bi-check-circle"></i> Check Answers (${answeredQuestions}/${totalQuestions})`;
 
-            // Enable button if all questions are answered
-            if (answeredQuestions >= totalQuestions) {
+            // Enable button if all questions are answered and no more are on the way
+            if (answeredQuestions >= totalQuestions && !quizStreaming) {
                 submitQuizBtn.disabled = false;
                 console.log('All questions answered, enabling submit button');
             } else {
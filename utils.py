@@ -1,8 +1,8 @@
 import os
 import json
-import re
-import google.generativeai as genai
 import model_config
+from app.helpers.json_utils import parse_json_text
+from app.services.model_backends import get_backend
 
 def upload_files(file_paths):
     """
@@ -10,7 +10,7 @@ def upload_files(file_paths):
     Returns the file references for immediate use.
     """
     # Upload files and get references
-    file_refs = [genai.upload_file(file_path) for file_path in file_paths]
+    file_refs = [get_backend().upload_file(file_path) for file_path in file_paths]
     
     # Extract URIs and save to file_uris.json
     file_uris = [file_ref.uri.split('/')[-1] for file_ref in file_refs]
@@ -32,7 +32,7 @@ def load_files_from_uris():
     
     file_refs = []
     for uri in file_uris:
-        file_ref = genai.get_file(uri)
+        file_ref = get_backend().get_file(uri)
         file_refs.append(file_ref)
     
     return file_refs
@@ -60,26 +60,10 @@ def extract_json_from_response(response):
     """
     Extract JSON from the Gemini API response.
     Returns a Python dictionary parsed from the JSON in the response.
+    Uses the shared tolerant parser from app.helpers.json_utils.
     """
     try:
-        text = response.text
-        
-        # Check if the response contains Markdown JSON code blocks
-        if "```json" in text:
-            # Extract the content between ```json and ```
-            start_idx = text.find("```json") + 7  # Move past "```json"
-            end_idx = text.find("```", start_idx)
-            if end_idx != -1:
-                text = text[start_idx:end_idx].strip()
-        
-        # Look for JSON content between curly braces if no code block was found
-        if not text.strip() or "```" in text:
-            json_match = re.search(r'({[\s\S]*})', text)
-            if json_match:
-                text = json_match.group(1)
-        
-        # Parse the text as JSON
-        return json.loads(text)
+        return parse_json_text(response.text)[0]
     except Exception as e:
         print(f"Error extracting JSON: {e}")
         # Return an empty list as a fallback
@@ -113,7 +97,7 @@ def generate_quiz_questions(file_refs, num_questions, context_prompt=""):
         )
         
         # Create a new model for the quiz generation
-        quiz_model = genai.GenerativeModel(
+        quiz_model = get_backend().create_model(
             model_name=model_config.DEFAULT_QUIZ_MODEL,
             generation_config={
                 'response_mime_type': 'application/json'
@@ -154,7 +138,7 @@ def generate_quiz_questions(file_refs, num_questions, context_prompt=""):
 def generate_study_guide(file_refs):
     """Generate a structured study guide from the files"""
     # Create new model configured for JSON response
-    json_response_model = genai.GenerativeModel(
+    json_response_model = get_backend().create_model(
         model_name=model_config.DEFAULT_STUDY_GUIDE_MODEL,
     )
     
@@ -205,18 +189,7 @@ def generate_study_guide(file_refs):
     )
     
     # Extract the JSON content from the response
-    response_text = structured_response.text
-    
-    # Check if the response contains Markdown JSON code blocks
-    if "```json" in response_text:
-        # Extract the content between ```json and ```
-        start_idx = response_text.find("```json") + 7  # Move past "```json"
-        end_idx = response_text.find("```", start_idx)
-        if end_idx != -1:
-            response_text = response_text[start_idx:end_idx].strip()
-    
-    # Parse the JSON data
-    study_guide_data = json.loads(response_text)
+    study_guide_data = parse_json_text(structured_response.text)[0]
     
     # Now add the quizzes to each section and unit using our consolidated quiz function
     for unit_index, unit in enumerate(study_guide_data):